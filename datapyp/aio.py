@@ -0,0 +1,201 @@
+# Copyright 2015 Fred Moolekamp
+# BSD 3-clause license
+"""
+Support for coroutine step functions and for running a `.Pipeline` from asyncio code
+"""
+import asyncio
+import functools
+import time
+import inspect
+import logging
+
+from datapyp.core import MultiprocessStep, PipelineError
+
+logger = logging.getLogger('datapyp.aio')
+
+def run_coroutine(coro, loop=None):
+    """
+    Run a coroutine to completion from synchronous code
+
+    Parameters
+    ----------
+    coro: coroutine
+        Coroutine to run
+    loop: `asyncio.AbstractEventLoop` (optional)
+        Event loop running in another thread. If ``loop`` is given the coroutine is
+        run in ``loop`` and the current thread waits for the result, otherwise the
+        coroutine is run in a new event loop.
+    """
+    if loop is not None and loop.is_running() and not _in_loop_thread(loop):
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+    if _get_running_loop() is not None:
+        coro.close()
+        raise PipelineError('Cannot run a coroutine step from inside a running event '
+            'loop, use Pipeline.arun instead of Pipeline.run')
+    return asyncio.run(coro)
+
+def _get_running_loop():
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+def _in_loop_thread(loop):
+    return _get_running_loop() is loop
+
+async def acall_step_func(func, func_kwargs):
+    """
+    Call a step function from a coroutine. Coroutine functions are awaited in the
+    current event loop, while other functions are run in the loop's default executor
+    so that they do not block the loop.
+    """
+    if inspect.iscoroutinefunction(func):
+        return await func(**func_kwargs)
+    loop = asyncio.get_running_loop()
+    result = await loop.run_in_executor(None, functools.partial(func, **func_kwargs))
+    if inspect.iscoroutine(result):
+        result = await result
+    return result
+
+async def aexecute_step(func, step_id, func_kwargs, run_step_idx, ignore_errors=False,
+        ignore_exceptions=False, retry=None, timeout=None):
+    """
+    Coroutine version of `.execute_step`. If ``timeout`` is given an attempt that
+    runs longer than ``timeout`` seconds raises a `.StepTimeout`, which is retried
+    if ``retry.retry_on`` includes `.StepTimeout`.
+    """
+    from datapyp.core import StepTimeout, check_result, get_exception_result
+    from datapyp.core import get_timeout_result
+    durations = []
+    while True:
+        start = time.time()
+        try:
+            try:
+                result = await asyncio.wait_for(acall_step_func(func, func_kwargs),
+                    timeout)
+            except asyncio.TimeoutError:
+                if timeout is None:
+                    raise
+                # Coroutines are cancelled, but functions running in the
+                # default executor are left running
+                raise StepTimeout()
+            durations.append(time.time()-start)
+            break
+        except Exception as error:
+            durations.append(time.time()-start)
+            if retry is not None and retry.should_retry(error, len(durations)):
+                delay = retry.get_delay(len(durations))
+                logger.warning('attempt {0} of step {1} failed ({2!r}), retrying in '
+                    '{3:.1f}s'.format(len(durations), step_id, error, delay))
+                await asyncio.sleep(delay)
+                continue
+            if isinstance(error, StepTimeout):
+                result = get_timeout_result(step_id, run_step_idx, timeout, ignore_errors)
+                break
+            if not ignore_exceptions:
+                raise
+            result = get_exception_result(step_id, run_step_idx)
+            break
+    result = check_result(result, step_id, run_step_idx, ignore_errors)
+    if retry is not None:
+        from datapyp.retry import record_attempts
+        record_attempts(result, durations)
+    return result
+
+async def run_async_step(pipeline, step, ignore_errors=None, ignore_exceptions=None,
+        cache=None, fresh=set(), freshness=None, resume=False, run_step_idx=None):
+    """
+    Run all of the steps in an `AsyncStep` in the current event loop, with at most
+    ``step.concurrency`` steps running at the same time. The results are saved in the
+    same way as the results of a `.MultiprocessStep`.
+    """
+    from datapyp.dispatch import Progress
+    if run_step_idx is None:
+        run_step_idx = pipeline.run_step_idx
+    tasks, keys, timeouts, shared_globals = pipeline._prepare_substeps(step,
+        ignore_errors, ignore_exceptions, cache, fresh, resume, run_step_idx,
+        in_process=True)
+    if len(tasks)>0:
+        progress = Progress('step {0}'.format(step.step_id), len(tasks))
+        results = asyncio.Queue()
+        # The coroutines for the steps are only created when a worker is free, so
+        # the number of steps is not limited by memory
+        pending = iter(tasks)
+
+        async def worker():
+            for idx, params in pending:
+                try:
+                    result = await aexecute_step(*params, timeout=timeouts.get(idx))
+                    success = True
+                except Exception as error:
+                    result = error
+                    success = False
+                await results.put((idx, success, result))
+
+        workers = [asyncio.ensure_future(worker())
+            for n in range(min(step.concurrency, len(tasks)))]
+        errors = []
+        try:
+            for n in range(len(tasks)):
+                idx, success, result = await results.get()
+                if not success:
+                    errors.append(result)
+                    if step.error_policy=='fail_fast':
+                        logger.warning(
+                            'step {0} failed, cancelling the remaining steps'.format(
+                                step.step_id))
+                        break
+                    continue
+                pipeline._finish_substep(step, idx, result, cache, keys[idx], freshness,
+                    progress)
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            pipeline._finish_reductions(step)
+        if len(errors)>0:
+            # Make sure the steps that finished are saved before the exception is raised
+            if pipeline._checkpointer is not None:
+                pipeline._checkpointer.step_interrupted(step)
+            raise errors[0]
+    return pipeline._set_container_results(step)
+
+async def arun_pipeline(pipeline, *args, **kwargs):
+    """
+    Run a pipeline without blocking the current event loop (see `.Pipeline.arun`)
+    """
+    loop = asyncio.get_running_loop()
+    if pipeline._loop is not None:
+        raise PipelineError('The pipeline is already running')
+    pipeline._loop = loop
+    try:
+        return await loop.run_in_executor(None,
+            functools.partial(pipeline.run, *args, **kwargs))
+    finally:
+        pipeline._loop = None
+
+class AsyncStep(MultiprocessStep):
+    """
+    A collection of steps run as coroutines in a single event loop, useful for large
+    numbers of steps that spend most of their time waiting on the network or on sockets.
+    Functions that are not coroutine functions are run in the event loop's
+    default executor.
+
+    When the pipeline is run with `.Pipeline.arun` the steps are run in the caller's
+    event loop, otherwise a new event loop is created for the step.
+    """
+    def __init__(self, concurrency=100, **kwargs):
+        """
+        Parameters
+        ----------
+        concurrency: int (optional)
+            Maximum number of steps running at the same time. The default is ``100``.
+        kwargs: dict
+            Keyword arguments for `.MultiprocessStep` (``step_id``, ``tags``,
+            ``steps``, ``finalizer``, ``error_policy``, ``reducers``,
+            ``depends_on`` and ``timeout``)
+        """
+        kwargs['pool_size'] = concurrency
+        MultiprocessStep.__init__(self, **kwargs)
+        self._step_type = 'AsyncStep'
+        self.concurrency = concurrency
@@ -0,0 +1,263 @@
+# Copyright 2015 Fred Moolekamp
+# BSD 3-clause license
+"""
+Run several steps of a `.MultiprocessStep` that use the same function with a single
+call to a batched version of the function
+"""
+import logging
+
+logger = logging.getLogger('datapyp.batch')
+
+# Keywords that are the same for every step and are only passed once to a batch function
+SHARED_KWARGS = ['global_vars', 'pipeline']
+
+def stack_kwargs(kwargs_list):
+    """
+    Combine the keyword arguments of several steps into a list of values for each
+    keyword. The keywords in `SHARED_KWARGS` are not combined, the value from the
+    first step is used.
+
+    Parameters
+    ----------
+    kwargs_list: list
+        Keyword arguments of each step. Every step must use the same keywords.
+
+    Returns
+    -------
+    kwargs: dict
+        Keyword arguments for the batch function
+    """
+    from datapyp.core import PipelineError
+    names = list(kwargs_list[0])
+    kwargs = {}
+    for name in names:
+        if name in SHARED_KWARGS:
+            kwargs[name] = kwargs_list[0][name]
+        else:
+            kwargs[name] = []
+    for func_kwargs in kwargs_list:
+        if len(func_kwargs)!=len(names):
+            raise PipelineError('Steps in a batch must use the same keywords')
+        for name in names:
+            if name not in SHARED_KWARGS:
+                kwargs[name].append(func_kwargs[name])
+    return kwargs
+
+def unstack_kwargs(kwargs, idx):
+    """
+    Keyword arguments of step number ``idx`` in a batch (see `stack_kwargs`)
+    """
+    return dict([(name, value if name in SHARED_KWARGS else value[idx])
+        for name, value in kwargs.items()])
+
+def split_results(result, n):
+    """
+    Split the result of a batch function into the results of each step
+
+    Parameters
+    ----------
+    result: list or dict
+        Either a list with the result of each step, or a dictionary with a list (or
+        array) of ``n`` values for each key. ``result['status']`` can also be a single
+        status used by every step.
+    n: int
+        Number of steps in the batch
+
+    Returns
+    -------
+    results: list
+        Result of each step
+    """
+    from datapyp.core import PipelineError
+    if isinstance(result, dict):
+        columns = {}
+        for name, values in result.items():
+            if name=='status' and isinstance(values, str):
+                values = [values]*n
+            elif not hasattr(values, '__len__') or len(values)!=n:
+                raise PipelineError(
+                    "Batch result '{0}' must have a value for each of the {1} steps".format(
+                        name, n))
+            elif hasattr(values, 'tolist'):
+                # Convert NumPy arrays to python values
+                values = values.tolist()
+            columns[name] = values
+        names = list(columns)
+        return [dict(zip(names, values)) for values in zip(*[columns[name]
+            for name in names])] if len(names)>0 else [{} for idx in range(n)]
+    if not hasattr(result, '__len__') or len(result)!=n:
+        raise PipelineError('Batch function must return a result for each of the '
+            '{0} steps'.format(n))
+    return list(result)
+
+class StepBatch:
+    """
+    Task that runs several steps with a single call to a batch function. It is sent to
+    a worker in place of the parameters of a single step (see `.run_task`).
+    """
+    def __init__(self, func, batch_func, kwargs, step_ids, run_step_idx, ignore_errors,
+            ignore_exceptions, retry):
+        """
+        Parameters
+        ----------
+        func: function or str
+            Function used by each step, or a reference to it created by
+            `datapyp.executors.get_func_ref`
+        batch_func: function or str
+            Batched version of ``func``, or a reference to it
+        kwargs: dict
+            Keyword arguments of all of the steps (see `stack_kwargs`)
+        step_ids: list
+            Id of each step
+        run_step_idx: int
+            Index of the `.MultiprocessStep` in the pipeline
+        ignore_errors: list
+            ``ignore_errors`` flag of each step
+        ignore_exceptions: list
+            ``ignore_exceptions`` flag of each step
+        retry: list
+            `datapyp.retry.RetryPolicy` of each step (or ``None``)
+        """
+        self.func = func
+        self.batch_func = batch_func
+        self.kwargs = kwargs
+        self.step_ids = step_ids
+        self.run_step_idx = run_step_idx
+        self.ignore_errors = ignore_errors
+        self.ignore_exceptions = ignore_exceptions
+        self.retry = retry
+
+    def __len__(self):
+        return len(self.step_ids)
+
+    def get_step_params(self, idx):
+        """
+        Parameters for `.run_task` to run step number ``idx`` separately
+        """
+        return (self.func, self.step_ids[idx], unstack_kwargs(self.kwargs, idx),
+            self.run_step_idx, self.ignore_errors[idx], self.ignore_exceptions[idx],
+            self.retry[idx])
+
+    def run(self):
+        """
+        Call the batch function and check the result of each step. If the batch
+        function raises an exception (or its result cannot be split), each step is
+        run separately with its own function, so that one bad step does not make the
+        entire batch fail.
+
+        Returns
+        -------
+        outcomes: list
+            ``(success, result)`` for each step, where ``result`` is the exception
+            raised by the step if ``success==False``
+        """
+        from datapyp.core import check_result, run_task, PipelineError
+        from datapyp.executors import resolve_func
+        try:
+            batch_func = resolve_func(self.batch_func)
+            results = split_results(batch_func(**self.kwargs), len(self))
+        except Exception as error:
+            logger.warning('batch of {0} steps failed ({1!r}), running them '
+                'separately'.format(len(self), error))
+            results = None
+        outcomes = []
+        if results is None:
+            for idx in range(len(self)):
+                try:
+                    outcomes.append((True, run_task(self.get_step_params(idx))))
+                except Exception as error:
+                    outcomes.append((False, error))
+            return outcomes
+        for idx, result in enumerate(results):
+            try:
+                outcomes.append((True, check_result(result, self.step_ids[idx],
+                    self.run_step_idx, self.ignore_errors[idx])))
+            except PipelineError as error:
+                outcomes.append((False, error))
+        return outcomes
+
+def build_batch(batch_func, params_list):
+    """
+    Create a `StepBatch` from the parameters for `.run_task` of each step
+    """
+    return StepBatch(params_list[0][0], batch_func,
+        stack_kwargs([params[2] for params in params_list]),
+        [params[1] for params in params_list], params_list[0][3],
+        [params[4] for params in params_list], [params[5] for params in params_list],
+        [params[6] if len(params)>6 else None for params in params_list])
+
+def group_keys(keys, get_func, batch_funcs, batch_size, timeouts=None):
+    """
+    Combine the tasks of steps that use a function in ``batch_funcs`` into batches of
+    up to ``batch_size`` steps. Steps with a timeout are not combined, since a
+    timeout would stop every step in the batch.
+
+    Parameters
+    ----------
+    keys: list
+        Index of each step that will be run, in the order they are dispatched
+    get_func: function
+        Function that returns the step function of the step with a given index
+    batch_funcs: dict
+        Batch function for each step function
+    batch_size: int
+        Maximum number of steps in a batch
+    timeouts: dict (optional)
+        Timeout of each step that has one
+
+    Returns
+    -------
+    keys: list
+        Keys of the tasks, where each batch is a tuple with the index of each of its
+        steps
+    """
+    if timeouts is None:
+        timeouts = {}
+    grouped = []
+    groups = {}
+    for idx in keys:
+        func = get_func(idx)
+        if func not in batch_funcs or timeouts.get(idx) is not None:
+            grouped.append(idx)
+            continue
+        if func not in groups:
+            groups[func] = []
+            grouped.append(groups[func])
+        group = groups[func]
+        group.append(idx)
+        if len(group)>=batch_size:
+            del groups[func]
+    return [tuple(key) if isinstance(key, list) else key for key in grouped]
+
+def split_batches(results, durations=None):
+    """
+    Split the results of the batches created by `group_keys` into the result of each
+    step
+
+    Parameters
+    ----------
+    results: iterable
+        ``(key, success, result)`` for each task that finished
+    durations: dict (optional)
+        Duration of each task. The duration of a batch is divided evenly between its
+        steps.
+
+    Returns
+    -------
+    results: generator
+        ``(idx, success, result)`` for each step
+    """
+    for key, success, result in results:
+        if not isinstance(key, tuple):
+            yield key, success, result
+            continue
+        if durations is not None and durations.get(key) is not None:
+            for idx in key:
+                durations[idx] = durations[key]/len(key)
+        if not success:
+            # The entire batch failed, for example because a worker was lost
+            for idx in key:
+                yield idx, False, result
+            continue
+        for idx, (step_success, step_result) in zip(key, result):
+            yield idx, step_success, step_result
@@ -0,0 +1,270 @@
+# Copyright 2015 Fred Moolekamp
+# BSD 3-clause license
+"""
+On-disk cache of step results, used to skip steps that have already been run with
+the same function and keyword arguments
+"""
+import os
+import hashlib
+import logging
+import threading
+import warnings
+
+logger = logging.getLogger('datapyp.cache')
+
+# Keywords injected by the pipeline that refer to mutable state, so the results
+# of functions that use them cannot be cached
+UNCACHEABLE_KWARGS = ['global_vars', 'pipeline']
+
+def get_func_hash(func):
+    """
+    Hash the identity of a function using its module, name and source code (or its
+    bytecode if the source is not available)
+    """
+    import inspect
+    sha = hashlib.sha1()
+    name = getattr(func, '__qualname__', getattr(func, '__name__', repr(func)))
+    sha.update('{0}.{1}'.format(getattr(func, '__module__', None), name).encode('utf-8'))
+    try:
+        sha.update(inspect.getsource(func).encode('utf-8'))
+    except (IOError, OSError, TypeError):
+        code = getattr(func, '__code__', None)
+        if code is None:
+            sha.update(repr(func).encode('utf-8'))
+        else:
+            sha.update(code.co_code)
+            sha.update(repr(code.co_consts).encode('utf-8'))
+    return sha.hexdigest()
+
+def _normalize_array(value):
+    import numpy as np
+    # Equal arrays give the same bytes regardless of their memory layout, byte order
+    # or the size of their dtype
+    kinds = {'b': np.bool_, 'i': np.int64, 'u': np.uint64, 'f': np.float64,
+        'c': np.complex128}
+    dtype = kinds.get(value.dtype.kind)
+    if dtype is None:
+        return value.dtype.str, value.shape, value.tolist()
+    return value.dtype.kind, value.shape, np.ascontiguousarray(value, dtype=dtype).tobytes()
+
+def get_value_hash(value):
+    """
+    Hash a keyword argument so that equal values give the same hash: dictionaries and
+    sets do not depend on the order their items were added, NumPy scalars are hashed
+    as python values and NumPy arrays are hashed by their values (see
+    `_normalize_array`). Other objects are pickled, so they must be picklable.
+
+    Returns
+    -------
+    digest: bytes
+        SHA1 digest of the value
+    """
+    import pickle
+    sha = hashlib.sha1()
+    if type(value).__module__=='numpy':
+        if hasattr(value, 'shape') and value.shape!=():
+            sha.update(b'array')
+            value = _normalize_array(value)
+        elif hasattr(value, 'item'):
+            value = value.item()
+    if isinstance(value, dict):
+        sha.update(b'dict')
+        items = sorted([get_value_hash(k)+get_value_hash(v) for k,v in value.items()])
+        for item in items:
+            sha.update(item)
+    elif isinstance(value, (set, frozenset)):
+        sha.update(b'set')
+        for item in sorted([get_value_hash(v) for v in value]):
+            sha.update(item)
+    elif isinstance(value, (list, tuple)):
+        sha.update(type(value).__name__.encode('utf-8'))
+        sha.update(str(len(value)).encode('utf-8'))
+        for v in value:
+            sha.update(get_value_hash(v))
+    elif isinstance(value, float):
+        sha.update(b'float')
+        sha.update(value.hex().encode('utf-8'))
+    else:
+        sha.update(pickle.dumps(value, 2))
+    return sha.digest()
+
+class StepCache:
+    """
+    Content-addressed cache of step results.
+
+    Each result is saved in ``path`` using a key built from a hash of the step function
+    and its keyword arguments. When the total size of the cache exceeds ``max_size``
+    the least recently used results are removed.
+
+    The cache can be used by steps running in separate threads.
+    """
+    def __init__(self, path, max_size=None):
+        """
+        Parameters
+        ----------
+        path: str
+            Directory used to store the cache
+        max_size: int (optional)
+            Maximum size of the cache (in bytes). If ``max_size`` is ``None``
+            the size of the cache is not limited.
+        """
+        from datapyp.utils import create_paths
+        if not os.path.isdir(path):
+            create_paths(path)
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.RLock()
+        self._func_hashes = {}
+        self._size = sum([os.path.getsize(os.path.join(path, f))
+            for f in os.listdir(path) if f.endswith('.p')])
+
+    def get_key(self, func, func_kwargs):
+        """
+        Build the key for a function called with ``func_kwargs``. If any of the keyword
+        arguments cannot be pickled, or the function uses the pipeline's global variables
+        or the pipeline itself, ``None`` is returned and the step is not cached.
+        Keyword arguments are hashed with `get_value_hash`.
+        """
+        if any([k in func_kwargs for k in UNCACHEABLE_KWARGS]):
+            return None
+        try:
+            func_hash = self._func_hashes[func]
+        except KeyError:
+            func_hash = self._func_hashes[func] = get_func_hash(func)
+        except TypeError:
+            # Unhashable callable
+            func_hash = get_func_hash(func)
+        try:
+            kwargs_hash = get_value_hash(func_kwargs)
+        except Exception:
+            return None
+        sha = hashlib.sha1(func_hash.encode('utf-8'))
+        sha.update(kwargs_hash)
+        return sha.hexdigest()
+
+    def _get_filename(self, key):
+        return os.path.join(self.path, key+'.p')
+
+    def get(self, key):
+        """
+        Load the results stored in the cache for ``key``
+
+        Returns
+        -------
+        hit: bool
+            Whether or not ``key`` was found in the cache
+        results: dict
+            Results saved in the cache (``None`` if the key was not found)
+        """
+        import pickle
+        filename = self._get_filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                results = pickle.load(f)
+        except Exception:
+            # A missing or unreadable entry is a miss
+            with self._lock:
+                self.misses += 1
+            return False, None
+        # Update the modification time to keep track of the least recently used results
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return True, results
+
+    def put(self, key, results):
+        """
+        Save the results of a step in the cache. The results are written to a temporary
+        file that replaces the entry once it is complete, so an interrupted write never
+        leaves a partial entry.
+
+        Returns
+        -------
+        success: bool
+            ``True`` if the results were saved
+        """
+        import pickle
+        try:
+            data = pickle.dumps(results, 2)
+        except Exception:
+            logger.debug('results for {0} could not be cached'.format(key))
+            return False
+        import tempfile
+        filename = self._get_filename(key)
+        fd, temp_filename = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            with self._lock:
+                old_size = os.path.getsize(filename) if os.path.isfile(filename) else 0
+                os.replace(temp_filename, filename)
+                self._size += len(data)-old_size
+                if self.max_size is not None and self._size>self.max_size:
+                    self.evict()
+        except Exception:
+            if os.path.isfile(temp_filename):
+                os.remove(temp_filename)
+            raise
+        return True
+
+    def evict(self):
+        """
+        Remove the least recently used results until the cache is smaller than
+        ``max_size``
+        """
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        files = []
+        for f in os.listdir(self.path):
+            if f.endswith('.p'):
+                filename = os.path.join(self.path, f)
+                stat = os.stat(filename)
+                files.append((stat.st_mtime, stat.st_size, filename))
+        files.sort()
+        self._size = sum([f[1] for f in files])
+        for mtime, size, filename in files:
+            if self._size<=self.max_size:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                warnings.warn('Unable to remove {0} from the cache'.format(filename))
+                continue
+            self._size -= size
+            self.evictions += 1
+
+    def clear(self):
+        """
+        Remove all of the results from the cache
+        """
+        with self._lock:
+            for f in os.listdir(self.path):
+                if f.endswith('.p'):
+                    os.remove(os.path.join(self.path, f))
+            self._size = 0
+
+    def get_stats(self):
+        """
+        Statistics for the cache
+
+        Returns
+        -------
+        stats: dict
+            Number of ``hits``, ``misses`` and ``evictions`` and the current ``size`` of
+            the cache (in bytes)
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': self._size
+            }
@@ -0,0 +1,293 @@
+# Copyright 2015 Fred Moolekamp
+# BSD 3-clause license
+"""
+Background writer used to save pipeline checkpoints while the next step runs
+"""
+import os
+import threading
+import logging
+import warnings
+from collections import deque
+
+logger = logging.getLogger('datapyp.checkpoint')
+
+class CheckpointWriter:
+    """
+    Write checkpoints to disk in a dedicated thread.
+
+    Data is serialized by the caller (so that it is a consistent snapshot of the
+    pipeline) and only the disk I/O happens in the background. The queue is bounded,
+    so if the disk cannot keep up the caller blocks until there is space. A snapshot
+    that is superseded by a newer snapshot of the same file before it has been written
+    is dropped, since only the latest state of the pipeline needs to be saved.
+    """
+    def __init__(self, maxsize=2):
+        """
+        Parameters
+        ----------
+        maxsize: int (optional)
+            Maximum number of writes waiting in the queue
+        """
+        self.maxsize = maxsize
+        self.errors = []
+        self.written = 0
+        self.coalesced = 0
+        self._queue = deque()
+        self._busy = False
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='datapyp-checkpoint')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, path, data, mode):
+        with self._cond:
+            if self._closed:
+                raise ValueError('CheckpointWriter has already been closed')
+            # Only replace a snapshot if it is the last write queued for the file,
+            # otherwise the order of writes to the file would change
+            if mode=='wb' and len(self._queue)>0:
+                last_path, last_data, last_mode = self._queue[-1]
+                if last_path==path and last_mode=='wb':
+                    self._queue[-1] = (path, data, mode)
+                    self.coalesced += 1
+                    return
+            while len(self._queue)>=self.maxsize:
+                self._cond.wait()
+            self._queue.append((path, data, mode))
+            self._cond.notify_all()
+
+    def write(self, path, data):
+        """
+        Queue ``data`` to replace the contents of ``path``. The file is written to a
+        temporary file first and then moved, so a crash never leaves a partial checkpoint.
+        """
+        self._put(path, data, 'wb')
+
+    def append(self, path, data):
+        """
+        Queue ``data`` to be appended to ``path``. Appends are never coalesced.
+        """
+        self._put(path, data, 'ab')
+
+    def _run(self):
+        replace = getattr(os, 'replace', os.rename)
+        while True:
+            with self._cond:
+                while len(self._queue)==0 and not self._closed:
+                    self._cond.wait()
+                if len(self._queue)==0:
+                    return
+                path, data, mode = self._queue.popleft()
+                self._busy = True
+                self._cond.notify_all()
+            try:
+                if mode=='wb':
+                    tmp_path = path+'.tmp'
+                    with open(tmp_path, 'wb') as f:
+                        f.write(data)
+                    replace(tmp_path, path)
+                else:
+                    with open(path, mode) as f:
+                        f.write(data)
+                self.written += 1
+            except Exception as error:
+                logger.error('unable to write checkpoint {0}: {1}'.format(path, error))
+                warnings.warn('Checkpoint {0} could not be saved'.format(path))
+                self.errors.append((path, error))
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+    def flush(self):
+        """
+        Block until every queued write has finished
+
+        Returns
+        -------
+        success: bool
+            ``True`` if every checkpoint has been written without an error
+        """
+        with self._cond:
+            while len(self._queue)>0 or self._busy:
+                self._cond.wait()
+        return len(self.errors)==0
+
+    def close(self):
+        """
+        Finish all of the queued writes and stop the writer thread
+        """
+        success = self.flush()
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        logger.debug('checkpoint writer wrote {0} files, {1} coalesced'.format(
+            self.written, self.coalesced))
+        return success
+
+class PipelineCheckpointer:
+    """
+    Save the state of a `.Pipeline` while it is running.
+
+    In ``'snapshot'`` mode the entire pipeline is saved after each step, while in
+    ``'journal'`` mode a compact record of each step is appended to a
+    `datapyp.journal.PipelineJournal`. Either way, the writes can be done in a
+    background `CheckpointWriter`.
+    """
+    # Minimum number of seconds between snapshots saved while the sub-steps
+    # of a MultiprocessStep are finishing
+    substep_interval = 30
+
+    def __init__(self, pipeline, logfile, dump_type=None, save_globals=False,
+            checkpoint='snapshot', compact_every=100, async_checkpoint=False):
+        """
+        Parameters
+        ----------
+        pipeline: `.Pipeline`
+            Pipeline to save
+        logfile: str
+            Filename used to save the pipeline
+        dump_type: str (optional)
+            Module used to serialize the pipeline (see `.Pipeline.save_pipeline`)
+        save_globals: bool (optional)
+            Whether or not to save global variables
+        checkpoint: str (optional)
+            Either ``'snapshot'`` or ``'journal'``
+        compact_every: int (optional)
+            Number of journal records written before the pipeline is saved and the
+            journal is cleared
+        async_checkpoint: bool (optional)
+            Whether or not to write the checkpoints in a background thread
+        """
+        self.pipeline = pipeline
+        self.logfile = logfile
+        self.dump_type = dump_type
+        self.save_globals = save_globals
+        self.checkpoint = checkpoint
+        self.compact_every = compact_every
+        self.async_checkpoint = async_checkpoint
+        self.journal = None
+        self.writer = None
+        # Global variables before each running step was started
+        self._globals_before = {}
+        self._last_save = 0
+
+    def save(self):
+        """
+        Save the entire pipeline
+        """
+        import time
+        import uuid
+        # Steps running in other threads cannot update the pipeline while it is saved
+        with self.pipeline._lock:
+            self._last_save = time.time()
+            # Every snapshot gets a new id, so that a journal written after an older
+            # snapshot is never replayed onto it
+            self.pipeline.snapshot_id = uuid.uuid4().hex
+            return self.pipeline.save_pipeline(
+                self.logfile, self.dump_type, self.save_globals, self.writer)
+
+    def start(self):
+        """
+        Save the pipeline before any steps are run and prepare the journal and writer
+
+        Returns
+        -------
+        success: bool
+            ``True`` if the pipeline was saved
+        """
+        from datapyp.journal import PipelineJournal, get_journal_path
+        if not self.save():
+            return False
+        # The pipeline was just saved, so any previous journal is out of date.
+        # It is removed in snapshot mode too, otherwise `.load_pipeline` would replay
+        # it onto the new snapshot.
+        journal_path = get_journal_path(self.logfile)
+        if self.checkpoint=='journal':
+            self.journal = PipelineJournal(journal_path, self.dump_type, self.compact_every)
+            self.journal.clear(self.pipeline.snapshot_id)
+        elif os.path.isfile(journal_path):
+            os.remove(journal_path)
+        # Write checkpoints in a separate thread
+        if self.async_checkpoint:
+            self.writer = CheckpointWriter()
+            if self.journal is not None:
+                self.journal.writer = self.writer
+        return True
+
+    def step_started(self, step):
+        """
+        Keep track of the global variables before ``step`` is run
+        """
+        if self.journal is not None:
+            from datapyp.journal import get_globals_state
+            with self.pipeline._lock:
+                self._globals_before[id(step)] = get_globals_state(self.pipeline.global_vars)
+
+    def step_finished(self, step, step_idx=None):
+        """
+        Save the pipeline after ``step`` has finished
+
+        Parameters
+        ----------
+        step: `.PipelineStep` or `.MultiprocessStep`
+            Step that finished
+        step_idx: int (optional)
+            Index of the step in `.Pipeline.run_steps`
+        """
+        if self.journal is not None:
+            from datapyp.journal import build_record, get_globals_delta
+            with self.pipeline._lock:
+                before = self._globals_before.pop(id(step), {})
+                changed, deleted, complete = get_globals_delta(
+                    before, self.pipeline.global_vars)
+                # A global variable that cannot be serialized might have been changed in
+                # place, so the entire pipeline is saved instead
+                if not complete and self.save():
+                    self.journal.clear(self.pipeline.snapshot_id)
+                    return
+                self.journal.append(build_record(
+                    step, self.pipeline.run_step_idx, (changed, deleted), step_idx))
+                if self.journal.needs_compaction() and self.save():
+                    self.journal.clear(self.pipeline.snapshot_id)
+        else:
+            self.save()
+
+    def substep_finished(self, step, substep_idx):
+        """
+        Save the results of a single step in a `.MultiprocessStep` as soon as it
+        finishes, including any ``global_updates`` it returned.
+        In ``'snapshot'`` mode the pipeline is saved at most once every
+        ``substep_interval`` seconds.
+        """
+        import time
+        if self.journal is not None:
+            from datapyp.journal import build_substep_record
+            with self.pipeline._lock:
+                self.journal.append(build_substep_record(step, substep_idx))
+        elif time.time()-self._last_save>self.substep_interval:
+            self.save()
+
+    def step_interrupted(self, step):
+        """
+        Save the pipeline when ``step`` fails, so that any of its sub-steps that finished
+        since the last snapshot are not lost. In ``'journal'`` mode every sub-step has
+        already been saved.
+        """
+        if self.journal is None:
+            self.save()
+
+    def close(self):
+        """
+        Finish writing all of the checkpoints
+
+        Returns
+        -------
+        success: bool
+            ``True`` if all of the checkpoints were written
+        """
+        if self.writer is not None:
+            return self.writer.close()
+        return True
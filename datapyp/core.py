@@ -4,89 +4,173 @@
 Class and functions to define an astronomy pipeline
 """
 import os
+import time
+import inspect
+import operator
 import subprocess
 import copy
 import logging
 import warnings
 
+from datapyp.freshness import get_step_key
+from datapyp.plan import get_injected_kwargs
+from datapyp.retry import get_retry_policy
+from datapyp.tags import TagList, get_step_tags, set_step_tags
+
 logger = logging.getLogger('datapyp.core')
 
+# Ways a MultiprocessStep can respond to an exception in one of its steps
+ERROR_POLICIES = ['continue', 'fail_fast']
+
 class PipelineError(Exception):
     """
     Errors generated by running Pipeline
     """
     pass
 
-def load_pipeline(path):
+class StepTimeout(PipelineError):
+    """
+    A step ran longer than its ``timeout``
+    """
+    pass
+
+def load_pipeline(path, journal=None):
     """
     Load a pipeline from a filename. This attempts to use the fastest method (cPickle)
     and if that fails it tries dill, then finally pickle. If all three fail an error
     is returned.
     
+    If the pipeline was run with ``checkpoint='journal'``, the records in its journal
+    are replayed to restore the state of the pipeline after the last completed step.
+    
     Parameters
     ----------
     path: str
         Filename of pipeline to load
+    journal: str (optional)
+        Filename of the journal to replay. The default is to use the journal
+        saved next to ``path`` (if it exists).
     """
+    from datapyp.journal import get_journal_path, replay_journal
     try:
         # Fastest
         import cPickle
         p = cPickle.load(open(path, 'rb'))
         logger.debug('loaded pipeline with cPickle')
-        return p
     except:
         try:
             # Most broad
             import dill
             p = dill.load(open(path, 'rb'))
             logger.debug('loaded pipeline with dill')
-            return p
         except ImportError:
             # Unlikely to work if the others failed, but still try
             import pickle
             p = pickle.load(open(path, 'rb'))
             logger.debug('loaded pipeline with pickle')
-            return p
     
-    raise PipelineError("Unable to load pipeline with cPickle, dill, or pickle")
+    if journal is None:
+        journal = get_journal_path(path)
+    if os.path.isfile(journal):
+        replay_journal(p, journal)
+    return p
 
-def run_step(params):
+def get_exception_result(step_id, run_step_idx):
     """
-    Run a specified step in a pipeline
+    Result of a step that raised an exception while ``ignore_exceptions==True``.
+    This must be called from the ``except`` block that caught the exception.
+    """
+    import traceback
+    warning_str = "Exception occurred during step {0} (run_step_idx {1})".format(
+        step_id, run_step_idx)
+    warnings.warn(warning_str)
+    return {
+        'status': 'error', 
+        'error': traceback.format_exc()
+    }
+
+def get_timeout_result(step_id, run_step_idx, timeout, ignore_errors=False):
+    """
+    Result of a step that was stopped because it ran longer than its ``timeout``.
+    If ``ignore_errors==False`` a `StepTimeout` is raised instead.
+    """
+    if not ignore_errors:
+        raise StepTimeout('Step {0} (run_step_idx {1}) timed out after {2}s'.format(
+            step_id, run_step_idx, timeout))
+    warnings.warn('Step {0} (run_step_idx {1}) timed out after {2}s'.format(
+        step_id, run_step_idx, timeout))
+    return {
+        'status': 'timeout',
+        'timeout': timeout
+    }
+
+def check_step_timeout(step):
+    """
+    Make sure that a `PipelineStep` with a ``timeout`` also has an ``executor``, since
+    a step run directly in the pipeline's thread cannot be stopped
+    """
+    if (step._step_type=='PipelineStep' and getattr(step, 'timeout', None) is not None
+            and getattr(step, 'executor', None) is None):
+        raise PipelineError(
+            "Step {0} has a timeout but no executor. Only a step run in a separate "
+            "process can be stopped, so set executor='process': the function and its "
+            "keyword arguments must be picklable and changes it makes to global_vars "
+            "or the pipeline are lost".format(step.step_id))
+
+def handle_task_timeout(dispatcher, key, params, timeout, timed_out):
+    """
+    Handle a task (with parameters for `run_task`) that ran longer than its
+    ``timeout``. If the retry policy of the step allows it the task is sent back to
+    ``dispatcher`` to be run again, otherwise the timeout result of the step is
+    returned (see `get_timeout_result`).
     
     Parameters
     ----------
+    dispatcher: `datapyp.dispatch.TaskDispatcher`
+        Dispatcher running the task
+    key: object
+        Key of the task in ``dispatcher``
+    params: tuple
+        Parameters of the task
+    timeout: float
+        Timeout of the task
+    timed_out: dict
+        Duration of each attempt that timed out for every task, which is updated
     
+    Returns
+    -------
+    result: dict
+        Result of the step, or ``None`` if the task will be run again
     """
-    step, func_kwargs, run_step_idx, ignore_errors, ignore_exceptions = params
-    
-    logger.debug('function kwargs: {0}'.format(step.func_kwargs))
-    
-    # Attempt to run the step. If an exception occurs, use the
-    # ignore_exceptions parameter to determine whether to 
-    # stop the Pipeline's execution or warn the user and
-    # continue
-    if (ignore_exceptions is not None and ignore_exceptions) or (
-            ignore_exceptions is None and step.ignore_exceptions):
-        try:
-            result = step.func(**func_kwargs)
-        except Exception as error:
-            import traceback
-            warning_str = "Exception occurred during step {0} (run_step_idx {1})".format(
-                step.step_id, run_step_idx)
-            warnings.warn(warning_str)
-            result = {
-                'status': 'error', 
-                'error': traceback.format_exc()
-            }
-    else:
-        result = step.func(**func_kwargs)
+    retry = params[6] if len(params)>6 else None
+    durations = timed_out.setdefault(key, [])
+    durations.append(timeout)
+    if retry is not None and retry.should_retry(StepTimeout(), len(durations)):
+        delay = retry.get_delay(len(durations))
+        logger.warning('attempt {0} of step {1} timed out, retrying in {2:.1f}s'.format(
+            len(durations), params[1], delay))
+        dispatcher.retry(key, params, delay)
+        return None
+    result = get_timeout_result(params[1], params[3], timeout, params[4])
+    if retry is not None:
+        from datapyp.retry import record_attempts
+        record_attempts(result, durations)
+    return result
+
+def check_result(result, step_id, run_step_idx, ignore_errors=False):
+    """
+    Check the result returned by a step function
     
-    step.results = result
+    Returns
+    -------
+    result: dict
+        Result returned by the step. If it is not a dictionary with a
+        ``status`` key, the result is ``{'status': 'unknown', 'result': result}``.
+    """
     # Check that the result is a dictionary with a 'status' key
     if result is None or not isinstance(result, dict) or 'status' not in result:
         warning_str = "Step {0} (run_step_idx {1}) did not return a valid result".format(
-            step.step_id, run_step_idx)
+            step_id, run_step_idx)
         warnings.warn(warning_str)
         result = {
             'status': 'unknown',
@@ -95,26 +179,247 @@ def run_step(params):
     # If there was an error in the step, use ignore_errors to determine whether
     # or not to raise an exception
     if result['status'].lower() == 'error':
-        if ((ignore_errors is None and not step.ignore_errors) or
-                not ignore_errors):
+        if not ignore_errors:
             raise PipelineError(
                 'Error returned in step {0} (run_step_idx {1})'.format(
-                    step.step_id, run_step_idx
+                    step_id, run_step_idx
                 ))
         else:
             warning_str = "Error in step {0} (run_step_idx{1})".format(
-                step.step_id, run_step_idx)
+                step_id, run_step_idx)
             warning_str += ", see results for more"
             warnings.warn(warning_str)
+    return result
+
+def call_step_func(func, func_kwargs, loop=None):
+    """
+    Call a step function. If ``func`` is a coroutine function the coroutine is run
+    to completion (see `datapyp.aio.run_coroutine`).
+    """
+    result = func(**func_kwargs)
+    if inspect.iscoroutine(result):
+        from datapyp.aio import run_coroutine
+        result = run_coroutine(result, loop)
+    return result
+
+def execute_step(func, step_id, func_kwargs, run_step_idx, ignore_errors=False,
+        ignore_exceptions=False, loop=None, retry=None):
+    """
+    Run a step function and check its result
+    
+    Parameters
+    ----------
+    func: function
+        Function to run. If ``func`` is a coroutine function it is run in an event loop.
+    step_id: str
+        Id of the step (used in warnings and errors)
+    func_kwargs: dict
+        Keyword arguments passed to ``func``
+    run_step_idx: int
+        Index of the current step in the pipeline
+    ignore_errors: bool (optional)
+        Whether or not to raise a `PipelineError` if ``func`` returns an error
+    ignore_exceptions: bool (optional)
+        Whether or not to catch an exception raised by ``func`` and return
+        an error instead
+    loop: `asyncio.AbstractEventLoop` (optional)
+        Event loop (running in another thread) used to run coroutine functions.
+        By default a new event loop is created for each coroutine.
+    retry: `datapyp.retry.RetryPolicy` (optional)
+        Policy used to run ``func`` again if it raises an exception. If ``retry`` is
+        given the number of attempts and the duration of each attempt are saved
+        in the result.
+    
+    Returns
+    -------
+    result: dict
+        Result returned by ``func``. If ``func`` did not return a dictionary with a
+        ``status`` key, the result is ``{'status': 'unknown', 'result': result}``.
+    """
+    durations = []
+    while True:
+        start = time.time()
+        # Attempt to run the step. If an exception occurs, use the
+        # retry policy and the ignore_exceptions parameter to determine whether to
+        # run the step again, stop the Pipeline's execution or warn the user and
+        # continue
+        try:
+            result = call_step_func(func, func_kwargs, loop)
+            durations.append(time.time()-start)
+            break
+        except Exception as error:
+            durations.append(time.time()-start)
+            if retry is not None and retry.should_retry(error, len(durations)):
+                delay = retry.get_delay(len(durations))
+                logger.warning('attempt {0} of step {1} failed ({2!r}), retrying in '
+                    '{3:.1f}s'.format(len(durations), step_id, error, delay))
+                time.sleep(delay)
+                continue
+            if not ignore_exceptions:
+                raise
+            result = get_exception_result(step_id, run_step_idx)
+            break
+    result = check_result(result, step_id, run_step_idx, ignore_errors)
+    if retry is not None:
+        from datapyp.retry import record_attempts
+        record_attempts(result, durations)
+    return result
+
+def get_ignore_flags(step, ignore_errors=None, ignore_exceptions=None):
+    """
+    Combine the ``ignore_errors`` and ``ignore_exceptions`` parameters passed to
+    `Pipeline.run` with the parameters for a step. If the run parameter is ``None``
+    the value for the step is used.
+    """
+    if ignore_errors is None:
+        ignore_errors = step.ignore_errors
+    if ignore_exceptions is None:
+        ignore_exceptions = step.ignore_exceptions
+    return ignore_errors, ignore_exceptions
+
+def run_step(params):
+    """
+    Run a specified step in a pipeline
+    
+    Parameters
+    ----------
+    params: tuple
+        ``(step, func_kwargs, run_step_idx, ignore_errors, ignore_exceptions)``,
+        optionally followed by the event loop used to run coroutine functions
+    
+    Returns
+    -------
+    step: `PipelineStep`
+        The step with its ``results`` set
+    """
+    step, func_kwargs, run_step_idx, ignore_errors, ignore_exceptions = params[:5]
+    loop = params[5] if len(params)>5 else None
+    
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('function kwargs: {0}'.format(step.func_kwargs))
+    ignore_errors, ignore_exceptions = get_ignore_flags(
+        step, ignore_errors, ignore_exceptions)
+    step.results = execute_step(step.func, step.step_id, func_kwargs, run_step_idx,
+        ignore_errors, ignore_exceptions, loop, getattr(step, 'retry', None))
     return step
 
+def run_task(params):
+    """
+    Run a step in a worker process. Only the information needed to call the function
+    is sent to the worker and only the result is sent back, instead of the
+    entire `PipelineStep`.
+    
+    Parameters
+    ----------
+    params: tuple
+        ``(func_ref, step_id, func_kwargs, run_step_idx, ignore_errors,
+        ignore_exceptions)``, optionally followed by a `datapyp.retry.RetryPolicy`,
+        where ``func_ref`` is created by `datapyp.executors.get_func_ref`, or a
+        `datapyp.batch.StepBatch`
+    
+    Returns
+    -------
+    result: dict
+        Result of the step, or the outcome of each step in a
+        `datapyp.batch.StepBatch` (see `datapyp.batch.StepBatch.run`)
+    """
+    from datapyp.executors import resolve_func
+    from datapyp.batch import StepBatch
+    if isinstance(params, StepBatch):
+        return params.run()
+    func_ref, step_id, func_kwargs, run_step_idx, ignore_errors, ignore_exceptions = (
+        params[:6])
+    retry = params[6] if len(params)>6 else None
+    return execute_step(resolve_func(func_ref), step_id, func_kwargs, run_step_idx,
+        ignore_errors, ignore_exceptions, retry=retry)
+
 class StepContainer:
     def get_next_id(self):
         next_id = self.next_id
         self.next_id += 1
         return next_id
     
-    def add_step(self, func, tags=list(), ignore_errors=False, ignore_exceptions=False, **kwargs):
+    @property
+    def steps(self):
+        """
+        Steps in the container. A list of steps is stored as a `datapyp.tags.StepList`,
+        which keeps the container's tag index up to date as steps are added, replaced
+        or removed.
+        """
+        return self._steps
+    
+    @steps.setter
+    def steps(self, steps):
+        from datapyp.tags import StepList
+        from datapyp.table import StepTable
+        if not isinstance(steps, (StepList, StepTable)):
+            steps = StepList(steps)
+        old_steps = self.__dict__.get('_steps')
+        if isinstance(old_steps, StepList) and old_steps is not steps:
+            # Stop updating the index of the old steps, which is rebuilt if it is used
+            old_steps._reset_index()
+        self._steps = steps
+    
+    def __getstate__(self):
+        # Containers are saved with the same attributes as before the steps and tags
+        # were properties, and the tag index is rebuilt when it is needed
+        state = self.__dict__.copy()
+        state['steps'] = state.pop('_steps')
+        if '_tags' in state:
+            state['tags'] = list(state.pop('_tags'))
+        state.pop('_tag_index', None)
+        return state
+    
+    def __setstate__(self, state):
+        state = dict(state)
+        steps = state.pop('steps')
+        tags = state.pop('tags', None)
+        state.pop('_tag_index', None)
+        self.__dict__.update(state)
+        self.steps = steps
+        if tags is not None or hasattr(self.__class__, 'tags'):
+            self.tags = tags
+    
+    def get_tag_index(self):
+        """
+        Get the `datapyp.tags.TagIndex` of the steps in the container. The index of a
+        list of steps is updated as the steps change, while the steps in a
+        `datapyp.table.StepTable` are indexed each time.
+        """
+        from datapyp.tags import StepList, TagIndex
+        if isinstance(self.steps, StepList):
+            return self.steps.get_index()
+        return TagIndex(self.steps)
+    
+    def select_steps(self, tag_expr=None, run_tags=(), ignore_tags=()):
+        """
+        Select steps using their tags. The steps are found using the container's
+        tag index, so only the steps that are selected are visited.
+        
+        Parameters
+        ----------
+        tag_expr: str (optional)
+            Boolean expression of tags, for example ``'reduce and not (test or
+            debug*)'`` (see `datapyp.tags.parse_tag_expression`)
+        run_tags: list (optional)
+            Only select steps that have one of the ``run_tags``
+        ignore_tags: list (optional)
+            Do not select steps that have one of the ``ignore_tags``
+        
+        Returns
+        -------
+        steps: list
+            Selected steps, in the order they were added
+        """
+        from datapyp.tags import build_tag_query
+        query = build_tag_query(run_tags, ignore_tags, tag_expr)
+        if query is None:
+            return list(self.steps)
+        return [self.steps[idx] for idx in sorted(self.get_tag_index().select(query))]
+    
+    def add_step(self, func, tags=list(), ignore_errors=False, ignore_exceptions=False,
+            cache=False, inputs=None, outputs=None, depends_on=None, executor=None,
+            timeout=None, retry=None, idempotent=False, **kwargs):
         """
         Build a new `PipelineStep` to the pipeline
     
@@ -138,6 +443,28 @@ class StepContainer:
             for the step that threw an exception and continue running. The default is
             ``ignore_exceptions==False``, which will stop the pipeline and raise an
             exception.
+        cache: bool (optional)
+            If ``cache==True`` the results of the step are saved in the pipeline's
+            step cache and the step is skipped when it is run again with the same
+            function and keyword arguments. The default is ``False``.
+        inputs: list (optional)
+            Files read by the step
+        outputs: list (optional)
+            Files created by the step. When the pipeline is run with
+            ``freshness`` set, the step is skipped if its outputs are up to date.
+        depends_on: list (optional)
+            ``step_id`` of each step that must finish before this step is run
+            when the pipeline is run with ``scheduler=='dag'``
+        executor: str (optional)
+            Name of an executor used to run the step outside of the pipeline's
+            thread (see `PipelineStep`). The default is to run the step directly.
+        timeout: float (optional)
+            Maximum number of seconds the step is allowed to run (see `PipelineStep`)
+        retry: `datapyp.retry.RetryPolicy`, int or dict (optional)
+            How to retry the step if it fails (see `PipelineStep`)
+        idempotent: bool (optional)
+            Whether or not the step can safely be run more than once
+            (see `PipelineStep`)
         kwargs: dict
             Keyword arguments passed to the ``func`` when the pipeline is run
         """
@@ -153,12 +480,20 @@ class StepContainer:
                 tags,
                 ignore_errors,
                 ignore_exceptions,
-                kwargs
+                kwargs,
+                cache=cache,
+                inputs=inputs,
+                outputs=outputs,
+                depends_on=depends_on,
+                executor=executor,
+                timeout=timeout,
+                retry=retry,
+                idempotent=idempotent
             ))
 
 class Pipeline(StepContainer):
     def __init__(self, paths={}, pipeline_name=None,
-            next_id=0, create_paths=False, **kwargs):
+            next_id=0, create_paths=False, cache_size=None, executor='process', **kwargs):
         """
         Parameters
         ----------
@@ -186,11 +521,23 @@ class Pipeline(StepContainer):
             If ``create_paths==True``, any path in ``paths`` that does not exist
             is created. Otherwise the user will be prompted if a path does not
             exist. The default is to prompt the user (``create_paths==False``).
+        cache_size: int (optional)
+            Maximum size (in bytes) of the cache used to store the results of steps
+            with ``cache==True``. The cache is saved in ``paths['cache']`` or, if no
+            cache path is given, a *step_cache* directory in ``paths['temp']``.
+            The default is ``None``, which does not limit the size of the cache.
+        executor: str (optional)
+            Name of the executor used to run the steps in each `MultiprocessStep`
+            (see `datapyp.executors.create_executor`), unless the step sets its own
+            ``executor``. The options are ``'serial'``, ``'thread'``, ``'process'``
+            (the default), ``'spawn'``, ``'forkserver'`` and ``'socket'``. An executor
+            object can also be used.
         kwargs: dict
             Additional keyword arguments that might be used in a custom pipeline.
         """
         from datapyp.utils import check_path
         from types import MethodType
+        import threading
         self.create_paths = create_paths
         self.name = pipeline_name
         self.steps = []
@@ -198,7 +545,31 @@ class Pipeline(StepContainer):
         self.run_steps = None
         self.run_warnings = None
         self.run_step_idx = 0
+        # Indices of the steps in run_steps that have finished, which can be ahead
+        # of run_step_idx when the steps are run with scheduler=='dag'
+        self.completed_steps = set()
         self.paths = paths
+        self.cache_size = cache_size
+        self.cache_stats = None
+        self.executor = executor
+        # Executors shared by the steps, by name
+        self._executors = {}
+        # Largest pool_size of the steps in run_steps that use each executor
+        self._pool_sizes = None
+        self._checkpointer = None
+        # Id of the last snapshot saved while the pipeline was run, used to match the
+        # snapshot with its journal
+        self.snapshot_id = None
+        # Event loop used to run coroutines while the pipeline is run by `Pipeline.arun`
+        self._loop = None
+        # Durations of previous steps, used to order the steps in a MultiprocessStep
+        self._history = None
+        # Lock used when steps running in separate threads update the pipeline
+        self._lock = threading.RLock()
+        # Lists and arrays grown by the 'concat' reducer for each running step
+        self._reductions = {}
+        # Keywords injected into each step function during the current run
+        self._injected = {}
         
         # Set additional keyword arguements
         for key, value in kwargs.items():
@@ -224,7 +595,147 @@ class Pipeline(StepContainer):
             warnings.warn(
                 "'log' path has not been set for the pipeline. Log files will not be saved.")
     
-    def save_pipeline(self, logfile, dump_type=None, save_globals=False):
+    def __getstate__(self):
+        # The pool of workers and the objects used to save the pipeline while it is
+        # running cannot be pickled
+        state = StepContainer.__getstate__(self)
+        state['_executors'] = {}
+        state['_pool_sizes'] = None
+        state['_checkpointer'] = None
+        state['_loop'] = None
+        state['_history'] = None
+        state['_reductions'] = {}
+        state['_injected'] = {}
+        del state['_lock']
+        return state
+    
+    def __setstate__(self, state):
+        import threading
+        # Pipelines saved before steps could be run concurrently
+        state.setdefault('completed_steps', set())
+        state.setdefault('_loop', None)
+        state.setdefault('_history', None)
+        state.setdefault('snapshot_id', None)
+        state.setdefault('executor', 'process')
+        state.setdefault('_executors', {})
+        state.setdefault('_pool_sizes', None)
+        state.setdefault('_reductions', {})
+        state.setdefault('_injected', {})
+        StepContainer.__setstate__(self, state)
+        self._lock = threading.RLock()
+    
+    def add_step(self, func, *args, **kwargs):
+        """
+        Add a step to the pipeline (see `StepContainer.add_step`). A step with a
+        ``timeout`` must also have an ``executor`` (see `PipelineStep`).
+        """
+        next_id = self.next_id
+        StepContainer.add_step(self, func, *args, **kwargs)
+        step = self.steps[-1]
+        try:
+            check_step_timeout(step)
+        except PipelineError:
+            # Remove the step and free its id, so that step ids have no gaps
+            self.steps.pop()
+            if self.next_id!=next_id:
+                self.next_id = next_id
+                if step is func:
+                    step.step_id = None
+            raise
+    
+    def get_executor(self, processes=None, executor=None):
+        """
+        Get the pool of workers shared by all of the steps in the pipeline that use
+        the same executor. The pool is created the first time it is needed and is
+        closed at the end of `Pipeline.run`.
+        
+        Parameters
+        ----------
+        processes: int (optional)
+            Number of workers to use if the pool has not been created yet
+        executor: str (optional)
+            Name of the executor. The default is the pipeline's ``executor``.
+        """
+        from datapyp.executors import create_executor
+        if executor is None:
+            executor = self.executor
+        if hasattr(executor, 'submit'):
+            return executor
+        with self._lock:
+            if executor not in self._executors:
+                self._executors[executor] = create_executor(executor, processes)
+            return self._executors[executor]
+    
+    def close_executor(self, terminate=False):
+        """
+        Shut down the pools of workers shared by the steps
+        
+        Parameters
+        ----------
+        terminate: bool (optional)
+            If ``terminate==True`` the workers are stopped immediately, otherwise
+            they are allowed to finish their current tasks.
+        """
+        with self._lock:
+            executors = list(self._executors.values())
+            self._executors = {}
+        for executor in executors:
+            if terminate:
+                executor.terminate()
+            else:
+                executor.close()
+    
+    def _get_executor_name(self, step):
+        """
+        Name of the executor used to run ``step``, or ``None`` if the step is run in
+        the pipeline's process
+        """
+        if step._step_type in ['MultiprocessStep', 'ThreadedStep']:
+            return getattr(step, 'executor', None) or self.executor
+        return getattr(step, 'executor', None)
+    
+    def _get_step_executor(self, step, reuse_pool=True):
+        """
+        Get the executor used to run ``step``
+        
+        Returns
+        -------
+        executor: object
+            Executor for the step
+        owned: bool
+            Whether the executor was created for this step and must be closed
+            when the step has finished
+        """
+        from datapyp.executors import create_executor
+        executor = self._get_executor_name(step)
+        pool_size = getattr(step, 'pool_size', None)
+        if hasattr(executor, 'submit'):
+            return executor, False
+        if not reuse_pool:
+            return create_executor(executor, pool_size), True
+        # Use a pool large enough for the largest step that uses the same executor
+        sizes = [self._get_pool_sizes().get(executor), pool_size]
+        sizes = [size for size in sizes if size is not None]
+        return self.get_executor(max(sizes) if len(sizes)>0 else None, executor), False
+    
+    def _get_pool_sizes(self):
+        """
+        Largest ``pool_size`` of the steps in ``run_steps`` that use each executor.
+        This is only worked out once per run.
+        """
+        if self._pool_sizes is None:
+            sizes = {}
+            for step in self.run_steps or []:
+                size = getattr(step, 'pool_size', None)
+                if size is None:
+                    continue
+                executor = self._get_executor_name(step)
+                if executor not in sizes or size>sizes[executor]:
+                    sizes[executor] = size
+            self._pool_sizes = sizes
+        return self._pool_sizes
+    
+    def save_pipeline(self, logfile, dump_type=None, save_globals=False, writer=None):
         """
         Save the pipeline to file
         
@@ -236,24 +747,33 @@ class Pipeline(StepContainer):
         log_exception: bool (optional)
             If the pipeline cannot be saved, if ``log_exception==True`` an exception
             will be raised.
+        writer: `datapyp.checkpoint.CheckpointWriter` (optional)
+            If a writer is specified the pipeline is serialized immediately but
+            written to disk in the writer's background thread.
         
         Returns
         -------
         success: bool
-            If the file was saved the function returns ``True``
+            If the file was saved (or queued to be saved) the function returns ``True``
         """
+        def dump(module):
+            if writer is None:
+                module.dump(self, open(logfile, 'wb'))
+            else:
+                writer.write(logfile, module.dumps(self))
+        
         # Depending on the contents of the pipeline cPickle might work
         if dump_type=='pickle' or dump_type is None:
             try:
                 import cPickle
-                cPickle.dump(self, open(logfile, 'wb'))
+                dump(cPickle)
                 dump_type = 'pickle'
                 logger.info('saved using cPickle')
                 return True
             except:
                 try:
                     import pickle
-                    pickle.dump(self, open(logfile, 'wb'))
+                    dump(pickle)
                     dump_type = 'pickle'
                     logger.info('saved using pickle')
                     return True
@@ -266,7 +786,7 @@ class Pipeline(StepContainer):
         if dump_type=='dill' or dump_type is None:
             try:
                 import dill
-                dill.dump(self, open(logfile, 'wb'))
+                dump(dill)
                 dump_type = 'dill'
                 logger.info('saved using dill')
                 return True
@@ -284,31 +804,532 @@ class Pipeline(StepContainer):
     
     def get_func_kwargs(self, step):
         """
-        Add on any special keywords to the function kwargs
+        Add on any special keywords to the function kwargs. The keywords accepted by
+        each function are only found once per run (see
+        `datapyp.plan.get_injected_kwargs`), and the kwargs of a step whose function
+        doesn't accept any of them are used without copying them.
         """
-        import inspect
+        func = step.func
+        try:
+            injected = self._injected[func]
+        except KeyError:
+            injected = self._injected[func] = get_injected_kwargs(func)
+        except TypeError:
+            # Unhashable callable
+            injected = get_injected_kwargs(func)
+        if len(injected)==0:
+            return step.func_kwargs
         func_kwargs = step.func_kwargs.copy()
-
-        # Some functions use step_id to keep track of log files, so the id of
-        # the current step is added to the funciton call
-        function_args = inspect.getargspec(step.func).args
-        if 'step_id' in function_args:
-            func_kwargs['step_id'] = step.step_id
-        
-        # Include the pipelines global variables
-        if 'global_vars' in function_args:
-            func_kwargs['global_vars'] = self.global_vars
-        
-        # Some functions require the Pipeline as a parameter,
-        # so pass the pipeline to the function
-        if 'pipeline' in function_args:
-            func_kwargs['pipeline'] = self
+        for name in injected:
+            # Some functions use step_id to keep track of log files, so the id of
+            # the current step is added to the funciton call
+            if name=='step_id':
+                func_kwargs['step_id'] = step.step_id
+            # Include the pipelines global variables
+            elif name=='global_vars':
+                func_kwargs['global_vars'] = self.global_vars
+            # Some functions require the Pipeline as a parameter,
+            # so pass the pipeline to the function
+            else:
+                func_kwargs['pipeline'] = self
         return func_kwargs
     
+    def get_step_cache(self):
+        """
+        Load the cache used to store the results of steps with ``cache==True``.
+        If neither a ``cache`` or ``temp`` path has been set for the pipeline, a warning
+        is given and ``None`` is returned.
+        """
+        from datapyp.cache import StepCache
+        if 'cache' in self.paths:
+            path = self.paths['cache']
+        elif 'temp' in self.paths:
+            path = os.path.join(self.paths['temp'], 'step_cache')
+        else:
+            warnings.warn("A 'cache' or 'temp' path is required to cache step results")
+            return None
+        return StepCache(path, self.cache_size)
+    
+    def _load_cached(self, cache, step, func_kwargs):
+        """
+        If the results of ``step`` are in the step cache, load them into ``step.results``
+        and clear them otherwise. Returns the cache key for the step or ``None`` if
+        the step is not cached.
+        """
+        if cache is None or not getattr(step, 'cache', False):
+            return None
+        key = cache.get_key(step.func, func_kwargs)
+        if key is None:
+            logger.debug('step {0} cannot be cached'.format(step.step_id))
+            return None
+        hit, results = cache.get(key)
+        step.results = results
+        if hit:
+            logger.info('loaded step {0} from the cache'.format(step.step_id))
+        return key
+    
+    def _save_cached(self, cache, step, key):
+        """
+        Save the results of a step in the step cache if it ran successfully
+        """
+        if key is not None and isinstance(step.results, dict) and (
+                step.results.get('status')=='success'):
+            cache.put(key, step.results)
+    
+    def _skip_fresh(self, step):
+        """
+        Mark a step whose outputs are up to date as finished. If the step has results
+        from a previous run they are kept.
+        """
+        if not isinstance(step.results, dict) or step.results.get('status')!='success':
+            step.results = {
+                'status': 'success',
+                'up_to_date': True
+            }
+    
+    def _save_hashes(self, step, freshness):
+        """
+        Save the hashes of the inputs of a step that ran successfully, so that the next
+        time the pipeline is run with ``freshness=='hash'`` the step can be skipped if
+        its inputs have not changed
+        """
+        if freshness=='hash' and isinstance(step.results, dict) and (
+                step.results.get('status')=='success') and getattr(step, 'outputs', None):
+            from datapyp.freshness import hash_inputs
+            step.input_hashes = hash_inputs(step)
+    
+    def _reduce_globals(self, step, result):
+        """
+        Combine the ``global_updates`` returned by a step in a `MultiprocessStep`
+        with the pipeline's global variables. Returns the new values of the variables
+        that were updated.
+        """
+        if not isinstance(result, dict) or not result.get('global_updates'):
+            return None
+        from datapyp.reducers import apply_updates
+        with self._lock:
+            return apply_updates(self.global_vars, result['global_updates'],
+                getattr(step, 'reducers', {}), self._reductions.setdefault(id(step), {}))
+    
+    def _finish_reductions(self, step):
+        """
+        Stop growing the variables combined by the sub-steps of ``step`` in place, so
+        that they are copied the next time a step updates them
+        """
+        with self._lock:
+            self._reductions.pop(id(step), None)
+    
+    def _prepare_substeps(self, step, ignore_errors=None, ignore_exceptions=None,
+            cache=None, fresh=set(), resume=False, run_step_idx=None, in_process=False,
+            batch=False, shared_memory=True):
+        """
+        Build the tasks for the steps in a `MultiprocessStep` that need to be run.
+        Steps that are up to date or in the step cache are finished immediately.
+        If ``step.dispatch_order=='longest_first'`` the tasks are sorted by their
+        expected duration. If ``batch==True`` steps with a function in
+        ``step.batch_funcs`` are combined into `datapyp.batch.StepBatch` tasks, whose
+        keys are a tuple with the index of each step in the batch. Unless
+        ``in_process==True`` large arrays in the global variables are placed in shared
+        memory, or if ``shared_memory==False`` (for workers on other hosts) they are
+        pickled with each task.
+        
+        Returns
+        -------
+        tasks: list
+            ``(idx, params)`` for each step that needs to be run, where ``idx`` is the
+            index of the step and ``params`` are the parameters for `run_task`.
+            If the steps are a `datapyp.table.StepTable` this is a
+            `datapyp.dispatch.LazyTasks` that builds the parameters of each step
+            when it is dispatched.
+        keys: dict
+            Cache key of each step that needs to be run
+        timeouts: dict
+            Timeout of each step that needs to be run and has one. A step without
+            its own ``timeout`` (or ``retry``) uses the ``timeout`` (or ``retry``)
+            of the `MultiprocessStep`.
+        shared_globals: `datapyp.shared.SharedGlobals`
+            Global variables placed in shared memory for the workers, or ``None``.
+            The caller must release them when the steps have finished.
+        """
+        from datapyp.executors import get_func_ref
+        from datapyp.table import StepTable
+        if run_step_idx is None:
+            run_step_idx = self.run_step_idx
+        # Variables left over from a previous run of the step are copied again
+        self._finish_reductions(step)
+        tasks = []
+        keys = {}
+        timeouts = {}
+        func_refs = {}
+        shared = {}
+        # The tasks for the steps in a StepTable are only built when they are dispatched
+        lazy = isinstance(step.steps, StepTable)
+        rows = []
+        
+        def share_globals():
+            # Large arrays are placed in shared memory instead of being
+            # sent to the workers with every step
+            if not shared_memory:
+                return self.global_vars
+            if 'globals' not in shared:
+                from datapyp.shared import SharedGlobals
+                shared['globals'] = SharedGlobals(self.paths.get('temp'))
+                shared['worker_globals'] = shared['globals'].share(self.global_vars)
+            return shared['worker_globals']
+        
+        def build_params(mstep, func_kwargs):
+            if 'global_vars' in func_kwargs and not in_process:
+                func_kwargs['global_vars'] = share_globals()
+            # Steps run in the current process don't need to be pickled
+            if in_process:
+                func_refs[mstep.func] = mstep.func
+            elif mstep.func not in func_refs:
+                func_refs[mstep.func] = get_func_ref(mstep.func)
+            retry = getattr(mstep, 'retry', None) or getattr(step, 'retry', None)
+            return (func_refs[mstep.func], mstep.step_id, func_kwargs,
+                run_step_idx) + get_ignore_flags(mstep, ignore_errors, ignore_exceptions
+                ) + (retry,)
+        
+        def build_row(idx):
+            mstep = step.steps[idx]
+            return build_params(mstep, self.get_func_kwargs(mstep))
+        
+        for idx, mstep in enumerate(step.steps):
+            if resume and isinstance(mstep.results, dict) and (
+                    mstep.results.get('status')=='success'):
+                continue
+            if len(fresh)>0 and get_step_key(mstep) in fresh:
+                self._skip_fresh(mstep)
+                continue
+            if lazy and (cache is None or not mstep.cache):
+                key = None
+            else:
+                func_kwargs = self.get_func_kwargs(mstep)
+                key = self._load_cached(cache, mstep, func_kwargs)
+                if key is not None and mstep.results is not None:
+                    self._reduce_globals(step, mstep.results)
+                    continue
+            if lazy:
+                rows.append(idx)
+            else:
+                tasks.append((idx, build_params(mstep, func_kwargs)))
+            keys[idx] = key
+            timeout = getattr(mstep, 'timeout', None)
+            if timeout is None:
+                timeout = getattr(step, 'timeout', None)
+            if timeout is not None:
+                timeouts[idx] = timeout
+        if getattr(step, 'dispatch_order', 'list')=='longest_first' and (
+                self._history is not None):
+            from datapyp.history import order_keys, order_tasks
+            estimates = dict([(idx, self._history.estimate(*self._get_task_features(
+                step.steps[idx]))) for idx in keys])
+            if lazy:
+                rows = order_keys(rows, estimates)
+            else:
+                tasks = order_tasks(tasks, estimates)
+        if lazy:
+            from datapyp.dispatch import LazyTasks
+            tasks = LazyTasks(rows, build_row)
+            if len(rows)>0 and not in_process and any(['global_vars' in
+                    get_injected_kwargs(func) for func in step.steps.funcs]):
+                # The shared memory must exist before the caller starts the tasks
+                share_globals()
+        batch_funcs = getattr(step, 'batch_funcs', None)
+        if batch and batch_funcs and len(tasks)>0:
+            tasks = self._group_substeps(step, tasks, timeouts, ignore_errors,
+                ignore_exceptions, run_step_idx, in_process, func_refs, share_globals)
+        shared_globals = shared.get('globals')
+        return tasks, keys, timeouts, shared_globals
+    
+    def _group_substeps(self, step, tasks, timeouts, ignore_errors, ignore_exceptions,
+            run_step_idx, in_process, func_refs, share_globals):
+        """
+        Combine the tasks of the steps in a `MultiprocessStep` that have a batch
+        function into batches (see `_prepare_substeps`). The keyword arguments of the
+        steps in a `datapyp.table.StepTable` are combined directly from its columns.
+        """
+        from datapyp.batch import StepBatch, build_batch, group_keys
+        from datapyp.dispatch import LazyTasks, get_task_keys
+        from datapyp.executors import get_func_ref
+        from datapyp.table import StepTable
+        table = step.steps if isinstance(step.steps, StepTable) else None
+        if table is not None:
+            get_func = lambda idx: table.get_attr(idx, 'func')
+        else:
+            get_func = lambda idx: step.steps[idx].func
+        if isinstance(tasks, LazyTasks):
+            build = tasks.build
+        else:
+            build = dict(tasks).__getitem__
+        
+        def get_ref(func):
+            # Steps run in the current process don't need to be pickled
+            if func not in func_refs:
+                func_refs[func] = func if in_process else get_func_ref(func)
+            return func_refs[func]
+        
+        def build_table_batch(rows, func, batch_func):
+            attr = table.get_attr
+            kwargs = table.get_stacked_kwargs(rows)
+            step_ids = [attr(row, 'step_id') for row in rows]
+            for name in get_injected_kwargs(func):
+                if name=='step_id':
+                    kwargs['step_id'] = step_ids
+                elif name=='global_vars':
+                    kwargs['global_vars'] = self.global_vars if in_process else (
+                        share_globals())
+                else:
+                    kwargs['pipeline'] = self
+            # Same as get_ignore_flags without creating a view of each step
+            if ignore_errors is None:
+                errors = [attr(row, 'ignore_errors') for row in rows]
+            else:
+                errors = [ignore_errors]*len(rows)
+            if ignore_exceptions is None:
+                exceptions = [attr(row, 'ignore_exceptions') for row in rows]
+            else:
+                exceptions = [ignore_exceptions]*len(rows)
+            retry = [attr(row, 'retry') or getattr(step, 'retry', None) for row in rows]
+            return StepBatch(get_ref(func), get_ref(batch_func), kwargs, step_ids,
+                run_step_idx, errors, exceptions, retry)
+        
+        def build_task(key):
+            if not isinstance(key, tuple):
+                return build(key)
+            func = get_func(key[0])
+            batch_func = step.batch_funcs[func]
+            if table is not None:
+                return build_table_batch(key, func, batch_func)
+            return build_batch(get_ref(batch_func), [build(idx) for idx in key])
+        return LazyTasks(group_keys(get_task_keys(tasks), get_func, step.batch_funcs,
+            step.batch_size, timeouts), build_task)
+    
+    def _get_task_features(self, step):
+        """
+        Function name and size of the input files of a step, used to record and
+        estimate its duration in the runtime history
+        """
+        from datapyp.history import get_func_key, get_task_size
+        return get_func_key(step.func), get_task_size(step.func_kwargs)
+    
+    def _record_duration(self, step, duration):
+        """
+        Save the duration of a step in the runtime history
+        """
+        if self._history is not None and duration is not None:
+            func_key, size = self._get_task_features(step)
+            self._history.add(func_key, size, duration)
+    
+    def _finish_substep(self, step, idx, result, cache=None, key=None, freshness=None,
+            progress=None):
+        """
+        Save the result of a single step in a `MultiprocessStep` as soon as it finishes
+        """
+        mstep = step.steps[idx]
+        mstep.results = result
+        self._reduce_globals(step, result)
+        self._save_cached(cache, mstep, key)
+        self._save_hashes(mstep, freshness)
+        if progress is not None:
+            progress.update()
+            step.progress = progress.get_state()
+        if self._checkpointer is not None:
+            self._checkpointer.substep_finished(step, idx)
+    
+    def _set_container_results(self, step):
+        """
+        Set the status of a `MultiprocessStep` from the results of its steps
+        """
+        statuses = set([s.results['status'] for s in step.steps])
+        if statuses.issubset(['success']):
+            step.results = {
+                'status': 'success'
+            }
+        elif statuses.issubset(['error', 'timeout']):
+            step.results = {
+                'status': 'error'
+            }
+        else:
+            step.results = {
+                'status': 'some failed'
+            }
+        return step
+    
+    def _run_multiprocess_step(self, step, ignore_errors=None, ignore_exceptions=None,
+            cache=None, fresh=set(), freshness=None, reuse_pool=True, resume=False,
+            run_step_idx=None):
+        """
+        Run all of the steps in a `MultiprocessStep` (or `ThreadedStep`) using the
+        step's executor.
+        If ``resume==True`` only the steps that have not already finished successfully
+        are run.
+        """
+        if run_step_idx is None:
+            run_step_idx = self.run_step_idx
+        executor, owned = self._get_step_executor(step, reuse_pool)
+        # Executors that run in the current process don't need the steps to be pickled
+        in_process = getattr(executor, 'in_process', False)
+        tasks, keys, timeouts, shared_globals = self._prepare_substeps(step,
+            ignore_errors, ignore_exceptions, cache, fresh, resume, run_step_idx,
+            in_process, batch=True,
+            shared_memory=getattr(executor, 'shared_memory', True))
+        if len(tasks)==0 and owned:
+            executor.close()
+        if len(tasks)>0:
+            from datapyp.dispatch import TaskDispatcher, Progress, LazyTasks, get_task_keys
+            max_active = step.pool_size
+            if getattr(executor, 'max_active', None) is not None:
+                max_active = min(max_active, executor.max_active)
+            # Results are processed as soon as each step finishes, so that the
+            # results of completed steps are saved even if another step fails
+            speculative = getattr(step, 'speculative', None)
+            if speculative is True:
+                speculative = 2
+            dispatcher = TaskDispatcher(executor, run_task, step.initializer, max_active,
+                getattr(step, 'chunksize', 1), speculative or None)
+            # Only idempotent steps are safe to run more than once
+            speculate = set()
+            if speculative:
+                for key in get_task_keys(tasks):
+                    # The key of a batch is the index of each of its steps
+                    idxs = key if isinstance(key, tuple) else [key]
+                    if getattr(step, 'idempotent', False) or all([
+                            getattr(step.steps[idx], 'idempotent', False) for idx in idxs]):
+                        speculate.add(key)
+            progress = Progress('step {0}'.format(step.step_id), len(keys))
+            if isinstance(tasks, LazyTasks):
+                get_params = tasks.build
+            else:
+                get_params = dict(tasks).get
+            results = dispatcher.imap_unordered(tasks, timeouts, speculate)
+            if getattr(step, 'batch_funcs', None):
+                from datapyp.batch import split_batches
+                results = split_batches(results, dispatcher.durations)
+            timed_out = {}
+            errors = []
+            try:
+                for idx, success, result in results:
+                    if not success and isinstance(result, StepTimeout):
+                        # The retry policy and ignore_errors flag of the step decide
+                        # whether a timeout stops the step
+                        try:
+                            result = handle_task_timeout(dispatcher, idx,
+                                get_params(idx), timeouts[idx], timed_out)
+                            if result is None:
+                                continue
+                            success = True
+                        except StepTimeout as error:
+                            result = error
+                    elif success and idx in timed_out:
+                        from datapyp.retry import record_attempts
+                        record_attempts(result,
+                            timed_out[idx]+result.get('attempt_durations', []))
+                    if not success:
+                        errors.append(result)
+                        if getattr(step, 'error_policy', 'continue')=='fail_fast':
+                            logger.warning(
+                                'step {0} failed, cancelling the remaining steps'.format(
+                                    step.step_id))
+                            dispatcher.cancel()
+                            break
+                        continue
+                    if self._history is not None:
+                        self._record_duration(step.steps[idx],
+                            dispatcher.durations.get(idx))
+                    self._finish_substep(step, idx, result, cache, keys[idx], freshness,
+                        progress)
+            finally:
+                if owned:
+                    executor.close()
+                if shared_globals is not None:
+                    shared_globals.release()
+                self._finish_reductions(step)
+            if len(errors)>0:
+                # Make sure the steps that finished are saved before the exception is raised
+                if self._checkpointer is not None:
+                    self._checkpointer.step_interrupted(step)
+                raise errors[0]
+        return self._set_container_results(step)
+    
+    def _run_step_in_executor(self, step, func_kwargs, run_step_idx, ignore_errors=None,
+            ignore_exceptions=None, reuse_pool=True):
+        """
+        Run a `PipelineStep` that has an ``executor`` as a single task in the executor
+        """
+        from datapyp.dispatch import TaskDispatcher
+        from datapyp.executors import get_func_ref
+        executor, owned = self._get_step_executor(step, reuse_pool)
+        func = step.func
+        if not getattr(executor, 'in_process', False):
+            func = get_func_ref(func)
+        params = (func, step.step_id, func_kwargs, run_step_idx) + get_ignore_flags(
+            step, ignore_errors, ignore_exceptions) + (getattr(step, 'retry', None),)
+        timeouts = {}
+        if getattr(step, 'timeout', None) is not None:
+            timeouts[0] = step.timeout
+        timed_out = {}
+        dispatcher = TaskDispatcher(executor, run_task)
+        try:
+            for idx, success, result in dispatcher.imap_unordered([(0, params)], timeouts):
+                if not success and isinstance(result, StepTimeout):
+                    result = handle_task_timeout(dispatcher, idx, params, step.timeout,
+                        timed_out)
+                    if result is None:
+                        continue
+                elif not success:
+                    raise result
+                elif idx in timed_out:
+                    from datapyp.retry import record_attempts
+                    record_attempts(result,
+                        timed_out[idx]+result.get('attempt_durations', []))
+                step.results = result
+        finally:
+            if owned:
+                executor.close()
+        return step
+    
+    def _execute_step(self, step, run_step_idx, cache=None, fresh=set(), freshness=None,
+            ignore_errors=None, ignore_exceptions=None, reuse_pool=True, resume=False):
+        """
+        Run a single step in ``run_steps``, followed by its finalizer
+        """
+        if logger.isEnabledFor(logging.INFO):
+            logger.info('running step {0}: {1}'.format(step.step_id, step.tags))
+        if get_step_key(step) in fresh:
+            logger.info('step {0} is up to date'.format(step.step_id))
+            self._skip_fresh(step)
+        elif step._step_type=='PipelineStep':
+            func_kwargs = self.get_func_kwargs(step)
+            key = self._load_cached(cache, step, func_kwargs)
+            if step.results is None or key is None:
+                if self._get_executor_name(step) is None:
+                    step = run_step((step, func_kwargs, run_step_idx, ignore_errors,
+                        ignore_exceptions, self._loop))
+                else:
+                    self._run_step_in_executor(step, func_kwargs, run_step_idx,
+                        ignore_errors, ignore_exceptions, reuse_pool)
+                self._save_cached(cache, step, key)
+                self._save_hashes(step, freshness)
+        elif step._step_type in ['MultiprocessStep', 'ThreadedStep']:
+            self._run_multiprocess_step(step, ignore_errors, ignore_exceptions, cache,
+                fresh, freshness, reuse_pool, resume, run_step_idx)
+        elif step._step_type=='AsyncStep':
+            from datapyp.aio import run_async_step, run_coroutine
+            run_coroutine(run_async_step(self, step, ignore_errors, ignore_exceptions,
+                cache, fresh, freshness, resume, run_step_idx), self._loop)
+        if get_step_key(step) not in fresh and (
+                hasattr(step, 'finalizer') and step.finalizer is not None):
+            step.finalizer(self, step)
+        return step
+    
     def run(self, run_tags=[], ignore_tags=[], run_steps=None, run_name=None,
             resume=False, ignore_errors=None, ignore_exceptions=None,
             start_idx=None, current_step_idx=None, dump_type=None,
-            log_exception=False, save_globals=False):
+            log_exception=False, save_globals=False, checkpoint='snapshot',
+            compact_every=100, async_checkpoint=False, freshness=None, reuse_pool=True,
+            scheduler='sequential', max_concurrent=None, runtime_history=None,
+            tag_expr=None):
         """
         Run the pipeline given a list of PipelineSteps
         
@@ -320,6 +1341,12 @@ class Pipeline(StepContainer):
             in ignore tags.
         ignore_tags: list (optional)
             Ignore all steps that contain one of the tags in ``ignore_tags``.
+        tag_expr: str (optional)
+            Only run steps whose tags match a boolean expression, which combines tags
+            (that can include the wildcards ``*``, ``?`` and ``[...]``) with ``and``,
+            ``or``, ``not`` and parentheses, for example
+            ``'reduce and not (test or debug*)'``. This is combined with ``run_tags``
+            and ``ignore_tags``.
         run_steps: list of `PipelineStep` (optional)
             Instead of running the steps associated with a pipeline, the user can specify
             a set of steps to run. This can be useful if (for example) mulitple criteria
@@ -335,7 +1362,9 @@ class Pipeline(StepContainer):
             If ``resume==True`` and ``start_idx is None``, the pipeline will continue
             where it left off. If ``resume==False`` and ``start_idx is None`` then the
             pipeline will start at the first step (Pipeline.run_step_idx=0). The
-            default is ``resume=False``.
+            default is ``resume=False``. If the run stopped during a `MultiprocessStep`,
+            only the steps in the `MultiprocessStep` that did not finish successfully
+            are run when it is resumed.
         ignore_errors: bool (optional)
             If ``ignore_errors==False`` the pipeline will raise an exception if an error
             occurred during any step in the pipeline which returned a result with
@@ -359,94 +1388,244 @@ class Pipeline(StepContainer):
             will be raised.
         save_globals: bool
             Whether or not to save global variables. *Default is False*
+        checkpoint: str (optional)
+            How the pipeline is saved after each step. If ``checkpoint=='snapshot'``
+            (the default) the entire pipeline is saved after each step. If
+            ``checkpoint=='journal'`` a compact record of each completed step is
+            appended to a journal next to the pipeline's log file, which is replayed
+            by `load_pipeline`.
+        compact_every: int (optional)
+            When ``checkpoint=='journal'``, the number of steps to run before saving
+            the entire pipeline and clearing the journal. The default is ``100``.
+        async_checkpoint: bool (optional)
+            If ``async_checkpoint==True`` the pipeline is still serialized after each
+            step but it is written to disk in a background thread, so the next step
+            can begin while the checkpoint is being saved. All of the checkpoints are
+            written before ``run`` returns (or raises an exception).
+            The default is ``False``.
+        freshness: str (optional)
+            If ``freshness=='mtime'``, steps with declared ``outputs`` that are all newer
+            than their ``inputs`` are skipped. If ``freshness=='hash'``, a step is also
+            skipped if the contents of its inputs have not changed since it was last run.
+            The default is ``None``, which runs every step.
+        reuse_pool: bool (optional)
+            If ``reuse_pool==True`` (the default) all of the `MultiprocessStep` objects
+            share a single pool of workers, sized by the largest ``pool_size``, that is
+            closed when the run finishes (or raises an exception). Each step's
+            ``initializer`` is run once in each worker, before the worker's first task
+            from that step. If ``reuse_pool==False`` a new pool is created for each step.
+        scheduler: str (optional)
+            If ``scheduler=='sequential'`` (the default) the steps are run one at a time
+            in the order of ``run_steps``. If ``scheduler=='dag'`` each step is started
+            as soon as the steps it depends on have finished (see the ``depends_on``,
+            ``inputs`` and ``outputs`` of `PipelineStep`), so steps that do not depend
+            on each other run at the same time. Steps that run at the same time should
+            not modify the same global variables. When a run with ``scheduler=='dag'``
+            is resumed, only the steps that did not finish are run.
+        max_concurrent: int (optional)
+            Maximum number of steps running at the same time when
+            ``scheduler=='dag'``. The default is the number of cpus.
+        runtime_history: bool (optional)
+            Whether or not to record how long each step in a `MultiprocessStep` takes,
+            along with the size of its input files, in a history saved next to the
+            pipeline's log file (see `datapyp.history.RuntimeHistory`). Steps with
+            ``dispatch_order=='longest_first'`` use the history to run the steps that
+            are expected to take the longest first. The default is ``None``, which
+            records the history if any of the steps use ``'longest_first'``.
         """
         # If no steps are specified and the user is not resuming a previous run,
-        # run all of the steps associated with the pipeline
+        # run all of the steps associated with the pipeline.
+        # Filter the steps based on run_tags, ignore_tags and tag_expr, with ignore
+        # tags taking precendent
+        from datapyp.plan import filter_steps
         if run_steps is not None:
-            self.run_steps = run_steps
+            self.run_steps = filter_steps(run_steps, run_tags, ignore_tags, tag_expr)
         elif  self.run_steps is None or not resume:
-            self.run_steps = [step for step in self.steps]
-        # Filter the steps based on run_tags and ignore_tags, with ignore tags 
-        # taking precendent
-        self.run_steps = [step for step in self.run_steps if
-            (len(run_tags) == 0 or any([tag in run_tags for tag in step.tags])) and
-            not any([tag in ignore_tags for tag in step.tags])]
+            self.run_steps = self.select_steps(tag_expr, run_tags, ignore_tags)
+        else:
+            self.run_steps = filter_steps(self.run_steps, run_tags, ignore_tags,
+                tag_expr)
+        
+        self._pool_sizes = None
+        for step in self.run_steps:
+            check_step_timeout(step)
+        if checkpoint not in ['snapshot', 'journal']:
+            raise PipelineError(
+                "checkpoint must be either 'snapshot' or 'journal', received {0}".format(
+                    checkpoint))
+        if scheduler not in ['sequential', 'dag']:
+            raise PipelineError(
+                "scheduler must be either 'sequential' or 'dag', received {0}".format(
+                    scheduler))
+        if scheduler=='dag':
+            # Check for circular dependencies before anything is run
+            from datapyp.scheduler import DagScheduler
+            dag = DagScheduler(self.run_steps, max_concurrent)
         
         # Set the path of the log file for the current run
-        skip_save = True
+        checkpointer = None
         if 'log' in self.paths:
+            from datapyp.checkpoint import PipelineCheckpointer
             if run_name is None:
                 logfile = os.path.join(self.paths['log'], 'pipeline.p')
             else:
                 logfile = os.path.join(self.paths['log'], 'pipeline-{0}.p'.format(run_name))
             logger.info('Pipeline state will be saved to {0}'.format(logfile))
             
-            if self.save_pipeline(logfile, dump_type):
-                skip_save = False
-            elif log_exception:
-                raise PipelineError("Pipeline could not be saved")
-            
+            checkpointer = PipelineCheckpointer(self, logfile, dump_type, save_globals,
+                checkpoint, compact_every, async_checkpoint)
+            if not checkpointer.start():
+                checkpointer = None
+                if log_exception:
+                    raise PipelineError("Pipeline could not be saved")
+        self._checkpointer = checkpointer
+        
+        # Load the durations of the steps from previous runs
+        if runtime_history is None:
+            runtime_history = any([getattr(step, 'dispatch_order', 'list')=='longest_first'
+                for step in self.run_steps])
+        history = None
+        if runtime_history:
+            from datapyp.history import RuntimeHistory, get_history_path
+            history_path = None
+            if 'log' in self.paths:
+                history_path = get_history_path(logfile)
+            history = RuntimeHistory(history_path)
+        self._history = history
+        
+        # Check the inputs and outputs of all of the steps before any are run
+        fresh = set()
+        if freshness is not None:
+            from datapyp.freshness import find_fresh_steps, FRESHNESS_METHODS
+            if freshness not in FRESHNESS_METHODS:
+                raise PipelineError("freshness must be one of {0}, received {1}".format(
+                    FRESHNESS_METHODS, freshness))
+            start = start_idx if start_idx is not None else (self.run_step_idx if resume else 0)
+            fresh = find_fresh_steps(self.run_steps[start:], freshness)
+        
+        # Load the step cache if any of the steps use it
+        cache = None
+        if any([getattr(step, 'cache', False) for step in self.run_steps]) or any([
+                getattr(mstep, 'cache', False) for step in self.run_steps
+                if hasattr(step, 'steps') for mstep in step.steps]):
+            cache = self.get_step_cache()
+        
         # If the user specifies a starting index use it, otherwise start at the 
         # first step unless the user specified to resume where it left off
         if start_idx is not None:
             self.run_step_idx = start_idx
         elif not resume:
             self.run_step_idx = 0
-        # Run each step in order
-        steps = self.run_steps[self.run_step_idx:]
-        for step in steps:
-            logger.info('running step {0}: {1}'.format(step.step_id, step.tags))
-            # Run the step
-            if step._step_type=='PipelineStep':
-                func_kwargs = self.get_func_kwargs(step)
-                step = run_step(
-                    (step, func_kwargs, self.run_step_idx, ignore_errors, ignore_exceptions))
-            elif step._step_type=='MultiprocessStep':
-                import multiprocessing
-                pool_kwargs = {'processes': step.pool_size}
-                if step.initializer is not None:
-                    pool_kwargs['initializer'] = step.initializer
-                pool = multiprocessing.Pool(** pool_kwargs)
-                pool_params = []
-                for mstep in step.steps:
-                    func_kwargs = self.get_func_kwargs(mstep)
-                    pool_params.append(
-                        (mstep, func_kwargs, self.run_step_idx, ignore_errors, ignore_exceptions)
-                    )
-                pool_results = pool.map(run_step, pool_params)
-                pool.close()
-                pool.join()
-                step.steps = pool_results
-                if all([s.results['status']=='success' for s in step.steps]):
-                    step.results = {
-                        'status': 'success'
-                    }
-                elif all([s.results['status']=='error' for s in step.steps]):
-                    step.results = {
-                        'status': 'error'
-                    }
-                else:
-                    step.results = {
-                        'status': 'some failed'
-                    }
-            if hasattr(step, 'finalizer') and step.finalizer is not None:
-                step.finalizer(self, step)
-            # Increase the run_step_idx and save the pipeline
-            self.run_step_idx+=1
-            if not skip_save:
-                self.save_pipeline(logfile, dump_type, save_globals)
+        if not resume or start_idx is not None:
+            self.completed_steps = set()
+        options = {
+            'cache': cache,
+            'fresh': fresh,
+            'freshness': freshness,
+            'ignore_errors': ignore_errors,
+            'ignore_exceptions': ignore_exceptions,
+            'reuse_pool': reuse_pool
+        }
+        try:
+            if scheduler=='dag':
+                self._run_dag(dag, options, resume and start_idx is None)
+            else:
+                # Only the first step might have been interrupted by the previous run
+                resume_idx = self.run_step_idx if resume and start_idx is None else None
+                # Run each step in order
+                for step_idx in range(self.run_step_idx, len(self.run_steps)):
+                    step = self.run_steps[step_idx]
+                    if checkpointer is not None:
+                        checkpointer.step_started(step)
+                    self._execute_step(step, step_idx, resume=step_idx==resume_idx,
+                        **options)
+                    # Increase the run_step_idx and save the pipeline
+                    self.run_step_idx+=1
+                    self.completed_steps.add(step_idx)
+                    if checkpointer is not None:
+                        checkpointer.step_finished(step, step_idx)
+        except:
+            self.close_executor(terminate=True)
+            raise
+        finally:
+            self.close_executor()
+            # Make sure that every checkpoint has been written, even if a step failed
+            self._checkpointer = None
+            if checkpointer is not None:
+                saved = checkpointer.close()
+            self._history = None
+            self._injected = {}
+            if history is not None:
+                history.save()
+            if cache is not None:
+                self.cache_stats = cache.get_stats()
+                logger.info('step cache: {0}'.format(self.cache_stats))
+        if checkpointer is not None and not saved and log_exception:
+            raise PipelineError("Pipeline could not be saved")
         result = {
             'status': 'success'
         }
         return result
+    
+    def arun(self, *args, **kwargs):
+        """
+        Run the pipeline from a coroutine, for example ``await pipeline.arun()``.
+        This takes the same parameters as `Pipeline.run`.
+        
+        The pipeline is run in a separate thread so that the event loop is not blocked,
+        while coroutine step functions and `datapyp.aio.AsyncStep` steps are run in the
+        event loop that called ``arun``.
+        """
+        from datapyp.aio import arun_pipeline
+        return arun_pipeline(self, *args, **kwargs)
+    
+    def _run_dag(self, dag, options, resume=False):
+        """
+        Run the steps in ``run_steps`` with a `datapyp.scheduler.DagScheduler`
+        """
+        # Steps before run_step_idx have all finished
+        completed = set(range(self.run_step_idx))
+        if resume:
+            completed.update(self.completed_steps)
+        self.completed_steps = completed
+        checkpointer = self._checkpointer
+        
+        def execute(step_idx):
+            step = self.run_steps[step_idx]
+            # Steps that did not finish in the previous run might have been interrupted
+            self._execute_step(step, step_idx, resume=resume, **options)
+        
+        def on_start(step_idx):
+            if checkpointer is not None:
+                checkpointer.step_started(self.run_steps[step_idx])
+        
+        def on_finish(step_idx):
+            with self._lock:
+                self.completed_steps.add(step_idx)
+                while self.run_step_idx in self.completed_steps:
+                    self.run_step_idx += 1
+            if checkpointer is not None:
+                checkpointer.step_finished(self.run_steps[step_idx], step_idx)
+        
+        dag.run(execute, completed, on_start, on_finish)
 
 class PipelineStep:
     """
     A single step in the pipeline. This takes a function and a set of tags and kwargs
     associated with it and stores them in the pipeline.
+    
+    Steps use ``__slots__`` to keep pipelines with a large number of steps small,
+    so attributes other than the parameters below cannot be added to a step.
+    For millions of similar steps use a `datapyp.table.StepTable`.
     """
+    __slots__ = ('func', '_tags', 'step_id', 'ignore_errors', 'ignore_exceptions',
+        'func_kwargs', 'results', 'finalizer', 'cache', 'inputs', 'outputs',
+        'input_hashes', 'depends_on', 'executor', 'timeout', 'retry', 'idempotent')
+    _step_type = 'PipelineStep'
+    
     def __init__(self, func, step_id=None, tags=[], ignore_errors=False, ignore_exceptions=False, 
-            func_kwargs={}, finalizer=None):
+            func_kwargs={}, finalizer=None, cache=False, inputs=None, outputs=None,
+            depends_on=None, executor=None, timeout=None, retry=None, idempotent=False):
         """
         Initialize a PipelineStep object
         
@@ -455,6 +1634,8 @@ class PipelineStep:
         func: function
             The function to be run. All functions must return a dictionary with at a 
             minimum a ``status`` key whose value is either ``success`` or ``error``.
+            If ``func`` is a coroutine function (``async def``) it is run in an
+            event loop (see `Pipeline.arun`).
         step_id: str
             Unique identifier for the step
         tags: list (optional)
@@ -478,8 +1659,56 @@ class PipelineStep:
                 There are a few protected keywords:
                     - ``global_vars``: global variables for all steps in the pipeline
                     - ``pipeline``: the entire pipeline is passed to the function
+        finalizer: func (optional)
+            Function to run after the step has finished
+        cache: bool (optional)
+            Whether or not to save the results of the step in the pipeline's step cache
+            and reuse them when the step is run again with the same function and
+            keyword arguments. Functions that use ``global_vars`` or ``pipeline``
+            are never cached. The default is ``False``.
+        inputs: list (optional)
+            Files read by the step
+        outputs: list (optional)
+            Files created by the step. If the pipeline is run with ``freshness`` set
+            and all of the outputs are newer than the inputs, the step is skipped.
+        depends_on: list (optional)
+            ``step_id`` of each step that must finish before this step is run when the
+            pipeline is run with ``scheduler=='dag'``. A step also depends on any
+            earlier step whose ``outputs`` include one of its ``inputs``.
+        executor: str (optional)
+            Name of an executor (see `datapyp.executors.create_executor`) used to run
+            the step, for example ``'process'`` to run it in a separate process.
+            Unless the executor runs in the pipeline's process the function and its
+            keyword arguments are pickled, so changes it makes to ``global_vars``
+            are lost. The default is ``None``, which runs the step directly in the
+            pipeline's thread.
+        timeout: float (optional)
+            Maximum number of seconds the step is allowed to run. A step that runs
+            longer is stopped and its result is ``{'status': 'timeout'}``, and unless
+            ``ignore_errors==True`` a `StepTimeout` is raised. Only workers of a
+            ``'process'`` executor (or ``'spawn'``/``'forkserver'``) can be stopped:
+            the worker is killed along with any processes it started. Other executors
+            stop waiting for the step but leave it running. A step in a `Pipeline`
+            with a ``timeout`` must have an ``executor``, since a step run in the
+            pipeline's thread cannot be stopped.
+            The default is ``None``, which lets the step run as long as it needs.
+        retry: `datapyp.retry.RetryPolicy`, int or dict (optional)
+            Policy used to run the step again if it raises an exception (or times
+            out, if ``retry_on`` includes `StepTimeout`), which can also be given as
+            the maximum number of attempts or a dictionary of parameters for
+            `datapyp.retry.RetryPolicy`. A step that raises an exception is retried in
+            the same worker, while a step that times out is sent to the pool again.
+            The number of attempts (``attempts``) and the number of seconds each
+            attempt took (``attempt_durations``) are saved in its results.
+            Only exceptions that are still raised after the last attempt are
+            handled using ``ignore_exceptions``. The default is ``None``, which never
+            retries the step.
+        idempotent: bool (optional)
+            Whether or not running the step more than once (or stopping it part way
+            through and running it again) gives the same result. Only idempotent steps
+            in a `MultiprocessStep` with ``speculative`` set are copied when they run
+            slowly. The default is ``False``.
         """
-        self._step_type = 'PipelineStep'
         self.func = func
         self.tags = tags
         self.step_id = step_id
@@ -488,6 +1717,85 @@ class PipelineStep:
         self.func_kwargs = func_kwargs
         self.results = None
         self.finalizer=finalizer
+        self.cache = cache
+        # Steps without any files or dependencies share an empty tuple
+        self.inputs = list(inputs) if inputs else ()
+        self.outputs = list(outputs) if outputs else ()
+        self.input_hashes = None
+        self.depends_on = list(depends_on) if depends_on else ()
+        self.executor = executor
+        self.timeout = timeout
+        self.retry = None if retry is None else get_retry_policy(retry)
+        self.idempotent = idempotent
+    
+    tags = property(get_step_tags, set_step_tags, doc="""
+        Tags of the step, stored in a `datapyp.tags.TagList` that updates the tag
+        index of each container with the step when the tags change
+        """)
+    
+    def __reduce__(self):
+        # Steps are pickled as a tuple of their attributes with the tags as a plain
+        # list. The optional attributes are left out if they all have their defaults.
+        attrs = (self.func, list(self._tags))+_get_required_attrs(self)
+        optional = _get_optional_attrs(self)
+        if optional!=_OPTIONAL_DEFAULTS:
+            attrs += optional
+        if self.__class__ is PipelineStep:
+            return (_load_step, (PipelineStep, attrs))
+        # Subclasses can also have a __dict__ or slots of their own
+        state = dict(getattr(self, '__dict__', {}))
+        for cls in self.__class__.__mro__:
+            if cls is PipelineStep:
+                break
+            slots = cls.__dict__.get('__slots__', ())
+            if isinstance(slots, str):
+                slots = [slots]
+            for name in slots:
+                if name not in ['__dict__', '__weakref__'] and hasattr(self, name):
+                    state[name] = getattr(self, name)
+        return (_load_step, (self.__class__, attrs, state))
+    
+    def __setstate__(self, state):
+        # Steps saved before __slots__ was used are pickled as a dict, which also
+        # contains _step_type
+        for name in self.__slots__:
+            setattr(self, name, state.get(name))
+        self.tags = state.get('tags')
+        for name in ['inputs', 'outputs', 'depends_on']:
+            if not getattr(self, name):
+                setattr(self, name, ())
+        for name in ['ignore_errors', 'ignore_exceptions', 'cache', 'idempotent']:
+            if getattr(self, name) is None:
+                setattr(self, name, False)
+
+# Attributes that are always pickled (after the function and tags), and the optional
+# attributes that are left out when a step is pickled if they have their defaults
+_get_required_attrs = operator.attrgetter('step_id', 'ignore_errors', 'ignore_exceptions',
+    'func_kwargs', 'results')
+_get_optional_attrs = operator.attrgetter('finalizer', 'cache', 'inputs', 'outputs',
+    'input_hashes', 'depends_on', 'executor', 'timeout', 'retry', 'idempotent')
+_OPTIONAL_DEFAULTS = (None, False, (), (), None, (), None, None, None, False)
+
+def _load_step(cls, attrs, state=None):
+    """
+    Rebuild a `PipelineStep` that was pickled, where ``attrs`` are the values of
+    ``PipelineStep.__slots__`` (without the optional attributes if they have their
+    default values) and ``state`` has any other attributes of a subclass
+    """
+    step = cls.__new__(cls)
+    if len(attrs)<len(PipelineStep.__slots__):
+        attrs += _OPTIONAL_DEFAULTS
+    # Assigning the attributes directly is much faster than calling setattr
+    (step.func, tags, step.step_id, step.ignore_errors, step.ignore_exceptions,
+        step.func_kwargs, step.results, step.finalizer, step.cache, step.inputs,
+        step.outputs, step.input_hashes, step.depends_on, step.executor, step.timeout,
+        step.retry, step.idempotent) = attrs
+    # Tags are saved as a list (or as a TagList by older versions)
+    step._tags = TagList(tags)
+    if state is not None:
+        for name, value in state.items():
+            setattr(step, name, value)
+    return step
 
 class MultiprocessStep(StepContainer):
     """
@@ -500,7 +1808,10 @@ class MultiprocessStep(StepContainer):
         Keep this in mind when creating functions for MultiprocessSteps.
     """
     def __init__(self, step_id=None, tags=list(), steps=list(), pool_size=None, 
-            initializer=None, finalizer=None, next_id=0):
+            initializer=None, finalizer=None, next_id=0, error_policy='continue',
+            chunksize=1, reducers=None, depends_on=None, executor=None, timeout=None,
+            retry=None, dispatch_order='list', speculative=None, idempotent=False,
+            batch_funcs=None, batch_size=100):
         """
         Initialize a MultiprocessStep
         
@@ -515,19 +1826,106 @@ class MultiprocessStep(StepContainer):
         steps: list-like (optional)
             A list of steps to be run concurrently. Each element of the list should be a
             :class:`.PipelineStep` or a dictionary of parameters used for each step.
-            If no steps are specified they can be added later by the user
+            If no steps are specified they can be added later by the user.
+            A `datapyp.table.StepTable` can be used instead of a list to store
+            a large number of similar steps in less memory.
         pool_size: int (optional)
             Number of concurrent processors to use
         initializer: func (optional)
-            Function to run to when pools are initialized
+            Function to run in each worker before it runs its first step from this
+            `MultiprocessStep`
         finalizer: func (optional)
             Function to run when the pools have finished
+        error_policy: str (optional)
+            What to do when one of the steps raises an exception (including a
+            `PipelineError` for a step that returned an error and does not ignore errors).
+            If ``error_policy=='continue'`` (the default) the remaining steps are run
+            before the exception is raised. If ``error_policy=='fail_fast'`` the steps
+            that have not started are cancelled and the running workers are terminated,
+            then the exception is raised immediately.
+        chunksize: int or str (optional)
+            Number of steps sent to a worker in a single task. Larger values reduce the
+            overhead of sending steps to the workers when there are a large number of
+            fast steps. If ``chunksize=='auto'`` the number of steps in each task is
+            chosen using the time taken by the steps that have already finished.
+            The default is ``1``.
+        reducers: dict (optional)
+            Reducers used to combine updates to the pipeline's global variables made by
+            the steps. A step updates the globals by returning a ``global_updates``
+            dictionary in its result, and each value is combined with the current value
+            of the variable (in the order the steps finish) using the reducer for that
+            variable. A reducer is either a function ``reducer(current, value)`` or
+            one of ``'sum'``, ``'concat'``, ``'min'``, ``'max'`` or ``'replace'``.
+        depends_on: list (optional)
+            ``step_id`` of each step that must finish before this step is run when the
+            pipeline is run with ``scheduler=='dag'``
+        executor: str (optional)
+            Name of the executor used to run the steps (see
+            `datapyp.executors.create_executor`). The default is the pipeline's
+            ``executor``.
+        timeout: float (optional)
+            Maximum number of seconds each step is allowed to run, used for steps
+            that do not have their own ``timeout`` (see `PipelineStep`). A step that
+            times out is sent to a worker on its own, regardless of ``chunksize``.
+        retry: `datapyp.retry.RetryPolicy`, int or dict (optional)
+            Retry policy used for steps that do not have their own ``retry``
+            (see `PipelineStep`)
+        dispatch_order: str (optional)
+            Order the steps are sent to the workers. If ``dispatch_order=='list'``
+            (the default) the steps are run in the order of ``steps``. If
+            ``dispatch_order=='longest_first'`` the steps that are expected to take the
+            longest, based on the durations of previous steps using the same function
+            with input files of a similar size (see ``runtime_history`` in
+            `Pipeline.run`), are run first. Steps whose function has never been run
+            go first. Since idle workers take the next step as soon as they finish,
+            this keeps a few long steps at the end of the list from running alone
+            while the other workers are idle.
+        speculative: float or bool (optional)
+            If ``speculative`` is set, once all of the steps have been sent to the
+            workers and a worker is idle, a copy of any idempotent step that has been
+            running more than ``speculative`` times as long as the median step (``2``
+            if ``speculative==True``) is started on another worker. The result of the
+            copy that finishes first is used and the worker running the other copy is
+            killed if the executor supports it (otherwise its result is ignored).
+            The default is ``None``, which never copies a step.
+        idempotent: bool (optional)
+            Whether or not all of the steps can safely be run more than once (see
+            `PipelineStep`). The default is ``False``, which only copies the steps
+            that are ``idempotent`` themselves.
+        batch_funcs: dict (optional)
+            Batched versions of the step functions, with the step functions as keys.
+            Steps that use one of the functions are run in groups of up to
+            ``batch_size`` steps with a single call to the batched version, which
+            receives a list with the value of each keyword for every step in the group
+            (``global_vars`` and ``pipeline`` are only passed once). The batched
+            function returns either a list with the result of each step or a
+            dictionary with a list of values for each key, where ``status`` can be a
+            single status for all of the steps. If the batched function raises an
+            exception the steps in the group are run separately. Steps with a
+            ``timeout`` are always run separately. Batches are not used by an
+            `datapyp.aio.AsyncStep`.
+        batch_size: int (optional)
+            Maximum number of steps in a batch. The default is ``100``.
         """
         import multiprocessing
+        from datapyp.history import DISPATCH_ORDERS
+        if error_policy not in ERROR_POLICIES:
+            raise PipelineError("error_policy must be one of {0}, received {1}".format(
+                ERROR_POLICIES, error_policy))
+        if dispatch_order not in DISPATCH_ORDERS:
+            raise PipelineError("dispatch_order must be one of {0}, received {1}".format(
+                DISPATCH_ORDERS, dispatch_order))
+        if batch_size<1:
+            raise PipelineError('batch_size must be at least 1, received {0}'.format(
+                batch_size))
         self._step_type = 'MultiprocessStep'
         self.step_id = step_id
         self.tags = tags
         self.next_id = next_id
+        self.depends_on = list(depends_on) if depends_on is not None else []
+        self.executor = executor
+        self.timeout = timeout
+        self.retry = get_retry_policy(retry)
         
         # Set the number of processors to use
         if pool_size is None:
@@ -538,19 +1936,105 @@ class MultiprocessStep(StepContainer):
         # Set the initialization function
         self.initializer = initializer
         self.finalizer = finalizer
-        self.steps = []
-        # Check whether each step is a PipelineStep or a dict-like object
-        for step in steps:
-            if isinstance(step, PipelineStep):
-                self.steps.append(step)
-            else:
-                self.steps.append(PipelineStep(**step))
+        self.error_policy = error_policy
+        self.chunksize = chunksize
+        self.dispatch_order = dispatch_order
+        self.speculative = speculative
+        self.idempotent = idempotent
+        self.batch_funcs = batch_funcs
+        self.batch_size = batch_size
+        if reducers is None:
+            reducers = {}
+        else:
+            from datapyp.reducers import get_reducer
+            for reducer in reducers.values():
+                get_reducer(reducer)
+        self.reducers = reducers
+        # Number of completed steps and estimated time remaining while the step is running
+        self.progress = None
+        from datapyp.table import StepTable
+        if isinstance(steps, StepTable):
+            self.steps = steps
+        else:
+            self.steps = []
+            # Check whether each step is a PipelineStep or a dict-like object
+            for step in steps:
+                if isinstance(step, PipelineStep):
+                    self.steps.append(step)
+                else:
+                    self.steps.append(PipelineStep(**step))
+    
+    @classmethod
+    def from_columns(cls, func, columns, func_kwargs=None, step_params=None, dtypes=None,
+            **kwargs):
+        """
+        Create a step that runs ``func`` once for each row of a table of parameters.
+        The parameters are stored in a `datapyp.table.StepTable`, so no object is
+        created for each step until it is dispatched, and the results are saved in
+        columns (see `datapyp.table.StepTable.get_results_columns`).
+        
+        Parameters
+        ----------
+        func: function
+            Function run by each step
+        columns: dict, array or str
+            Keyword arguments that are different for each step, as a dictionary of
+            lists (or arrays), a NumPy structured array or the name of a CSV file
+            (see `datapyp.table.load_columns`)
+        func_kwargs: dict (optional)
+            Keyword arguments passed to every step
+        step_params: dict (optional)
+            Other `PipelineStep` parameters (for example ``ignore_errors`` or
+            ``outputs``) used by every step
+        dtypes: dict (optional)
+            Type of each column of a CSV file that is not passed as a string, for
+            example ``{'x': float}`` (see `datapyp.table.read_csv_columns`)
+        kwargs: dict
+            Keyword arguments used to initialize the `MultiprocessStep`
+        """
+        from datapyp.table import StepTable, load_columns
+        if step_params is None:
+            step_params = {}
+        table = StepTable(func, func_kwargs, load_columns(columns, dtypes), **step_params)
+        return cls(steps=table, **kwargs)
+    
+    tags = property(get_step_tags, set_step_tags, doc=PipelineStep.tags.__doc__)
     
     def get_next_id(self):
         new_id = str(self.step_id)+'-'+str(self.next_id)
         self.next_id += 1
         return new_id
 
+class ThreadedStep(MultiprocessStep):
+    """
+    A collection of steps to be run concurrently in a pool of threads.
+    
+    This is useful for steps that spend most of their time reading or writing files,
+    or in functions that release the GIL (such as many NumPy routines). The steps are
+    run in the same process as the pipeline, so nothing is pickled: functions can be
+    lambdas or closures and steps receive the pipeline's own `PipelineGlobals` (and
+    the `Pipeline` itself if they take a ``pipeline`` argument).
+    
+    The parameters are the same as `MultiprocessStep`, where ``pool_size`` is the
+    number of threads and the ``initializer`` is run once in each thread. This is the
+    same as a `MultiprocessStep` with ``executor='thread'``.
+    
+    .. warning::
+    
+        Changes made directly to ``global_vars`` by the steps are not synchronized.
+        Return ``global_updates`` with a reducer to combine results from
+        several steps safely.
+    
+    With ``error_policy=='fail_fast'`` the steps that have not started are cancelled,
+    but steps that are already running cannot be interrupted and finish in
+    the background.
+    """
+    def __init__(self, *args, **kwargs):
+        MultiprocessStep.__init__(self, *args, **kwargs)
+        self._step_type = 'ThreadedStep'
+        if self.executor is None:
+            self.executor = 'thread'
+
 class PipelineGlobals:
     """
     Global variables for a pipeline. These are variables that can be modified by each step
@@ -561,9 +2045,26 @@ class PipelineGlobals:
         PipelineGlobals is passed to each step in the pipeline. Since multiple functions
         will be running copies of the same variable in separate processes, any changes
         made to a pipeline global variable in any one of these steps will *not* be
-        saved in the pipeline. In other words, a PipelineGlobals variable can be 
-        loaded but not changed by a MultiprocessStep.
+        saved in the pipeline. Instead a step can return a ``global_updates``
+        dictionary in its result, which is combined with the pipeline's global variables
+        using the ``reducers`` of the `.MultiprocessStep`.
+    
+    Large NumPy arrays are not copied to each step in a `.MultiprocessStep`. Instead
+    they are placed in shared memory (or a memory-mapped file in the pipeline's
+    ``temp`` path) and each worker receives a read-only view of the array.
     """
     def __init__(self, **kwargs):
-        for k,v in kwargs:
-            setattr(self,k,v)
\ No newline at end of file
+        for k,v in kwargs.items():
+            setattr(self,k,v)
+    
+    def __setstate__(self, state):
+        # Attach to any arrays that were placed in shared memory
+        from datapyp.shared import SharedArray, detach_all
+        shared = [k for k,v in state.items() if isinstance(v, SharedArray)]
+        if len(shared)>0:
+            names = [state[k].name for k in shared]
+            for k in shared:
+                state[k] = state[k].attach()
+            # Release arrays shared by previous steps
+            detach_all(keep=names)
+        self.__dict__.update(state)
\ No newline at end of file
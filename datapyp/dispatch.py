@@ -0,0 +1,541 @@
+# Copyright 2015 Fred Moolekamp
+# BSD 3-clause license
+"""
+Dispatch the steps in a `.MultiprocessStep` to a pool of workers and collect their
+results as they finish
+"""
+import time
+import heapq
+import logging
+import itertools
+
+logger = logging.getLogger('datapyp.dispatch')
+
+# Tokens that identify the batches with a timeout (or that might be copied) in the
+# workers, unique within the pipeline's process
+_tokens = itertools.count(1)
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+class Progress:
+    """
+    Keep track of the number of tasks that have finished and estimate the time
+    remaining
+    """
+    # Minimum number of seconds between progress messages
+    log_interval = 10
+
+    def __init__(self, name, total):
+        """
+        Parameters
+        ----------
+        name: str
+            Name displayed in progress messages
+        total: int
+            Total number of tasks
+        """
+        self.name = name
+        self.total = total
+        self.completed = 0
+        self.start_time = time.time()
+        self._last_log = self.start_time
+
+    def update(self, n=1):
+        """
+        Record that ``n`` more tasks have finished
+        """
+        self.completed += n
+        now = time.time()
+        if now-self._last_log>self.log_interval or self.completed==self.total:
+            self._last_log = now
+            logger.info('{0}: {1}/{2} complete, {3:.0f}s remaining'.format(
+                self.name, self.completed, self.total, self.get_eta()))
+
+    def get_eta(self):
+        """
+        Estimated number of seconds until all of the tasks are finished
+        """
+        if self.completed==0:
+            return float('nan')
+        elapsed = time.time()-self.start_time
+        return elapsed/self.completed*(self.total-self.completed)
+
+    def get_state(self):
+        """
+        Dictionary with the number of completed tasks, total tasks and ETA
+        """
+        return {
+            'completed': self.completed,
+            'total': self.total,
+            'eta': self.get_eta()
+        }
+
+class LazyTasks:
+    """
+    Sequence of ``(key, args)`` tasks where the ``args`` of each task are only built
+    when the task is dispatched, so that a large number of tasks does not need to be
+    kept in memory at once. Tasks that are retried are appended to the end.
+    """
+    def __init__(self, keys, build):
+        """
+        Parameters
+        ----------
+        keys: list-like
+            Key of each task, in the order they are dispatched
+        build: function
+            Function that builds the ``args`` of a task from its key
+        """
+        self.keys = keys
+        self.build = build
+        self.extra = []
+
+    def __len__(self):
+        return len(self.keys)+len(self.extra)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[n] for n in range(*idx.indices(len(self)))]
+        if idx<0:
+            idx += len(self)
+        if idx>=len(self.keys):
+            return self.extra[idx-len(self.keys)]
+        key = self.keys[idx]
+        return (key, self.build(key))
+
+    def __iter__(self):
+        for key in self.keys:
+            yield (key, self.build(key))
+        for task in self.extra:
+            yield task
+
+    def append(self, task):
+        self.extra.append(task)
+
+    def copy(self):
+        return LazyTasks(self.keys, self.build)
+
+def get_task_keys(tasks):
+    """
+    Keys of a list of ``(key, args)`` tasks (or `LazyTasks`) without building
+    their ``args``
+    """
+    if isinstance(tasks, LazyTasks):
+        return list(tasks.keys)+[key for key, args in tasks.extra]
+    return [key for key, args in tasks]
+
+class TaskDispatcher:
+    """
+    Submit tasks to an executor, keeping at most ``max_active`` batches of tasks running
+    at once, and yield the results in the order they finish.
+
+    Tasks are sent to the workers in batches of ``chunksize`` tasks, which reduces the
+    communication overhead when there are many short tasks. If ``chunksize=='auto'``
+    the size of each batch is chosen so that a batch takes roughly ``chunk_time``
+    seconds to run, based on the durations of the tasks that have already finished,
+    while leaving enough batches for all of the workers at the end of the run.
+
+    Tasks with a timeout are always sent in a batch of their own. When a task runs
+    longer than its timeout the worker running it is killed if the executor supports
+    it (see `datapyp.executors.ProcessExecutor.kill`), otherwise the dispatcher stops
+    waiting for the task and leaves it running.
+
+    If ``speculative`` is set, once every task has been submitted and a worker is idle,
+    a copy of any batch of tasks that are safe to run twice (see ``speculate`` in
+    `imap_unordered`) that has been running more than ``speculative`` times the median
+    duration of the finished tasks is submitted. The result of whichever copy finishes
+    first is used and the other copy is stopped in the same way as a task that
+    timed out.
+    """
+    # Target number of seconds for each batch when chunksize is 'auto'
+    chunk_time = 0.5
+    # Number of seconds to wait for a result before checking whether the
+    # executor's workers were terminated
+    poll_interval = 1
+    # Number of seconds to wait for a result while tasks with a timeout are running
+    timeout_interval = 0.1
+
+    def __init__(self, executor, func, initializer=None, max_active=None, chunksize=1,
+            speculative=None):
+        """
+        Parameters
+        ----------
+        executor: `datapyp.executors.ProcessExecutor`
+            Executor used to run the tasks
+        func: function
+            Function run for each task
+        initializer: function (optional)
+            Function run once in each worker before its first task
+        max_active: int (optional)
+            Maximum number of batches submitted to the executor at the same time.
+            The default is to submit all of the tasks at once.
+        chunksize: int or str (optional)
+            Number of tasks sent to a worker at once, or ``'auto'`` to choose the
+            number of tasks based on how long each task takes. The default is ``1``.
+        speculative: float (optional)
+            Number of times longer than the median task a batch must run before a
+            copy of it is submitted. The default is ``None``, which never runs
+            copies of the tasks.
+        """
+        from datapyp.executors import get_worker_initializer
+        self.executor = executor
+        self.func = func
+        # The key of the initializer is only computed once for every task
+        self.initializer = get_worker_initializer(initializer)
+        self.max_active = max_active
+        self.chunksize = chunksize
+        self.speculative = speculative
+        self.active = {}
+        self.completed = 0
+        self.total_duration = 0
+        # Number of seconds each task took to run, with the task keys as keys
+        self.durations = {}
+        self._results = queue.Queue()
+        self._next_batch = 0
+        # Token, timeout and submission time of each batch with a timeout or that
+        # might be copied
+        self.timed = {}
+        # Batch id of the copy of each batch that was run speculatively (and of the
+        # original batch for each copy)
+        self.copies = {}
+        self.speculated = 0
+        # Tasks waiting to be run again, ordered by the time they can be submitted
+        self._delayed = []
+        self._next_retry = 0
+
+    def get_chunksize(self, remaining=None):
+        """
+        Number of tasks to send in the next batch
+
+        Parameters
+        ----------
+        remaining: int (optional)
+            Number of tasks that have not been submitted yet
+        """
+        if self.chunksize!='auto':
+            return self.chunksize
+        if self.completed==0:
+            return 1
+        mean_duration = self.total_duration/self.completed
+        chunksize = int(self.chunk_time/max(mean_duration, 1e-6))
+        # Make smaller batches near the end so that workers are not left idle
+        if remaining is not None and self.max_active is not None:
+            chunksize = min(chunksize, remaining//(2*self.max_active))
+        return max(chunksize, 1)
+
+    def submit(self, batch, timeout=None, track=False):
+        """
+        Submit a batch of tasks to the executor
+
+        Parameters
+        ----------
+        batch: list
+            ``(key, args)`` for each task in the batch
+        timeout: float (optional)
+            Maximum number of seconds the batch is allowed to run
+        track: bool (optional)
+            Whether or not to keep track of when the batch starts, even if it does
+            not have a timeout
+
+        Returns
+        -------
+        batch_id: int
+            Id of the batch
+        """
+        from datapyp.executors import run_batch
+        results = self._results
+        batch_id = self._next_batch
+        self._next_batch += 1
+        keys = [key for key, args in batch]
+        def callback(values):
+            results.put((batch_id, keys, values))
+        def error_callback(error):
+            results.put((batch_id, keys, [(False, error, None)]*len(keys)))
+        params = (self.func, [args for key, args in batch])
+        if timeout is not None or track:
+            token = next(_tokens)
+            self.timed[batch_id] = (token, timeout, time.time())
+            params = params+(token,)
+        self.active[batch_id] = (getattr(self.executor, 'generation', 0), batch)
+        self.executor.submit(run_batch, params, callback, error_callback, self.initializer)
+        return batch_id
+
+    def resubmit_lost(self):
+        """
+        If the executor's workers were terminated (for example by another step sharing
+        the executor) resubmit the batches that were running on the old workers
+        """
+        generation = getattr(self.executor, 'generation', 0)
+        lost = [batch_id for batch_id, (gen, batch) in self.active.items()
+            if gen!=generation]
+        for batch_id in lost:
+            if batch_id not in self.active:
+                # The other copy of the batch was already resubmitted
+                continue
+            gen, batch = self.active.pop(batch_id)
+            tracked = batch_id in self.timed
+            timeout = self._pop_timed(batch_id)
+            copy_id = self.copies.pop(batch_id, None)
+            if copy_id is not None:
+                self.copies.pop(copy_id, None)
+                if copy_id not in lost:
+                    # The other copy is still running
+                    continue
+                self.active.pop(copy_id, None)
+                self._pop_timed(copy_id)
+            logger.info('resubmitting {0} tasks'.format(len(batch)))
+            self.submit(batch, timeout, tracked)
+
+    def _pop_timed(self, batch_id):
+        """
+        Stop tracking the time of a batch and return its timeout
+        """
+        if batch_id not in self.timed:
+            return None
+        token, timeout, submitted = self.timed.pop(batch_id)
+        started = getattr(self.executor, 'started', None)
+        if started is not None:
+            started.pop(token, None)
+        return timeout
+
+    def _get_start(self, batch_id):
+        """
+        Process id and start time of a tracked batch. If the executor cannot tell
+        when the batch started the process id is ``None`` and the submission time is
+        used, which includes the time spent waiting for a worker. If the batch is still
+        waiting for a worker ``None`` is returned.
+        """
+        token, timeout, submitted = self.timed[batch_id]
+        started = getattr(self.executor, 'started', None)
+        if started is None:
+            return None, submitted
+        return started.get(token)
+
+    def stop(self, batch_id):
+        """
+        Stop waiting for a batch and kill the worker running it (if the executor
+        supports it). The worker is only killed if it is still running the batch.
+
+        Returns
+        -------
+        killed: bool
+            Whether or not the worker was killed. If the batch finished before its
+            worker could be killed ``None`` is returned and the batch is still
+            active, so that its result is used.
+        """
+        token, start = None, None
+        if batch_id in self.timed:
+            token = self.timed[batch_id][0]
+            start = self._get_start(batch_id)
+        killed = False
+        if start is not None and start[0] is not None and hasattr(self.executor, 'kill'):
+            if not self.executor.kill(start[0], token):
+                return None
+            killed = True
+        self.active.pop(batch_id, None)
+        self._pop_timed(batch_id)
+        return killed
+
+    def speculate(self, eligible):
+        """
+        Submit copies of the batches that are running much longer than the median task,
+        while there are idle workers
+
+        Parameters
+        ----------
+        eligible: set
+            Keys of the tasks that can safely be run twice
+        """
+        if len(self.durations)==0:
+            return
+        durations = sorted(self.durations.values())
+        median = durations[len(durations)//2]
+        now = time.time()
+        for batch_id in list(self.timed.keys()):
+            if self.max_active is not None and len(self.active)>=self.max_active:
+                break
+            if batch_id in self.copies:
+                continue
+            gen, batch = self.active[batch_id]
+            if not all([key in eligible for key, args in batch]):
+                continue
+            start = self._get_start(batch_id)
+            if start is None or now-start[1]<=self.speculative*median*len(batch):
+                continue
+            logger.info('tasks {0} are running slowly, starting a copy'.format(
+                [key for key, args in batch]))
+            copy_id = self.submit(batch, self.timed[batch_id][1], True)
+            self.copies[batch_id] = copy_id
+            self.copies[copy_id] = batch_id
+            self.speculated += 1
+
+    def pop_expired(self):
+        """
+        Stop all of the batches that have run longer than their timeout
+
+        Returns
+        -------
+        results: list
+            ``(key, False, error)`` for each task that timed out, where ``error`` is a
+            `datapyp.core.StepTimeout`
+        """
+        from datapyp.core import StepTimeout
+        import warnings
+        now = time.time()
+        results = []
+        for batch_id, (token, timeout, submitted) in list(self.timed.items()):
+            if timeout is None or batch_id not in self.timed:
+                continue
+            start = self._get_start(batch_id)
+            if start is None or now-start[1]<timeout:
+                continue
+            gen, batch = self.active[batch_id]
+            killed = self.stop(batch_id)
+            if killed is None:
+                # The result of the batch is on its way
+                continue
+            copy_id = self.copies.pop(batch_id, None)
+            if copy_id is not None:
+                # Wait for the other copy of the batch
+                self.copies.pop(copy_id, None)
+                continue
+            if not killed:
+                warnings.warn('A task ran longer than its timeout of {0}s but it cannot '
+                    'be stopped by a {1}, so it was left running'.format(
+                        timeout, type(self.executor).__name__))
+            for key, args in batch:
+                results.append((key, False, StepTimeout(
+                    'Task {0} timed out after {1}s'.format(key, timeout))))
+        return results
+
+    def retry(self, key, args, delay=0):
+        """
+        Run a task again after it failed. This can be called while iterating over
+        the results of `imap_unordered`.
+
+        Parameters
+        ----------
+        key: object
+            Key that identifies the task
+        args: object
+            Parameters passed to ``func``
+        delay: float (optional)
+            Number of seconds to wait before the task is submitted
+        """
+        heapq.heappush(self._delayed, (time.time()+delay, self._next_retry, key, args))
+        self._next_retry += 1
+
+    def cancel(self):
+        """
+        Stop all of the tasks that are running by terminating the executor's workers.
+        Tasks that have not been submitted are never run.
+        """
+        logger.info('cancelling {0} running batches'.format(len(self.active)))
+        self.executor.terminate()
+        self.active = {}
+        self.copies = {}
+        self._delayed = []
+        for batch_id in list(self.timed.keys()):
+            self._pop_timed(batch_id)
+
+    def imap_unordered(self, tasks, timeouts=None, speculate=None):
+        """
+        Run a set of tasks
+
+        Parameters
+        ----------
+        tasks: list
+            Each task is a ``(key, args)`` tuple, where ``key`` identifies the task
+            and ``args`` is passed to ``func``. If ``tasks`` is a `LazyTasks` the
+            ``args`` are built as the tasks are dispatched.
+        timeouts: dict (optional)
+            Maximum number of seconds each task is allowed to run, with the task keys
+            as keys. Tasks that are not in ``timeouts`` can run as long as they need.
+        speculate: set (optional)
+            Keys of the tasks that can safely be run more than once (if the
+            dispatcher is ``speculative``)
+
+        Returns
+        -------
+        results: generator
+            Each result is a ``(key, success, value)`` tuple, where ``value`` is the
+            value returned by ``func`` if ``success==True``, otherwise it is the
+            exception raised by ``func``.
+        """
+        if timeouts is None:
+            timeouts = {}
+        if speculate is None or self.speculative is None:
+            speculate = set()
+        if isinstance(tasks, LazyTasks):
+            tasks = tasks.copy()
+        else:
+            tasks = list(tasks)
+        next_task = 0
+        while True:
+            now = time.time()
+            while len(self._delayed)>0 and self._delayed[0][0]<=now:
+                ready, n, key, args = heapq.heappop(self._delayed)
+                tasks.append((key, args))
+            while next_task<len(tasks) and (
+                    self.max_active is None or len(self.active)<self.max_active):
+                batch = [tasks[next_task]]
+                timeout = timeouts.get(batch[0][0])
+                if timeout is None:
+                    chunksize = self.get_chunksize(len(tasks)-next_task)
+                    while len(batch)<chunksize and next_task+len(batch)<len(tasks):
+                        key, args = tasks[next_task+len(batch)]
+                        if timeouts.get(key) is not None:
+                            break
+                        batch.append((key, args))
+                next_task += len(batch)
+                self.submit(batch, timeout,
+                    all([key in speculate for key, args in batch]))
+            if len(self.timed)>0:
+                for result in self.pop_expired():
+                    yield result
+                if len(speculate)>0 and next_task==len(tasks) and len(self._delayed)==0:
+                    self.speculate(speculate)
+            if len(self.active)==0:
+                if next_task<len(tasks):
+                    continue
+                if len(self._delayed)>0:
+                    time.sleep(max(self._delayed[0][0]-time.time(), 0))
+                    continue
+                break
+            if len(self.timed)>0:
+                wait = self.timeout_interval
+            else:
+                wait = self.poll_interval
+            if len(self._delayed)>0:
+                wait = min(wait, max(self._delayed[0][0]-time.time(), 0.01))
+            try:
+                batch_id, keys, values = self._results.get(timeout=wait)
+            except queue.Empty:
+                self.resubmit_lost()
+                continue
+            if batch_id not in self.active:
+                # The batch was cancelled, timed out or another copy finished first
+                continue
+            copy_id = self.copies.pop(batch_id, None)
+            if copy_id is not None:
+                self.copies.pop(copy_id, None)
+                if not all([value[0] for value in values]):
+                    # Use the result of the other copy, which might succeed
+                    self.active.pop(batch_id)
+                    self._pop_timed(batch_id)
+                    continue
+                logger.info('stopping the slower copy of tasks {0}'.format(keys))
+                self.stop(copy_id)
+                # Ignore the result of the other copy if it has already finished
+                self.active.pop(copy_id, None)
+                self._pop_timed(copy_id)
+            del self.active[batch_id]
+            self._pop_timed(batch_id)
+            for key, (success, value, duration) in zip(keys, values):
+                if duration is not None:
+                    self.completed += 1
+                    self.total_duration += duration
+                    self.durations[key] = duration
+                yield key, success, value
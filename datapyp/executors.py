@@ -0,0 +1,950 @@
+# Copyright 2015 Fred Moolekamp
+# BSD 3-clause license
+"""
+Pools of workers used to run the steps in a `.MultiprocessStep` or `.ThreadedStep`.
+
+Every executor has the same interface (``submit``, ``map``, ``close`` and
+``terminate``), so the way steps are run can be changed without changing the steps.
+Executors are chosen by name (see `create_executor`), and new executors can be
+added with `register_executor`.
+"""
+import logging
+import threading
+
+logger = logging.getLogger('datapyp.executors')
+
+# Initializers that have already been run in the current worker process
+_initialized = set()
+# Initializers that have already been run in each worker thread
+_thread_state = threading.local()
+# Queue used by a worker process to report when it starts and finishes a task with
+# a timeout
+_events = None
+# Array shared by the workers of a `ProcessExecutor` with the process id and the token
+# of the batch being run by each worker, and the slot used by the current worker
+_workers = None
+_slot = None
+
+def _get_func_name(func):
+    return '{0}.{1}'.format(getattr(func, '__module__', None),
+        getattr(func, '__qualname__', getattr(func, '__name__', repr(func))))
+
+def _get_initializer_key(initializer):
+    """
+    Key used to check whether an initializer has already been run. Initializers that
+    can be pickled use their pickled bytes, so a function (or a ``functools.partial``
+    with the same arguments) sent again to a worker process has the same key, while
+    closures, lambdas and partials with different arguments have different keys.
+    Other initializers use the initializer itself (or its id if it is unhashable).
+    """
+    import pickle
+    try:
+        return pickle.dumps(initializer, 2)
+    except Exception:
+        pass
+    try:
+        hash(initializer)
+    except TypeError:
+        return id(initializer)
+    return initializer
+
+class WorkerInitializer:
+    """
+    Initializer sent to the workers with each task, along with the key used to check
+    whether it has already been run in a worker (see `_get_initializer_key`). The key is
+    only computed once, when the tasks are created, instead of in the worker for
+    every task.
+    """
+    def __init__(self, func):
+        """
+        Parameters
+        ----------
+        func: function
+            Function run once in each worker
+        """
+        self.func = func
+        self.key = _get_initializer_key(func)
+
+def get_worker_initializer(initializer):
+    """
+    Get the `WorkerInitializer` for ``initializer``, which can also be ``None`` or a
+    `WorkerInitializer` that was already created
+    """
+    if initializer is None or isinstance(initializer, WorkerInitializer):
+        return initializer
+    return WorkerInitializer(initializer)
+
+# Functions that have already been imported in the current worker process
+_functions = {}
+
+def get_func_ref(func):
+    """
+    Get a lightweight reference to a function that is sent to the workers instead of
+    the function itself. If the function can be imported by its module and qualified
+    name the reference is the string ``'module:qualname'``, otherwise (for example a
+    lambda or a function defined inside another function) it is the function.
+    Static and class methods of a class defined in a module are also sent as a
+    reference, while methods bound to an instance are sent with their instance.
+    """
+    import sys
+    module = getattr(func, '__module__', None)
+    name = getattr(func, '__qualname__', getattr(func, '__name__', None))
+    if module is None or name is None or module=='__main__' or '<' in name:
+        return func
+    obj = sys.modules.get(module)
+    for attr in name.split('.'):
+        obj = getattr(obj, attr, None)
+    # Class methods are bound again each time they are looked up, so they are equal to
+    # (but not the same object as) ``func``
+    if obj is not func and (not hasattr(func, '__self__') or obj!=func):
+        return func
+    return '{0}:{1}'.format(module, name)
+
+def resolve_func(func_ref):
+    """
+    Get the function for a reference created by `get_func_ref`. Each function is
+    only imported once per worker.
+    """
+    if callable(func_ref):
+        return func_ref
+    try:
+        return _functions[func_ref]
+    except KeyError:
+        import importlib
+        module, name = func_ref.split(':')
+        func = importlib.import_module(module)
+        for attr in name.split('.'):
+            func = getattr(func, attr)
+        _functions[func_ref] = func
+        return func
+
+def initialize_worker(initializer):
+    """
+    Run a step's initializer in the current worker, unless it has already been run.
+    Since a worker is shared by many steps, each initializer is only run once per worker
+    (the first time the worker receives a task from a step that uses it).
+
+    Parameters
+    ----------
+    initializer: `WorkerInitializer`
+        Initializer to run, or ``None``
+    """
+    if initializer is None:
+        return
+    if initializer.key not in _initialized:
+        logger.debug('initializing worker with {0}'.format(
+            _get_func_name(initializer.func)))
+        initializer.func()
+        _initialized.add(initializer.key)
+
+def run_thread_initialized(params):
+    """
+    Run a task in a worker thread after initializing the thread. Unlike
+    `run_initialized`, each initializer is run once in every thread.
+
+    Parameters
+    ----------
+    params: tuple
+        ``(initializer, func, args)``, where ``func(args)`` is run after the
+        `WorkerInitializer` ``initializer``
+    """
+    initializer, func, args = params
+    if initializer is not None:
+        if not hasattr(_thread_state, 'initialized'):
+            _thread_state.initialized = set()
+        if initializer.key not in _thread_state.initialized:
+            logger.debug('initializing thread with {0}'.format(
+                _get_func_name(initializer.func)))
+            initializer.func()
+            _thread_state.initialized.add(initializer.key)
+    return func(args)
+
+def run_initialized(params):
+    """
+    Run a task in a worker after initializing the worker
+
+    Parameters
+    ----------
+    params: tuple
+        ``(initializer, func, args)``, where ``func(args)`` is run after the
+        `WorkerInitializer` ``initializer``
+    """
+    initializer, func, args = params
+    initialize_worker(initializer)
+    return func(args)
+
+def _is_alive(pid):
+    import os
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+def claim_worker_slot(workers):
+    """
+    Claim a slot for the current process in the array of ``(pid, token)`` pairs
+    shared by the workers of a `ProcessExecutor`, reusing the slots of workers that
+    have exited. Returns ``None`` if every slot is in use.
+    """
+    import os
+    pid = os.getpid()
+    with workers.get_lock():
+        for slot in range(len(workers)//2):
+            other = workers[2*slot]
+            if other==0 or other==pid or not _is_alive(other):
+                workers[2*slot] = pid
+                workers[2*slot+1] = 0
+                return slot
+    return None
+
+def _set_worker_token(token):
+    if _slot is not None:
+        with _workers.get_lock():
+            _workers[2*_slot+1] = token
+
+def init_process_worker(events, workers=None):
+    """
+    Prepare a worker process of a `ProcessExecutor`. The worker is moved to a new
+    session, so that the worker and any processes it starts (for example an
+    external program run with `subprocess`) can be killed as a group.
+    """
+    import os
+    global _events, _workers, _slot
+    _events = events
+    _workers = workers
+    if workers is not None:
+        _slot = claim_worker_slot(workers)
+    if hasattr(os, 'setsid'):
+        try:
+            os.setsid()
+        except OSError:
+            pass
+
+def run_batch(params):
+    """
+    Run a function on a batch of parameters in a single task. An exception raised for
+    one set of parameters does not stop the rest of the batch.
+
+    Parameters
+    ----------
+    params: tuple
+        ``(func, args_list)``, where ``func(args)`` is run for each ``args``
+        in ``args_list``, optionally followed by an integer token used to report
+        the process and start time of each task to the executor (for timeouts) and
+        when the batch has finished
+
+    Returns
+    -------
+    results: list
+        ``(success, value, duration)`` for each set of parameters, where ``value`` is
+        either the value returned by ``func`` or the exception it raised
+    """
+    import os
+    import time
+    func, args_list = params[:2]
+    token = params[2] if len(params)>2 else None
+    results = []
+    if token is not None:
+        _set_worker_token(token)
+    try:
+        for args in args_list:
+            start = time.time()
+            if token is not None and _events is not None:
+                _events.put((token, os.getpid(), start))
+            try:
+                value = func(args)
+                success = True
+            except Exception as error:
+                value = error
+                success = False
+            results.append((success, value, time.time()-start))
+    finally:
+        # The worker can no longer be killed for this batch once the token is cleared
+        if token is not None:
+            _set_worker_token(0)
+            if _events is not None:
+                _events.put((token, os.getpid(), None))
+    return results
+
+class SerialExecutor:
+    """
+    Run each task in the current process as soon as it is submitted. This is mostly
+    useful for debugging, since exceptions are raised in the pipeline's process and
+    nothing is pickled.
+    """
+    # Tasks run in the pipeline's process, so they can share its objects
+    in_process = True
+    # Only one batch of tasks should be submitted at a time
+    max_active = 1
+
+    def __init__(self, workers=None):
+        """
+        Parameters
+        ----------
+        workers: int (optional)
+            Ignored, tasks are always run one at a time
+        """
+        self.generation = 0
+
+    def map(self, func, iterable, initializer=None):
+        """
+        Run ``func`` on each item in ``iterable``
+        """
+        initializer = get_worker_initializer(initializer)
+        return [run_initialized((initializer, func, args)) for args in iterable]
+
+    def submit(self, func, args, callback, error_callback, initializer=None):
+        """
+        Run ``func(args)`` and call ``callback`` with the result (or
+        ``error_callback`` with the exception) before returning
+        """
+        try:
+            value = run_initialized((get_worker_initializer(initializer), func, args))
+        except Exception as error:
+            error_callback(error)
+        else:
+            callback(value)
+
+    def close(self):
+        pass
+
+    def terminate(self):
+        self.generation += 1
+
+class ProcessExecutor:
+    """
+    A pool of processes that is created the first time it is used and reused by every
+    `.MultiprocessStep` in a pipeline, so that the cost of starting processes and
+    importing modules is only paid once per run.
+    """
+    in_process = False
+
+    def __init__(self, processes=None, context=None):
+        """
+        Parameters
+        ----------
+        processes: int (optional)
+            Number of worker processes. The default is the number of cpus.
+        context: str (optional)
+            Method used to start the workers (``'fork'``, ``'spawn'`` or
+            ``'forkserver'``). The default is the platform's default start method.
+        """
+        self.processes = processes
+        self.context = context
+        # Process id and start time of each running task with a timeout
+        self.started = {}
+        self._events = None
+        self._workers = None
+        self._killed = False
+        # Incremented every time the workers are terminated, so that tasks submitted
+        # to the old workers can be identified
+        self.generation = 0
+        self._pool = None
+        self._lock = threading.RLock()
+
+    def get_pool(self):
+        """
+        Get the pool of workers, creating it if necessary
+        """
+        with self._lock:
+            if self._pool is None:
+                import os
+                import multiprocessing
+                logger.info('Starting pool with {0} workers'.format(self.processes))
+                if self.context is not None:
+                    multiprocessing = multiprocessing.get_context(self.context)
+                self._events = multiprocessing.Queue()
+                # Leave room for the workers that replace workers that were killed
+                slots = 4*(self.processes or os.cpu_count() or 1)
+                self._workers = multiprocessing.Array('q', 2*slots)
+                self._pool = multiprocessing.Pool(processes=self.processes,
+                    initializer=init_process_worker,
+                    initargs=(self._events, self._workers))
+                thread = threading.Thread(target=self._read_events, args=(self._events,),
+                    name='datapyp-worker-events')
+                thread.daemon = True
+                thread.start()
+            return self._pool
+
+    def _read_events(self, events):
+        while True:
+            try:
+                event = events.get()
+            except Exception:
+                # The queue was closed when the interpreter exited
+                return
+            if event is None:
+                return
+            token, pid, start = event
+            if start is None:
+                # The batch has finished
+                self.started.pop(token, None)
+            else:
+                self.started[token] = (pid, start)
+
+    def _kill(self, pid):
+        import os
+        import signal
+        logger.warning('killing worker {0}'.format(pid))
+        with self._lock:
+            self._killed = True
+        try:
+            # Each worker is the leader of its own process group
+            os.killpg(pid, signal.SIGKILL)
+        except (AttributeError, OSError):
+            try:
+                os.kill(pid, getattr(signal, 'SIGKILL', signal.SIGTERM))
+            except OSError:
+                pass
+
+    def kill(self, pid, token=None):
+        """
+        Kill a worker along with any processes it started. The pool replaces the
+        worker with a new one, but the task the worker was running is lost.
+
+        Parameters
+        ----------
+        pid: int
+            Process id of the worker
+        token: int (optional)
+            Token of the batch the worker should be running. The worker is only killed
+            if it is still running that batch, so that a worker that has moved on to
+            another task (or is waiting for one) is never killed.
+
+        Returns
+        -------
+        killed: bool
+            Whether or not the worker was killed
+        """
+        with self._lock:
+            workers = self._workers
+        if token is None:
+            self._kill(pid)
+            return True
+        if workers is not None:
+            # Workers clear their token while holding the lock before they return a
+            # result, so the worker cannot finish the batch while it is being killed
+            with workers.get_lock():
+                for slot in range(len(workers)//2):
+                    if workers[2*slot]==pid:
+                        if workers[2*slot+1]!=token:
+                            return False
+                        self._kill(pid)
+                        return True
+        # The worker could not claim a slot, so use the last event it reported
+        if self.started.get(token, (None,))[0]!=pid:
+            return False
+        self._kill(pid)
+        return True
+
+    def map(self, func, iterable, initializer=None):
+        """
+        Run ``func`` on each item in ``iterable`` using the pool of workers.
+
+        Parameters
+        ----------
+        func: function
+            Function to run on each item
+        iterable: list-like
+            Parameters passed to ``func``
+        initializer: function (optional)
+            Function run once in each worker before it runs its first task
+            from this set of tasks
+        """
+        initializer = get_worker_initializer(initializer)
+        params = [(initializer, func, args) for args in iterable]
+        return self.get_pool().map(run_initialized, params)
+
+    def submit(self, func, args, callback, error_callback, initializer=None):
+        """
+        Run ``func(args)`` asynchronously in the pool of workers
+
+        Parameters
+        ----------
+        func: function
+            Function to run
+        args: object
+            Parameter passed to ``func``
+        callback: function
+            Called with the value returned by ``func``
+        error_callback: function
+            Called with the exception raised if ``func`` fails
+        initializer: function (optional)
+            Function run once in the worker before its first task that uses it, or
+            a `WorkerInitializer` created for a set of tasks
+        """
+        with self._lock:
+            return self.get_pool().apply_async(run_initialized,
+                ((get_worker_initializer(initializer), func, args),), callback=callback,
+                error_callback=error_callback)
+
+    def close(self):
+        """
+        Wait for all of the workers to finish and shut down the pool
+        """
+        with self._lock:
+            pool, self._pool = self._pool, None
+            events, self._events = self._events, None
+            self._workers = None
+            killed, self._killed = self._killed, False
+        if pool is not None:
+            if killed:
+                # The pool waits forever for the results of the tasks that were
+                # killed, so it can only be terminated
+                pool.terminate()
+            else:
+                pool.close()
+            pool.join()
+            events.put(None)
+
+    def terminate(self):
+        """
+        Stop all of the workers immediately
+        """
+        with self._lock:
+            pool, self._pool = self._pool, None
+            events, self._events = self._events, None
+            self._workers = None
+            self._killed = False
+            self.generation += 1
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+            events.put(None)
+
+class ThreadExecutor:
+    """
+    A pool of threads with the same interface as `ProcessExecutor`, used for steps that
+    spend most of their time waiting on I/O or in code that releases the GIL. The
+    functions and their parameters are never pickled, so they can use any object in
+    the current process (including the `.Pipeline`).
+    """
+    in_process = True
+
+    def __init__(self, threads=None):
+        """
+        Parameters
+        ----------
+        threads: int (optional)
+            Number of worker threads. The default is the number of cpus.
+        """
+        self.threads = threads
+        self.generation = 0
+        self._pool = None
+        self._lock = threading.RLock()
+
+    def get_pool(self):
+        """
+        Get the pool of threads, creating it if necessary
+        """
+        with self._lock:
+            if self._pool is None:
+                from concurrent.futures import ThreadPoolExecutor
+                import multiprocessing
+                threads = self.threads or multiprocessing.cpu_count()
+                logger.info('Starting pool with {0} threads'.format(threads))
+                self._pool = ThreadPoolExecutor(max_workers=threads)
+            return self._pool
+
+    def map(self, func, iterable, initializer=None):
+        """
+        Run ``func`` on each item in ``iterable`` using the pool of threads.
+
+        Parameters
+        ----------
+        func: function
+            Function to run on each item
+        iterable: list-like
+            Parameters passed to ``func``
+        initializer: function (optional)
+            Function run once in each thread before it runs its first task
+            from this set of tasks
+        """
+        initializer = get_worker_initializer(initializer)
+        params = [(initializer, func, args) for args in iterable]
+        return list(self.get_pool().map(run_thread_initialized, params))
+
+    def submit(self, func, args, callback, error_callback, initializer=None):
+        """
+        Run ``func(args)`` asynchronously in the pool of threads
+
+        Parameters
+        ----------
+        func: function
+            Function to run
+        args: object
+            Parameter passed to ``func``
+        callback: function
+            Called with the value returned by ``func``
+        error_callback: function
+            Called with the exception raised if ``func`` fails
+        initializer: function (optional)
+            Function run once in the thread before its first task that uses it, or
+            a `WorkerInitializer` created for a set of tasks
+        """
+        def done(future):
+            if future.cancelled():
+                return
+            error = future.exception()
+            if error is not None:
+                error_callback(error)
+            else:
+                callback(future.result())
+        with self._lock:
+            future = self.get_pool().submit(run_thread_initialized,
+                (get_worker_initializer(initializer), func, args))
+        future.add_done_callback(done)
+        return future
+
+    def close(self):
+        """
+        Wait for all of the threads to finish and shut down the pool
+        """
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True)
+
+    def terminate(self):
+        """
+        Cancel all of the tasks that have not started. Threads cannot be stopped, so
+        tasks that are already running finish in the background and their results
+        are discarded.
+        """
+        with self._lock:
+            pool, self._pool = self._pool, None
+            self.generation += 1
+        if pool is not None:
+            try:
+                pool.shutdown(wait=False, cancel_futures=True)
+            except TypeError:
+                # Python < 3.9
+                pool.shutdown(wait=False)
+
+def socket_worker(address, authkey=None):
+    """
+    Run tasks sent by a `SocketExecutor` until the executor closes the connection.
+    To use workers on other hosts, create the executor with ``workers=0`` and an
+    ``address`` that the hosts can reach, then run this function on each host.
+    Unless the executor was created with ``shared_memory=True`` the global variables
+    are sent to the workers with each task, since shared memory is only available
+    on the executor's host.
+
+    Parameters
+    ----------
+    address: tuple
+        ``(host, port)`` of the executor
+    authkey: bytes (optional)
+        Key used to authenticate the connection
+    """
+    from multiprocessing.connection import Client
+    conn = Client(tuple(address), authkey=authkey)
+    try:
+        while True:
+            try:
+                task = conn.recv()
+            except EOFError:
+                break
+            if task is None:
+                break
+            try:
+                result = (True, run_initialized(task))
+            except Exception as error:
+                result = (False, error)
+            try:
+                conn.send(result)
+            except Exception as error:
+                # The result or exception could not be pickled
+                conn.send((False, RuntimeError(
+                    'Unable to send the result of a task: {0}'.format(error))))
+    finally:
+        conn.close()
+
+class _SocketPool:
+    """
+    Workers connected to a `SocketExecutor`. Each connection is served by a thread
+    that sends a task to the worker and waits for its result.
+    """
+    def __init__(self, workers, address, authkey):
+        import multiprocessing
+        from multiprocessing.connection import Listener
+        try:
+            import queue
+        except ImportError:
+            import Queue as queue
+        self.tasks = queue.Queue()
+        self.accepting = True
+        self.terminated = False
+        self.connections = []
+        self.threads = []
+        self.processes = []
+        self.listener = Listener(address, authkey=authkey, backlog=max(workers, 16))
+        self._lock = threading.Lock()
+        # The workers are started before the thread that accepts their connections,
+        # since forking a process while other threads are running is not safe
+        for n in range(workers):
+            process = multiprocessing.Process(target=socket_worker,
+                args=(self.listener.address, authkey))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+        self._accept_thread = threading.Thread(target=self._accept,
+            name='datapyp-socket-accept')
+        self._accept_thread.daemon = True
+        self._accept_thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn = self.listener.accept()
+            except Exception as error:
+                if self.accepting:
+                    logger.warning('unable to accept a worker: {0}'.format(error))
+                    continue
+                return
+            with self._lock:
+                if not self.accepting:
+                    conn.close()
+                    return
+                logger.debug('worker connected')
+                thread = threading.Thread(target=self._serve, args=(conn,),
+                    name='datapyp-socket-worker')
+                thread.daemon = True
+                self.connections.append(conn)
+                self.threads.append(thread)
+            thread.start()
+
+    def _stop_accepting(self):
+        import socket
+        with self._lock:
+            self.accepting = False
+        # Closing the listener does not interrupt accept, so connect to it instead.
+        # The connection fails authentication, which stops the accept thread.
+        try:
+            socket.create_connection(self.listener.address, timeout=1).close()
+        except Exception:
+            pass
+        self._accept_thread.join()
+        self.listener.close()
+
+    def _serve(self, conn):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                try:
+                    conn.send(None)
+                    conn.close()
+                except Exception:
+                    pass
+                return
+            params, callback, error_callback = task
+            try:
+                conn.send(params)
+                success, value = conn.recv()
+            except Exception as error:
+                if not self.terminated:
+                    logger.error('lost connection to a worker: {0}'.format(error))
+                    error_callback(error)
+                return
+            if self.terminated:
+                return
+            if success:
+                callback(value)
+            else:
+                error_callback(value)
+
+    def close(self):
+        self._stop_accepting()
+        # Each thread stops after the tasks already in the queue
+        for thread in self.threads:
+            self.tasks.put(None)
+        for thread in self.threads:
+            thread.join()
+        for process in self.processes:
+            process.join()
+
+    def terminate(self):
+        self.terminated = True
+        self._stop_accepting()
+        for conn in self.connections:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        for thread in self.threads:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.terminate()
+            process.join()
+
+class SocketExecutor:
+    """
+    Send tasks to workers that connect to the executor over a socket, which behaves
+    like a cluster of hosts: the workers only share the connection to the executor,
+    and tasks and results are pickled. By default the workers are started on the
+    current host, but workers on other hosts can connect using `socket_worker`.
+
+    Workers on other hosts cannot attach to the shared memory used to send large
+    arrays in the pipeline's global variables to the workers (see
+    `datapyp.shared.SharedGlobals`), so unless the executor only listens on a
+    loopback address the arrays are pickled with every task instead.
+    """
+    in_process = False
+
+    def __init__(self, workers=None, address=('localhost', 0), authkey=None,
+            shared_memory=None):
+        """
+        Parameters
+        ----------
+        workers: int (optional)
+            Number of workers to start on the current host. The default is the
+            number of cpus.
+        address: tuple (optional)
+            ``(host, port)`` the executor listens on. The default uses a free port
+            on ``localhost``.
+        authkey: bytes (optional)
+            Key that workers use to authenticate. The default is a random key, which
+            only works for workers started by the executor.
+        shared_memory: bool (optional)
+            Whether or not every worker runs on the current host, so that large
+            arrays in the global variables can be placed in shared memory. The
+            default is ``True`` if ``address`` is a loopback address (which workers on
+            other hosts cannot connect to), otherwise ``False``.
+        """
+        import os
+        import multiprocessing
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if shared_memory is None:
+            shared_memory = address[0] in ['localhost', '::1'] or (
+                address[0].startswith('127.'))
+        self.workers = workers
+        self.address = address
+        self.authkey = authkey if authkey is not None else os.urandom(16)
+        self.shared_memory = shared_memory
+        self.generation = 0
+        self._pool = None
+        self._lock = threading.RLock()
+
+    def get_pool(self):
+        """
+        Start listening for workers (and start the local workers) if necessary
+        """
+        with self._lock:
+            if self._pool is None:
+                logger.info('Starting {0} socket workers'.format(self.workers))
+                self._pool = _SocketPool(self.workers, self.address, self.authkey)
+            return self._pool
+
+    def map(self, func, iterable, initializer=None):
+        """
+        Run ``func`` on each item in ``iterable`` using the workers
+        """
+        initializer = get_worker_initializer(initializer)
+        results = [None]*len(iterable)
+        done = threading.Semaphore(0)
+        errors = []
+        def make_callbacks(idx):
+            def callback(value):
+                results[idx] = value
+                done.release()
+            def error_callback(error):
+                errors.append(error)
+                done.release()
+            return callback, error_callback
+        for idx, args in enumerate(iterable):
+            callback, error_callback = make_callbacks(idx)
+            self.submit(func, args, callback, error_callback, initializer)
+        for n in range(len(iterable)):
+            done.acquire()
+        if len(errors)>0:
+            raise errors[0]
+        return results
+
+    def submit(self, func, args, callback, error_callback, initializer=None):
+        """
+        Send ``func(args)`` to the next available worker
+
+        Parameters
+        ----------
+        func: function
+            Function to run
+        args: object
+            Parameter passed to ``func``
+        callback: function
+            Called with the value returned by ``func``
+        error_callback: function
+            Called with the exception raised if ``func`` fails
+        initializer: function (optional)
+            Function run once in the worker before its first task that uses it, or
+            a `WorkerInitializer` created for a set of tasks
+        """
+        with self._lock:
+            self.get_pool().tasks.put(((get_worker_initializer(initializer), func, args),
+                callback, error_callback))
+
+    def close(self):
+        """
+        Wait for the queued tasks to finish and disconnect the workers
+        """
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+
+    def terminate(self):
+        """
+        Disconnect the workers immediately and stop the local workers
+        """
+        with self._lock:
+            pool, self._pool = self._pool, None
+            self.generation += 1
+        if pool is not None:
+            pool.terminate()
+
+# Functions used to create each type of executor, called with the number of workers
+EXECUTORS = {
+    'serial': SerialExecutor,
+    'thread': ThreadExecutor,
+    'process': ProcessExecutor,
+    'spawn': lambda workers=None: ProcessExecutor(workers, context='spawn'),
+    'forkserver': lambda workers=None: ProcessExecutor(workers, context='forkserver'),
+    'socket': SocketExecutor
+}
+
+def register_executor(name, factory):
+    """
+    Add a new type of executor
+
+    Parameters
+    ----------
+    name: str
+        Name used to select the executor
+    factory: function
+        Function called with the number of workers (or ``None``) that returns a new
+        executor. An executor must have the same methods as `ProcessExecutor`.
+    """
+    EXECUTORS[name] = factory
+
+def create_executor(executor, workers=None):
+    """
+    Create an executor
+
+    Parameters
+    ----------
+    executor: str
+        Name of the executor: ``'serial'``, ``'thread'``, ``'process'``, ``'spawn'``,
+        ``'forkserver'``, ``'socket'`` or the name of an executor added with
+        `register_executor`
+    workers: int (optional)
+        Number of workers. The default depends on the executor (usually the
+        number of cpus).
+    """
+    try:
+        factory = EXECUTORS[executor]
+    except KeyError:
+        from datapyp.core import PipelineError
+        raise PipelineError("Unknown executor '{0}', use one of {1}".format(
+            executor, sorted(EXECUTORS.keys())))
+    return factory(workers)
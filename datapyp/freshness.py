@@ -0,0 +1,138 @@
+# Copyright 2015 Fred Moolekamp
+# BSD 3-clause license
+"""
+Make-style checks used to skip steps whose output files are already up to date
+"""
+import os
+import hashlib
+import logging
+
+logger = logging.getLogger('datapyp.freshness')
+
+FRESHNESS_METHODS = ['mtime', 'hash']
+
+def hash_file(filename, blocksize=1<<20):
+    """
+    SHA1 hash of the contents of a file
+    """
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        while True:
+            block = f.read(blocksize)
+            if not block:
+                break
+            sha.update(block)
+    return sha.hexdigest()
+
+def hash_inputs(step):
+    """
+    Hash all of the input files of a step. Inputs that do not exist are ignored.
+    """
+    return dict([(f, hash_file(f)) for f in step.inputs if os.path.isfile(f)])
+
+def _iter_steps(steps):
+    """
+    Iterate over every `.PipelineStep` in ``steps``, including the steps contained in
+    a `.MultiprocessStep`
+    """
+    for step in steps:
+        if step._step_type=='PipelineStep':
+            yield step
+        elif hasattr(step, 'steps'):
+            for substep in _iter_steps(step.steps):
+                yield substep
+
+def get_step_key(step):
+    """
+    Key used to identify a step in the set of fresh steps. Steps in a
+    `.StepTable` are views that are created when they are used, so they are
+    identified by their table and row instead of their ``id``.
+    """
+    return getattr(step, 'step_key', None) or id(step)
+
+def stat_files(steps):
+    """
+    Get the modification time of every input and output file declared by ``steps``.
+    Each file is only checked once, even if it is used by several steps.
+
+    Returns
+    -------
+    mtimes: dict
+        Modification time of each file, or ``None`` if the file does not exist
+    """
+    mtimes = {}
+    for step in _iter_steps(steps):
+        for filename in (getattr(step, 'inputs', None) or []) + (
+                getattr(step, 'outputs', None) or []):
+            if filename not in mtimes:
+                try:
+                    mtimes[filename] = os.stat(filename).st_mtime
+                except OSError:
+                    mtimes[filename] = None
+    return mtimes
+
+def is_fresh(step, mtimes, stale_files, method='mtime'):
+    """
+    Check whether the outputs of a step are up to date.
+
+    A step is up to date if it declares at least one output, all of its outputs exist,
+    none of its inputs will be re-created by an earlier step, and either its oldest
+    output is newer than its newest input or (if ``method=='hash'``) the hashes of its
+    inputs match the hashes saved the last time the step was run.
+
+    Parameters
+    ----------
+    step: `.PipelineStep`
+        Step to check
+    mtimes: dict
+        Modification times of all of the files (from `stat_files`)
+    stale_files: set
+        Files that will be re-created by steps that will run before ``step``
+    method: str (optional)
+        Either ``'mtime'`` or ``'hash'``
+    """
+    inputs = getattr(step, 'inputs', None) or []
+    outputs = getattr(step, 'outputs', None) or []
+    if len(outputs)==0:
+        return False
+    if any([f in stale_files for f in inputs]):
+        return False
+    output_times = [mtimes[f] for f in outputs]
+    input_times = [mtimes[f] for f in inputs]
+    if any([t is None for t in output_times]) or any([t is None for t in input_times]):
+        return False
+    if len(input_times)==0 or min(output_times)>=max(input_times):
+        return True
+    if method=='hash' and getattr(step, 'input_hashes', None) is not None:
+        return hash_inputs(step)==step.input_hashes
+    return False
+
+def find_fresh_steps(steps, method='mtime'):
+    """
+    Find all of the steps (and steps in a `.MultiprocessStep`) that do not need to be
+    run because their outputs are up to date. The files used by all of the steps are
+    checked once before any step is run, and any step that uses an output from a step
+    that is not up to date is also run.
+
+    Parameters
+    ----------
+    steps: list
+        Steps that will be run, in order
+    method: str (optional)
+        Either ``'mtime'`` or ``'hash'``
+
+    Returns
+    -------
+    fresh: set
+        Key of each step that can be skipped (see `get_step_key`)
+    """
+    mtimes = stat_files(steps)
+    stale_files = set()
+    fresh = set()
+    for step in _iter_steps(steps):
+        if is_fresh(step, mtimes, stale_files, method):
+            fresh.add(get_step_key(step))
+        else:
+            stale_files.update(getattr(step, 'outputs', None) or [])
+    logger.info('{0} steps are up to date'.format(len(fresh)))
+    return fresh
@@ -0,0 +1,205 @@
+# Copyright 2015 Fred Moolekamp
+# BSD 3-clause license
+"""
+History of how long the steps of a `.MultiprocessStep` took to run, used to start
+the steps that are expected to take the longest first
+"""
+import os
+import threading
+import logging
+import warnings
+
+logger = logging.getLogger('datapyp.history')
+
+# Ways the steps in a MultiprocessStep can be ordered before they are dispatched
+DISPATCH_ORDERS = ['list', 'longest_first']
+
+def get_history_path(logfile):
+    """
+    Name of the runtime history that accompanies the pipeline saved to ``logfile``.
+    For example the history for ``log/pipeline.p`` is saved in ``log/pipeline.history``.
+    """
+    return os.path.splitext(logfile)[0]+'.history'
+
+def get_func_key(func):
+    """
+    Name used to identify a function in the history
+    """
+    name = getattr(func, '__qualname__', getattr(func, '__name__', repr(func)))
+    return '{0}:{1}'.format(getattr(func, '__module__', None), name)
+
+def get_task_size(func_kwargs):
+    """
+    Total size (in bytes) of the files passed to a step, which is used to predict
+    how long the step will take. Any keyword argument that is the name of an
+    existing file (or a list of filenames) is included.
+
+    Returns
+    -------
+    size: int
+        Total size of the files, or ``None`` if no files were passed to the step
+    """
+    size = None
+    for value in func_kwargs.values():
+        if isinstance(value, (list, tuple)):
+            filenames = [v for v in value if isinstance(v, str)]
+        elif isinstance(value, str):
+            filenames = [value]
+        else:
+            continue
+        for filename in filenames:
+            try:
+                if os.path.isfile(filename):
+                    size = (size or 0)+os.path.getsize(filename)
+            except (OSError, ValueError):
+                pass
+    return size
+
+def order_tasks(tasks, estimates):
+    """
+    Sort tasks so that the ones expected to take the longest are run first, which
+    keeps a few long steps at the end of the list from running alone on a single
+    worker while the others are idle. Tasks that have never been run go first,
+    so that their duration is learned as early as possible.
+
+    Parameters
+    ----------
+    tasks: list
+        ``(key, params)`` for each task
+    estimates: dict
+        Estimated duration of each task, with the task keys as keys
+
+    Returns
+    -------
+    tasks: list
+        Sorted tasks
+    """
+    return sorted(tasks, key=lambda task: _get_sort_key(estimates.get(task[0])))
+
+def order_keys(keys, estimates):
+    """
+    Sort the keys of a set of tasks in the same order as `order_tasks`
+    """
+    return sorted(keys, key=lambda key: _get_sort_key(estimates.get(key)))
+
+def _get_sort_key(estimate):
+    return -float('inf') if estimate is None else -estimate
+
+class RuntimeHistory:
+    """
+    Durations of previous runs of each step function, along with the size of the
+    files passed to each step (see `get_task_size`). The duration of a new step is
+    estimated with a linear fit of duration against size, or the mean duration
+    if the sizes are not known.
+    """
+    def __init__(self, path=None, max_records=1000):
+        """
+        Parameters
+        ----------
+        path: str (optional)
+            Filename used to save the history. If the file exists the history is
+            loaded from it.
+        max_records: int (optional)
+            Maximum number of durations kept for each function. Older durations
+            are discarded first.
+        """
+        self.path = path
+        self.max_records = max_records
+        self.records = {}
+        self._fits = {}
+        self._lock = threading.Lock()
+        if path is not None and os.path.isfile(path):
+            self.load()
+
+    def load(self):
+        """
+        Load the history from ``path``
+        """
+        import pickle
+        try:
+            with open(self.path, 'rb') as f:
+                self.records = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            warnings.warn('Runtime history {0} could not be loaded'.format(self.path))
+            self.records = {}
+        self._fits = {}
+
+    def save(self):
+        """
+        Save the history to ``path``
+
+        Returns
+        -------
+        success: bool
+            ``True`` if the history was saved
+        """
+        import pickle
+        if self.path is None:
+            return False
+        replace = getattr(os, 'replace', os.rename)
+        with self._lock:
+            data = pickle.dumps(self.records, 2)
+        try:
+            tmp_path = self.path+'.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            replace(tmp_path, self.path)
+        except (IOError, OSError) as error:
+            logger.error('unable to save runtime history {0}: {1}'.format(
+                self.path, error))
+            return False
+        return True
+
+    def add(self, func_key, size, duration):
+        """
+        Record that a step using the function ``func_key`` with files of total size
+        ``size`` took ``duration`` seconds
+        """
+        with self._lock:
+            records = self.records.setdefault(func_key, [])
+            records.append((size, duration))
+            if len(records)>self.max_records:
+                del records[:len(records)-self.max_records]
+            self._fits.pop(func_key, None)
+
+    def _fit(self, records):
+        """
+        Fit ``duration = intercept + slope*size`` to the records with a size, or use
+        the mean duration if there are not enough of them
+        """
+        mean = sum([duration for size, duration in records])/len(records)
+        sized = [(size, duration) for size, duration in records if size is not None]
+        if len(sized)<2:
+            return mean, 0.
+        n = len(sized)
+        mean_size = sum([size for size, duration in sized])/float(n)
+        mean_duration = sum([duration for size, duration in sized])/float(n)
+        var = sum([(size-mean_size)**2 for size, duration in sized])
+        if var==0:
+            return mean, 0.
+        cov = sum([(size-mean_size)*(duration-mean_duration) for size, duration in sized])
+        slope = cov/var
+        if slope<0:
+            # Larger files never make a step faster, so the sizes are not useful
+            return mean, 0.
+        return mean_duration-slope*mean_size, slope
+
+    def estimate(self, func_key, size=None):
+        """
+        Estimate the number of seconds a step will take
+
+        Returns
+        -------
+        duration: float
+            Estimated duration, or ``None`` if the function has never been run
+        """
+        with self._lock:
+            if func_key not in self._fits:
+                records = self.records.get(func_key)
+                if not records:
+                    return None
+                self._fits[func_key] = self._fit(records)
+            intercept, slope = self._fits[func_key]
+        if size is None:
+            size = 0
+        return max(intercept+slope*size, 0.)
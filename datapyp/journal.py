@@ -0,0 +1,357 @@
+# Copyright 2015 Fred Moolekamp
+# BSD 3-clause license
+"""
+Append-only journal used to checkpoint a pipeline without re-serializing
+the entire `.Pipeline` after every step
+"""
+import os
+import struct
+import hashlib
+import logging
+import warnings
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+logger = logging.getLogger('datapyp.journal')
+
+# Each record is stored as a one byte serializer flag, the length of the
+# payload and the payload itself
+_HEADER = struct.Struct('>cQ')
+
+def get_journal_path(logfile):
+    """
+    Name of the journal that accompanies the pipeline saved to ``logfile``.
+    For example ``log/pipeline.p`` is journaled in ``log/pipeline.journal``.
+    """
+    return os.path.splitext(logfile)[0]+'.journal'
+
+def dumps_record(record, dump_type=None):
+    """
+    Serialize a journal record. Like `.Pipeline.save_pipeline` this tries pickle
+    first (unless ``dump_type=='dill'``) and falls back to dill.
+
+    Returns
+    -------
+    flag: bytes
+        ``b'P'`` if the record was pickled or ``b'D'`` if dill was used
+    payload: bytes
+        Serialized record
+    """
+    if dump_type=='pickle' or dump_type is None:
+        try:
+            try:
+                import cPickle as pickle
+            except ImportError:
+                import pickle
+            return b'P', pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            if dump_type=='pickle':
+                raise
+    import dill
+    return b'D', dill.dumps(record)
+
+def loads_record(flag, payload):
+    """
+    Deserialize a journal record written by `dumps_record`
+    """
+    if flag==b'D':
+        import dill
+        return dill.loads(payload)
+    try:
+        import cPickle as pickle
+    except ImportError:
+        import pickle
+    return pickle.loads(payload)
+
+# Values that cannot be changed in place, so they only change if they are re-assigned
+_IMMUTABLE = (type(None), bool, int, float, complex, str, bytes, frozenset)
+
+def get_fingerprint(value):
+    """
+    Hash of the serialized ``value``, used to detect changes made to a global variable
+    in place. Like `dumps_record` dill is used if ``value`` cannot be pickled.
+    Immutable values have an empty fingerprint and ``None`` is returned if the value
+    cannot be serialized.
+    """
+    if type(value) in _IMMUTABLE:
+        return b''
+    try:
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        try:
+            import dill
+            data = dill.dumps(value)
+        except Exception:
+            return None
+    return hashlib.sha1(data).digest()
+
+def get_globals_state(global_vars):
+    """
+    Value and fingerprint (see `get_fingerprint`) of each attribute of a
+    `.PipelineGlobals` instance, taken before a step is run
+    """
+    return dict([(k, (v, get_fingerprint(v))) for k,v in global_vars.__dict__.items()])
+
+def get_globals_delta(before, global_vars):
+    """
+    Compare the attributes of a `.PipelineGlobals` instance to the state returned by
+    `get_globals_state` before a step was run.
+
+    Variables that were re-assigned are detected by their identity and variables that
+    were changed in place (for example by appending to a list) by their fingerprint.
+
+    Returns
+    -------
+    changed: dict
+        Variables that were added or given a new value
+    deleted: list
+        Names of variables that were removed
+    complete: bool
+        ``False`` if a variable could not be serialized, so it might have been
+        changed in place without being included in ``changed``
+    """
+    after = global_vars.__dict__
+    changed = {}
+    complete = True
+    for k,v in after.items():
+        if k not in before:
+            changed[k] = v
+            continue
+        value, fingerprint = before[k]
+        if value is not v:
+            changed[k] = v
+        elif fingerprint is None:
+            complete = False
+        elif fingerprint:
+            new_fingerprint = get_fingerprint(v)
+            if new_fingerprint is None:
+                complete = False
+            elif new_fingerprint!=fingerprint:
+                changed[k] = v
+    deleted = [k for k in before if k not in after]
+    return changed, deleted, complete
+
+def build_record(step, run_step_idx, globals_delta=None, step_idx=None):
+    """
+    Create the compact record stored in the journal after ``step`` has been run
+
+    Parameters
+    ----------
+    step: `.PipelineStep` or `.MultiprocessStep`
+        Step that was just completed
+    run_step_idx: int
+        Value of `.Pipeline.run_step_idx` after the step finished
+    globals_delta: tuple (optional)
+        ``(changed, deleted)`` variables returned by `get_globals_delta`
+    step_idx: int (optional)
+        Index of the step in `.Pipeline.run_steps`. Steps run by a
+        `datapyp.scheduler.DagScheduler` can finish out of order, so this is
+        needed to resume the run.
+    """
+    results = step.results
+    record = {
+        'step_id': step.step_id,
+        'run_step_idx': run_step_idx,
+        'status': results.get('status') if isinstance(results, dict) else None,
+        'results': results,
+    }
+    if step_idx is not None:
+        record['step_idx'] = step_idx
+    if hasattr(step, 'steps'):
+        record['substeps'] = [s.results for s in step.steps]
+    if globals_delta is not None:
+        record['globals'], record['deleted_globals'] = globals_delta
+    return record
+
+def build_substep_record(step, substep_idx):
+    """
+    Create the record stored in the journal when a single step in a
+    `.MultiprocessStep` has finished. Only the ``global_updates`` in the results of
+    the sub-step are saved (not the combined value of each global variable, which
+    would make the journal grow with the square of the number of sub-steps), so
+    `replay_journal` combines them again using ``step.reducers``.
+
+    Parameters
+    ----------
+    step: `.MultiprocessStep`
+        Step containing the sub-step
+    substep_idx: int
+        Index of the sub-step in ``step.steps``
+    """
+    return {
+        'step_id': step.step_id,
+        'substep_idx': substep_idx,
+        'results': step.steps[substep_idx].results
+    }
+
+class PipelineJournal:
+    """
+    Append-only log of the steps completed by a `.Pipeline`.
+
+    Instead of saving the whole pipeline after every step, a compact record for the
+    step is appended to the journal. Every ``compact_every`` records the full pipeline
+    is saved and the journal is cleared, so the size of a checkpoint no longer grows
+    with the number of steps that have already been run.
+    """
+    def __init__(self, path, dump_type=None, compact_every=100, writer=None):
+        """
+        Parameters
+        ----------
+        path: str
+            Filename of the journal
+        dump_type: str (optional)
+            Module to use to serialize records (``'pickle'`` or ``'dill'``). If no
+            dump_type is specified pickle is tried first, then dill
+        compact_every: int (optional)
+            Number of records appended before the journal should be compacted
+        writer: `datapyp.checkpoint.CheckpointWriter` (optional)
+            If a writer is specified, records are written in its background thread
+        """
+        self.path = path
+        self.dump_type = dump_type
+        self.compact_every = compact_every
+        self.writer = writer
+        self.records = 0
+
+    def append(self, record):
+        """
+        Append a record to the journal
+
+        Returns
+        -------
+        success: bool
+            ``True`` if the record was written
+        """
+        try:
+            flag, payload = dumps_record(record, self.dump_type)
+        except Exception:
+            warnings.warn('Step {0} could not be written to the journal'.format(
+                record.get('step_id')))
+            return False
+        if self.writer is not None:
+            self.writer.append(self.path, _HEADER.pack(flag, len(payload))+payload)
+        else:
+            with open(self.path, 'ab') as f:
+                f.write(_HEADER.pack(flag, len(payload)))
+                f.write(payload)
+                f.flush()
+        self.records += 1
+        return True
+
+    def needs_compaction(self):
+        """
+        Whether or not enough records have been written to compact the journal
+        """
+        return self.compact_every is not None and self.records >= self.compact_every
+
+    def clear(self, snapshot_id=None):
+        """
+        Remove all of the records from the journal. This should only be called after
+        the full pipeline has been saved.
+
+        Parameters
+        ----------
+        snapshot_id: str (optional)
+            `.Pipeline.snapshot_id` of the pipeline that was just saved. It is written
+            at the start of the journal so that the records are only replayed onto
+            the same snapshot (see `replay_journal`).
+        """
+        data = b''
+        if snapshot_id is not None:
+            flag, payload = dumps_record({'snapshot_id': snapshot_id}, 'pickle')
+            data = _HEADER.pack(flag, len(payload))+payload
+        if self.writer is not None:
+            self.writer.write(self.path, data)
+        else:
+            with open(self.path, 'wb') as f:
+                f.write(data)
+        self.records = 0
+
+    def read(self):
+        """
+        Iterate over the records in the journal. If the last record was only partially
+        written (for example if the pipeline crashed during a write) it is ignored.
+        """
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            while True:
+                header = f.read(_HEADER.size)
+                if len(header)==0:
+                    break
+                if len(header)<_HEADER.size:
+                    warnings.warn('Ignoring incomplete record at the end of the journal')
+                    break
+                flag, length = _HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload)<length:
+                    warnings.warn('Ignoring incomplete record at the end of the journal')
+                    break
+                yield loads_record(flag, payload)
+
+def replay_journal(pipeline, path):
+    """
+    Apply the records in a journal to a pipeline loaded from its last full save
+
+    Parameters
+    ----------
+    pipeline: `.Pipeline`
+        Pipeline to update
+    path: str
+        Filename of the journal
+
+    Returns
+    -------
+    records: int
+        Number of records that were replayed
+    """
+    from datapyp.reducers import apply_updates
+    steps = pipeline.run_steps if pipeline.run_steps is not None else pipeline.steps
+    step_map = dict([(step.step_id, step) for step in steps])
+    # Variables combined by the sub-steps of each step are grown in place
+    buffers = {}
+    records = 0
+    for record in PipelineJournal(path).read():
+        if 'snapshot_id' in record:
+            # The journal was started after a different snapshot was saved, for example
+            # if the pipeline crashed after saving a snapshot but before the journal
+            # was cleared, so its records are already part of (or older than) this one
+            if record['snapshot_id']!=getattr(pipeline, 'snapshot_id', None):
+                warnings.warn('Journal {0} does not match the saved pipeline and '
+                    'was not replayed'.format(path))
+                break
+            continue
+        step = step_map.get(record['step_id'])
+        if step is not None and 'substep_idx' in record:
+            results = record['results']
+            step.steps[record['substep_idx']].results = results
+            if 'globals' in record:
+                # Journals written before only the updates of each sub-step were saved
+                for k,v in record['globals'].items():
+                    setattr(pipeline.global_vars, k, v)
+            elif isinstance(results, dict) and results.get('global_updates'):
+                apply_updates(pipeline.global_vars, results['global_updates'],
+                    getattr(step, 'reducers', {}), buffers.setdefault(id(step), {}))
+            records += 1
+            continue
+        if step is None:
+            warnings.warn('Step {0} in the journal is not part of the pipeline'.format(
+                record['step_id']))
+        else:
+            step.results = record['results']
+            if 'substeps' in record:
+                for substep, results in zip(step.steps, record['substeps']):
+                    substep.results = results
+        for k,v in record.get('globals', {}).items():
+            setattr(pipeline.global_vars, k, v)
+        for k in record.get('deleted_globals', []):
+            if hasattr(pipeline.global_vars, k):
+                delattr(pipeline.global_vars, k)
+        pipeline.run_step_idx = record['run_step_idx']
+        if 'step_idx' in record:
+            pipeline.completed_steps.add(record['step_idx'])
+        records += 1
+    logger.debug('replayed {0} records from {1}'.format(records, path))
+    return records
@@ -0,0 +1,86 @@
+# Copyright 2015 Fred Moolekamp
+# BSD 3-clause license
+"""
+Work done once per run instead of once per step: selecting the steps to run and
+finding the special keywords each step function accepts
+"""
+import inspect
+import logging
+import weakref
+
+logger = logging.getLogger('datapyp.plan')
+
+# Keywords the pipeline passes to a step function if the function accepts them
+INJECTED_KWARGS = ['step_id', 'global_vars', 'pipeline']
+
+# Keywords injected into each function, with the functions as keys. The functions are
+# only weakly referenced, so closures and partials used by old steps are not kept alive.
+_injected = weakref.WeakKeyDictionary()
+
+def get_arg_names(func):
+    """
+    Names of the arguments of ``func`` that can be passed by keyword
+    """
+    if hasattr(inspect, 'getfullargspec'):
+        try:
+            spec = inspect.getfullargspec(func)
+        except TypeError:
+            return []
+        return list(spec.args)+list(spec.kwonlyargs)
+    return inspect.getargspec(func).args
+
+def get_injected_kwargs(func):
+    """
+    Special keywords (``step_id``, ``global_vars`` and ``pipeline``) accepted by
+    ``func``. The signature of each function is only inspected once while the
+    function exists. Bound methods use the signature of their function, while
+    callables that are unhashable or cannot be weakly referenced (such as many
+    built in functions) are inspected each time.
+    """
+    key = getattr(func, '__func__', func)
+    try:
+        return _injected[key]
+    except KeyError:
+        pass
+    except TypeError:
+        # Unhashable callable or one that cannot be weakly referenced
+        return _find_injected(func)
+    injected = _find_injected(func)
+    try:
+        _injected[key] = injected
+    except TypeError:
+        pass
+    return injected
+
+def _find_injected(func):
+    arg_names = get_arg_names(func)
+    return tuple([name for name in INJECTED_KWARGS if name in arg_names])
+
+def filter_steps(steps, run_tags=(), ignore_tags=(), tag_expr=None):
+    """
+    Select the steps that have a tag in ``run_tags`` (or every step if ``run_tags``
+    is empty), do not have a tag in ``ignore_tags`` and match ``tag_expr``.
+    Each step is checked separately, use `.StepContainer.select_steps` to select
+    steps from a pipeline using its tag index.
+
+    Parameters
+    ----------
+    steps: list
+        Steps to filter
+    run_tags: list-like (optional)
+        Tags of the steps to run
+    ignore_tags: list-like (optional)
+        Tags of the steps to skip, which take precedence over ``run_tags``
+    tag_expr: str (optional)
+        Boolean expression of tags (see `datapyp.tags.parse_tag_expression`)
+
+    Returns
+    -------
+    steps: list
+        Steps to run, in the same order as ``steps``
+    """
+    from datapyp.tags import build_tag_query, match_tags
+    query = build_tag_query(run_tags, ignore_tags, tag_expr)
+    if query is None:
+        return list(steps)
+    return [step for step in steps if match_tags(query, step.tags)]
@@ -0,0 +1,149 @@
+# Copyright 2015 Fred Moolekamp
+# BSD 3-clause license
+"""
+Reducers used to combine the updates to `.PipelineGlobals` made by the steps in a
+`.MultiprocessStep`
+"""
+import sys
+import logging
+import warnings
+
+logger = logging.getLogger('datapyp.reducers')
+
+def _is_array(value):
+    return 'numpy' in sys.modules and isinstance(value, sys.modules['numpy'].ndarray)
+
+def reduce_sum(current, value):
+    return current+value
+
+def reduce_concat(current, value):
+    if _is_array(current) or _is_array(value):
+        import numpy as np
+        return np.concatenate([current, value])
+    return list(current)+list(value)
+
+def _concat_buffered(buffers, name, current, value):
+    """
+    Combine ``current`` and ``value`` like `reduce_concat`, but grow a list or array
+    owned by ``buffers`` in place, so that combining ``n`` updates takes ``O(n)``
+    time instead of copying the combined value for each update.
+
+    A list created in ``buffers`` is extended in place, while an array is stored in a
+    larger buffer whose size is doubled when it is full, and a new view of the filled
+    part of the buffer is returned. The values passed to the reducer are never changed,
+    so variables saved before the step started keep their values.
+    """
+    owned = buffers.get(name)
+    if not _is_array(current) and not _is_array(value):
+        if owned is not None and owned is current:
+            current.extend(value)
+            return current
+        combined = list(current)
+        combined.extend(value)
+        buffers[name] = combined
+        return combined
+    import numpy as np
+    value = np.asarray(value)
+    if owned is not None and owned[1] is current:
+        data = owned[0]
+    else:
+        data = None
+        current = np.asarray(current)
+    if current.ndim==0 or value.ndim==0 or current.shape[1:]!=value.shape[1:]:
+        # Let NumPy raise the same error as reduce_concat
+        return np.concatenate([current, value])
+    size = len(current)+len(value)
+    dtype = np.result_type(current, value)
+    if data is None or data.dtype!=dtype:
+        data = np.empty((max(2*size, 16),)+value.shape[1:], dtype=dtype)
+        data[:len(current)] = current
+    elif size>len(data):
+        grown = np.empty((2*size,)+value.shape[1:], dtype=dtype)
+        grown[:len(current)] = data[:len(current)]
+        data = grown
+    data[len(current):size] = value
+    combined = data[:size]
+    buffers[name] = (data, combined)
+    return combined
+
+def reduce_min(current, value):
+    if _is_array(current) or _is_array(value):
+        import numpy as np
+        return np.minimum(current, value)
+    return min(current, value)
+
+def reduce_max(current, value):
+    if _is_array(current) or _is_array(value):
+        import numpy as np
+        return np.maximum(current, value)
+    return max(current, value)
+
+def reduce_replace(current, value):
+    return value
+
+REDUCERS = {
+    'sum': reduce_sum,
+    'concat': reduce_concat,
+    'min': reduce_min,
+    'max': reduce_max,
+    'replace': reduce_replace
+}
+
+def get_reducer(reducer):
+    """
+    Get the function for a reducer, which is either the name of one of the built in
+    reducers (``'sum'``, ``'concat'``, ``'min'``, ``'max'``, ``'replace'``) or a
+    function ``reducer(current, value)`` that returns the new value of the variable.
+    """
+    if callable(reducer):
+        return reducer
+    try:
+        return REDUCERS[reducer]
+    except KeyError:
+        from datapyp.core import PipelineError
+        raise PipelineError("Unknown reducer '{0}', use a function or one of {1}".format(
+            reducer, sorted(REDUCERS.keys())))
+
+def apply_updates(global_vars, updates, reducers, buffers=None):
+    """
+    Combine the updates returned by a single step with the pipeline's global variables.
+
+    Parameters
+    ----------
+    global_vars: `.PipelineGlobals`
+        Global variables to update
+    updates: dict
+        New values returned by the step. If a variable does not exist yet it is set to
+        the value from the step, otherwise the value is combined with the current
+        value using the variable's reducer.
+    reducers: dict
+        Reducer for each variable (see `get_reducer`). Variables without a reducer
+        are replaced.
+    buffers: dict (optional)
+        Lists and arrays created by the ``'concat'`` reducer for the updates of the
+        current step. If ``buffers`` is given, the variables combined with
+        ``'concat'`` are grown in place when their updates are applied one at a time
+        (see `_concat_buffered`). A new dictionary must be used for each step.
+
+    Returns
+    -------
+    updated: dict
+        The new value of each variable that was updated
+    """
+    updated = {}
+    for k,v in updates.items():
+        if not hasattr(global_vars, k):
+            new_value = v
+        else:
+            if k not in reducers:
+                warnings.warn("No reducer for global '{0}', its value will be replaced".format(k))
+                reducer = reduce_replace
+            else:
+                reducer = get_reducer(reducers[k])
+            if reducer is reduce_concat and buffers is not None:
+                new_value = _concat_buffered(buffers, k, getattr(global_vars, k), v)
+            else:
+                new_value = reducer(getattr(global_vars, k), v)
+        setattr(global_vars, k, new_value)
+        updated[k] = new_value
+    return updated
@@ -0,0 +1,93 @@
+# Copyright 2015 Fred Moolekamp
+# BSD 3-clause license
+"""
+Retry steps that fail because of transient problems, for example a network file
+system that is briefly unavailable
+"""
+import random
+import logging
+
+logger = logging.getLogger('datapyp.retry')
+
+class RetryPolicy:
+    """
+    How many times to run a step that raises an exception and how long to wait
+    between attempts. The delay before attempt ``n+1`` is
+    ``backoff*multiplier**(n-1)`` seconds, at most ``max_backoff``.
+    """
+    def __init__(self, max_attempts=3, backoff=1, multiplier=2, max_backoff=None,
+            jitter=0, retry_on=(Exception,)):
+        """
+        Parameters
+        ----------
+        max_attempts: int (optional)
+            Maximum number of times the step is run, including the first attempt.
+            The default is ``3``.
+        backoff: float (optional)
+            Number of seconds to wait before the second attempt. The default is ``1``.
+        multiplier: float (optional)
+            Factor the delay is multiplied by after each attempt. The default is ``2``.
+        max_backoff: float (optional)
+            Maximum number of seconds to wait between attempts
+        jitter: float (optional)
+            Fraction of the delay that is chosen at random, so that many steps that
+            failed at the same time are not all retried at the same time.
+            The default is ``0``.
+        retry_on: tuple (optional)
+            Exception classes that are retried. Other exceptions are handled
+            immediately (see ``ignore_exceptions``). Include `.StepTimeout` to retry
+            steps that run longer than their ``timeout``. The default is to retry
+            any `Exception`.
+        """
+        from datapyp.core import PipelineError
+        if max_attempts<1:
+            raise PipelineError('max_attempts must be at least 1, received {0}'.format(
+                max_attempts))
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.multiplier = multiplier
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        if isinstance(retry_on, type):
+            retry_on = (retry_on,)
+        self.retry_on = tuple(retry_on)
+
+    def should_retry(self, error, attempt):
+        """
+        Whether or not to run a step again after attempt number ``attempt``
+        (starting at 1) raised ``error``
+        """
+        return attempt<self.max_attempts and isinstance(error, self.retry_on)
+
+    def get_delay(self, attempt):
+        """
+        Number of seconds to wait after attempt number ``attempt`` (starting at 1)
+        """
+        delay = self.backoff*self.multiplier**(attempt-1)
+        if self.max_backoff is not None:
+            delay = min(delay, self.max_backoff)
+        if self.jitter:
+            delay *= 1-self.jitter*random.random()
+        return delay
+
+def get_retry_policy(retry):
+    """
+    Build a `RetryPolicy` from the ``retry`` parameter of a step, which is either
+    ``None`` (no retries), a `RetryPolicy`, the maximum number of attempts or a
+    dictionary of parameters for `RetryPolicy`.
+    """
+    if retry is None or isinstance(retry, RetryPolicy):
+        return retry
+    if isinstance(retry, dict):
+        return RetryPolicy(**retry)
+    return RetryPolicy(max_attempts=retry)
+
+def record_attempts(result, durations):
+    """
+    Save the number of attempts and the duration of each attempt in the result
+    of a step that has a retry policy
+    """
+    if isinstance(result, dict):
+        result['attempts'] = len(durations)
+        result['attempt_durations'] = durations
+    return result
@@ -0,0 +1,195 @@
+# Copyright 2015 Fred Moolekamp
+# BSD 3-clause license
+"""
+Schedule the steps of a pipeline as a graph of dependencies, so that steps that do
+not depend on each other can run at the same time
+"""
+import os
+import heapq
+import logging
+
+logger = logging.getLogger('datapyp.scheduler')
+
+def get_step_files(step, attr):
+    """
+    Get the normalized ``inputs`` or ``outputs`` of a step. For a step that contains
+    other steps (for example a `.MultiprocessStep`) the files of all of its steps
+    are included.
+    """
+    files = set([os.path.normpath(f) for f in getattr(step, attr, [])])
+    for substep in getattr(step, 'steps', []):
+        files.update(get_step_files(substep, attr))
+    return files
+
+def get_dependencies(steps):
+    """
+    Find the steps that each step depends on. A step depends on every step listed in
+    its ``depends_on`` and on any earlier step whose ``outputs`` include one of its
+    ``inputs``. Dependencies on steps that are not in ``steps`` (for example steps
+    removed by filtering the tags) are ignored.
+
+    Parameters
+    ----------
+    steps: list
+        Steps to run
+
+    Returns
+    -------
+    dependencies: list of sets
+        Indices (in ``steps``) of the steps that must finish before each step can run
+    """
+    index = dict([(step.step_id, idx) for idx, step in enumerate(steps)])
+    producers = {}
+    dependencies = []
+    for idx, step in enumerate(steps):
+        deps = set()
+        for step_id in getattr(step, 'depends_on', []):
+            if step_id in index:
+                deps.add(index[step_id])
+            else:
+                logger.debug('step {0} depends on step {1}, which is not being run'.format(
+                    step.step_id, step_id))
+        for filename in get_step_files(step, 'inputs'):
+            if filename in producers:
+                deps.add(producers[filename])
+        for filename in get_step_files(step, 'outputs'):
+            producers[filename] = idx
+        deps.discard(idx)
+        dependencies.append(deps)
+    return dependencies
+
+def topological_order(dependencies):
+    """
+    Order the steps so that every step comes after the steps it depends on. When more
+    than one step is ready, the step that comes first in the pipeline is used.
+
+    Parameters
+    ----------
+    dependencies: list of sets
+        Dependencies of each step, from `get_dependencies`
+
+    Returns
+    -------
+    order: list
+        Indices of the steps in the order they can be run
+    """
+    from datapyp.core import PipelineError
+    remaining = [len(deps) for deps in dependencies]
+    dependents = [[] for deps in dependencies]
+    for idx, deps in enumerate(dependencies):
+        for dep in deps:
+            dependents[dep].append(idx)
+    ready = [idx for idx, count in enumerate(remaining) if count==0]
+    heapq.heapify(ready)
+    order = []
+    while len(ready)>0:
+        idx = heapq.heappop(ready)
+        order.append(idx)
+        for dependent in dependents[idx]:
+            remaining[dependent] -= 1
+            if remaining[dependent]==0:
+                heapq.heappush(ready, dependent)
+    if len(order)<len(dependencies):
+        cycle = [idx for idx, count in enumerate(remaining) if count>0]
+        raise PipelineError(
+            'Steps {0} in run_steps have circular dependencies'.format(cycle))
+    return order
+
+class DagScheduler:
+    """
+    Run the steps of a pipeline in a pool of threads, starting each step as soon as
+    all of the steps it depends on have finished.
+
+    Only the scheduling is done in threads: a `.MultiprocessStep` still runs its steps
+    in the pipeline's pool of processes, which is shared by all of the steps that are
+    running. All of the bookkeeping (``on_start`` and ``on_finish``) is done in the
+    thread that called `DagScheduler.run`.
+    """
+    def __init__(self, steps, max_concurrent=None):
+        """
+        Parameters
+        ----------
+        steps: list
+            Steps to run
+        max_concurrent: int (optional)
+            Maximum number of steps running at the same time. The default is the
+            number of cpus.
+        """
+        self.steps = steps
+        self.max_concurrent = max_concurrent
+        self.dependencies = get_dependencies(steps)
+        self.order = topological_order(self.dependencies)
+
+    def run(self, execute, completed=(), on_start=None, on_finish=None):
+        """
+        Run all of the steps that have not been completed
+
+        Parameters
+        ----------
+        execute: function
+            ``execute(idx)`` runs the step with index ``idx``
+        completed: list-like (optional)
+            Indices of steps that have already finished
+        on_start: function (optional)
+            ``on_start(idx)`` is called before a step is started
+        on_finish: function (optional)
+            ``on_finish(idx)`` is called after a step finishes successfully
+
+        If a step raises an exception no more steps are started, and the exception is
+        raised once the steps that are already running have finished.
+        """
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+        done = set(completed)
+        # Number of unfinished dependencies of each step that has not been run, and
+        # the steps waiting for each step, so that only the dependents of a step are
+        # checked when it finishes
+        remaining = {}
+        dependents = {}
+        ready = []
+        for idx in self.order:
+            if idx in done:
+                continue
+            count = 0
+            for dep in self.dependencies[idx]:
+                if dep not in done:
+                    count += 1
+                    dependents.setdefault(dep, []).append(idx)
+            remaining[idx] = count
+            if count==0:
+                ready.append(idx)
+        if len(remaining)==0:
+            return
+        # Ready steps are started in the order they appear in the pipeline
+        heapq.heapify(ready)
+        max_workers = min(self.max_concurrent or os.cpu_count() or 1, len(remaining))
+        running = {}
+        errors = []
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            while len(running)>0 or (len(ready)>0 and len(errors)==0):
+                if len(errors)==0:
+                    while len(ready)>0 and len(running)<max_workers:
+                        idx = heapq.heappop(ready)
+                        if on_start is not None:
+                            on_start(idx)
+                        running[pool.submit(execute, idx)] = idx
+                if len(running)==0:
+                    break
+                finished, not_done = wait(list(running.keys()),
+                    return_when=FIRST_COMPLETED)
+                for future in finished:
+                    idx = running.pop(future)
+                    try:
+                        future.result()
+                    except Exception as error:
+                        logger.error('step {0} failed'.format(self.steps[idx].step_id))
+                        errors.append(error)
+                        continue
+                    done.add(idx)
+                    if on_finish is not None:
+                        on_finish(idx)
+                    for dependent in dependents.pop(idx, []):
+                        remaining[dependent] -= 1
+                        if remaining[dependent]==0:
+                            heapq.heappush(ready, dependent)
+        if len(errors)>0:
+            raise errors[0]
@@ -0,0 +1,181 @@
+# Copyright 2015 Fred Moolekamp
+# BSD 3-clause license
+"""
+Share large NumPy arrays in `.PipelineGlobals` with the workers of a `.MultiprocessStep`
+without copying them into every task
+"""
+import os
+import sys
+import uuid
+import logging
+import warnings
+
+logger = logging.getLogger('datapyp.shared')
+
+# Blocks of shared memory (or memory-mapped files) attached in the current worker
+_attached = {}
+
+class SharedArray:
+    """
+    Picklable handle to a NumPy array stored in shared memory or in a memory-mapped
+    file. When a `.PipelineGlobals` object is unpickled in a worker, each handle is
+    replaced by a read-only view of the array.
+    """
+    def __init__(self, name, shape, dtype, filename=None):
+        """
+        Parameters
+        ----------
+        name: str
+            Name of the block of shared memory
+        shape: tuple
+            Shape of the array
+        dtype: str
+            Data type of the array
+        filename: str (optional)
+            If the array is stored in a memory-mapped file, the name of the file
+        """
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+        self.filename = filename
+
+    def attach(self):
+        """
+        Get a read-only view of the shared array. Each array is only attached once
+        per worker.
+        """
+        import numpy as np
+        if self.name in _attached:
+            return _attached[self.name][1]
+        if self.filename is not None:
+            shm = None
+            array = np.memmap(self.filename, dtype=self.dtype, mode='r', shape=self.shape)
+        else:
+            shm = _open_shared_memory(self.name)
+            array = np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf)
+            array.setflags(write=False)
+        _attached[self.name] = (shm, array)
+        return array
+
+def _open_shared_memory(name):
+    """
+    Attach to an existing block of shared memory. The block is owned (and removed) by
+    the pipeline, so it is not tracked by the worker when possible.
+    """
+    from multiprocessing import shared_memory
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 always registers the block with the resource tracker, which is
+        # shared with the pipeline, so the block is only unregistered when it is removed
+        return shared_memory.SharedMemory(name=name)
+
+def detach_all(keep=()):
+    """
+    Close all of the shared arrays attached in the current process, except for
+    the arrays named in ``keep``
+    """
+    for name in list(_attached.keys()):
+        if name not in keep:
+            shm, array = _attached.pop(name)
+            del array
+            if shm is not None:
+                try:
+                    shm.close()
+                except BufferError:
+                    # A view of the array is still being used
+                    _attached[name] = (shm, None)
+
+class SharedGlobals:
+    """
+    Copy the large NumPy arrays in a `.PipelineGlobals` object into shared memory (or
+    memory-mapped files when shared memory is not available) for the duration of a
+    `.MultiprocessStep`.
+
+    The arrays are meant to be read-only in the workers. They are copied when the step
+    starts, so changes made to them by earlier steps are always seen by the workers,
+    and the shared copies are removed by `release` when the step has finished.
+    """
+    # Arrays smaller than this (in bytes) are pickled with the other globals
+    min_size = 1<<20
+
+    def __init__(self, temp_path=None):
+        """
+        Parameters
+        ----------
+        temp_path: str (optional)
+            Directory used for memory-mapped files if shared memory is not available
+        """
+        self.temp_path = temp_path
+        self.blocks = []
+        self.files = []
+
+    def _share_array(self, array):
+        import numpy as np
+        try:
+            from multiprocessing import shared_memory
+        except ImportError:
+            shared_memory = None
+        if shared_memory is not None:
+            shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            shared = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+            shared[...] = array
+            del shared
+            self.blocks.append(shm)
+            return SharedArray(shm.name, array.shape, array.dtype.str)
+        if self.temp_path is None:
+            return None
+        name = 'datapyp-{0}'.format(uuid.uuid4().hex)
+        filename = os.path.join(self.temp_path, name+'.npy')
+        mmap = np.memmap(filename, dtype=array.dtype, mode='w+', shape=array.shape)
+        mmap[...] = array
+        mmap.flush()
+        del mmap
+        self.files.append(filename)
+        return SharedArray(name, array.shape, array.dtype.str, filename)
+
+    def share(self, global_vars):
+        """
+        Create a copy of ``global_vars`` to send to the workers, where every large
+        NumPy array is replaced by a `SharedArray`. If ``global_vars`` does not contain
+        any large arrays it is returned unchanged.
+        """
+        # NumPy arrays can only be in the globals if numpy has already been imported
+        if 'numpy' not in sys.modules:
+            return global_vars
+        import numpy as np
+        shared_vars = {}
+        for k,v in global_vars.__dict__.items():
+            if isinstance(v, np.ndarray) and v.nbytes>=self.min_size and (
+                    not v.dtype.hasobject):
+                handle = self._share_array(np.ascontiguousarray(v))
+                if handle is None:
+                    warnings.warn('Shared memory is not available and no temp path has '
+                        'been set, so {0} will be copied to each worker'.format(k))
+                    return global_vars
+                logger.debug('sharing global {0} ({1} bytes)'.format(k, v.nbytes))
+                shared_vars[k] = handle
+        if len(shared_vars)==0:
+            return global_vars
+        shared = global_vars.__class__.__new__(global_vars.__class__)
+        shared.__dict__.update(global_vars.__dict__)
+        shared.__dict__.update(shared_vars)
+        return shared
+
+    def release(self):
+        """
+        Remove all of the shared copies of the arrays
+        """
+        for shm in self.blocks:
+            try:
+                shm.close()
+                shm.unlink()
+            except (OSError, BufferError):
+                warnings.warn('Unable to release shared memory {0}'.format(shm.name))
+        for filename in self.files:
+            try:
+                os.remove(filename)
+            except OSError:
+                warnings.warn('Unable to remove {0}'.format(filename))
+        self.blocks = []
+        self.files = []
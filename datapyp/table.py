@@ -0,0 +1,605 @@
+# Copyright 2015 Fred Moolekamp
+# BSD 3-clause license
+"""
+Compact, column based storage for a large number of similar steps
+"""
+import array
+import logging
+
+logger = logging.getLogger('datapyp.table')
+
+# Status codes stored for each step
+STATUSES = [None, 'success', 'error', 'timeout', 'unknown']
+_STATUS_CODES = dict([(status, code) for code, status in enumerate(STATUSES)])
+
+# Default values of the step attributes that are not stored for each step
+STEP_DEFAULTS = {
+    'ignore_errors': False,
+    'ignore_exceptions': False,
+    'finalizer': None,
+    'cache': False,
+    'inputs': (),
+    'outputs': (),
+    'input_hashes': None,
+    'depends_on': (),
+    'executor': None,
+    'timeout': None,
+    'retry': None,
+    'idempotent': False
+}
+
+class _Missing:
+    """
+    Placeholder for a step that does not override a keyword argument
+    """
+    def __reduce__(self):
+        return '_MISSING'
+
+    def __repr__(self):
+        return '_MISSING'
+
+_MISSING = _Missing()
+
+def load_columns(columns, dtypes=None):
+    """
+    Load the columns of parameters used to build a `StepTable`
+
+    Parameters
+    ----------
+    columns: dict, array or str
+        Either a dictionary with a list (or array) of values for each parameter, a
+        NumPy structured array with a field for each parameter, or the name of a CSV
+        file with a header that contains the name of each parameter. Columns in a CSV
+        file are strings unless they are converted using ``dtypes``.
+    dtypes: dict (optional)
+        Type used to convert each column of a CSV file (see `read_csv_columns`)
+
+    Returns
+    -------
+    columns: dict
+        List or array of values for each parameter
+    """
+    if isinstance(columns, dict):
+        return columns
+    if isinstance(columns, str):
+        return read_csv_columns(columns, dtypes)
+    names = getattr(getattr(columns, 'dtype', None), 'names', None)
+    if names is not None:
+        # Fields of a structured array are views, so the data is not copied
+        return dict([(name, columns[name]) for name in names])
+    from datapyp.core import PipelineError
+    raise PipelineError('columns must be a dict, structured array or CSV filename, '
+        'received {0}'.format(type(columns)))
+
+def read_csv_columns(filename, dtypes=None, **kwargs):
+    """
+    Read the columns of a CSV file, where the first line contains the name of
+    each column. Values are kept as strings unless a type is given in ``dtypes``,
+    so that values like ``'00123'`` or long ids are not changed.
+
+    Parameters
+    ----------
+    filename: str
+        Name of the CSV file
+    dtypes: dict (optional)
+        Type of each column that is converted, either ``int`` or ``float`` (stored in
+        an ``array('q')`` or ``array('d')``, which use much less memory than lists,
+        unless an integer does not fit in 64 bits) or any other function that
+        converts a string
+    kwargs: dict
+        Keyword arguments passed to `csv.reader`
+
+    Returns
+    -------
+    columns: dict
+        Values in each column
+    """
+    import csv
+    from datapyp.core import PipelineError
+    with open(filename) as f:
+        reader = csv.reader(f, **kwargs)
+        try:
+            names = [name.strip() for name in next(reader)]
+        except StopIteration:
+            raise PipelineError('{0} is empty'.format(filename))
+        values = [[] for name in names]
+        for line, row in enumerate(reader):
+            if len(row)==0:
+                continue
+            if len(row)!=len(names):
+                raise PipelineError('Line {0} of {1} has {2} values, expected {3}'.format(
+                    line+2, filename, len(row), len(names)))
+            for column, value in zip(values, row):
+                column.append(value)
+    columns = dict(zip(names, values))
+    if dtypes is not None:
+        for name, dtype in dtypes.items():
+            if name not in columns:
+                raise PipelineError("Column '{0}' is not in {1}".format(name, filename))
+            try:
+                columns[name] = _convert_column(columns[name], dtype)
+            except ValueError as error:
+                raise PipelineError("Column '{0}' of {1} could not be converted: "
+                    "{2}".format(name, filename, error))
+    return columns
+
+def _convert_column(column, dtype):
+    values = [dtype(value) for value in column]
+    typecode = {int: 'q', float: 'd'}.get(dtype)
+    if typecode is not None:
+        try:
+            return array.array(typecode, values)
+        except OverflowError:
+            # Integers that do not fit in 64 bits are kept in a list
+            pass
+    return values
+
+class TableStep:
+    """
+    View of a single step in a `StepTable`, which can be used anywhere a
+    `.PipelineStep` is used. Views are created when they are needed and only store
+    the table and the row of the step, so changes to a view are saved in the table.
+
+    .. warning::
+
+        ``func_kwargs`` and ``results`` are built from the table each time they are
+        used, so changing them in place (for example
+        ``step.func_kwargs['x'] = 1``) has no effect. Assign a new value instead.
+    """
+    __slots__ = ('table', 'row')
+    _step_type = 'PipelineStep'
+
+    def __init__(self, table, row):
+        object.__setattr__(self, 'table', table)
+        object.__setattr__(self, 'row', row)
+
+    @property
+    def step_key(self):
+        """
+        Key that identifies the step even though a new view is created each time
+        """
+        return (id(self.table), self.row)
+
+    def __getattr__(self, name):
+        return self.table.get_attr(self.row, name)
+
+    def __setattr__(self, name, value):
+        self.table.set_attr(self.row, name, value)
+
+    def __reduce__(self):
+        return (TableStep, (self.table, self.row))
+
+    def __repr__(self):
+        return 'TableStep({0!r})'.format(self.step_id)
+
+class StepTable:
+    """
+    Store a large number of steps in columns instead of as individual
+    `.PipelineStep` objects. A table can be used as the ``steps`` of a
+    `.MultiprocessStep` and behaves like a list of steps, where each step is a
+    `TableStep` view of one row.
+
+    Each row stores:
+
+    - the index of its function in a list of functions used by the table
+    - the index of a shared dictionary of keyword arguments, along with any keyword
+      arguments that are different for the step, which are stored in columns
+    - a bitset of its tags
+    - a status code for its results, where the other values in the results are
+      stored in columns (see `get_results_columns`)
+
+    Any other step attribute (``ignore_errors``, ``timeout``, ...) uses the value given
+    when the table was created, unless it is changed for a single step.
+    """
+    def __init__(self, func=None, func_kwargs=None, columns=None, tags=None,
+            step_ids=None, **defaults):
+        """
+        Parameters
+        ----------
+        func: function (optional)
+            Function used by every step built from ``columns``
+        func_kwargs: dict (optional)
+            Keyword arguments shared by every step built from ``columns``
+        columns: dict (optional)
+            Keyword arguments that are different for each step, where each value is a
+            list (or array) with one value for each step. If ``columns`` is given one
+            step is added for each row.
+        tags: list (optional)
+            Tags of every step built from ``columns``
+        step_ids: list (optional)
+            ``step_id`` of each step built from ``columns``. By default the ``step_id``
+            of a step is its row in the table.
+        defaults: dict
+            Values of other `.PipelineStep` parameters (for example ``ignore_errors``
+            or ``timeout``) used by every step in the table
+        """
+        from datapyp.core import PipelineError
+        for name in defaults:
+            if name not in STEP_DEFAULTS:
+                raise PipelineError('Unknown step parameter {0!r}'.format(name))
+        from datapyp.retry import get_retry_policy
+        self.defaults = dict(STEP_DEFAULTS)
+        self.defaults.update(defaults)
+        self.defaults['retry'] = get_retry_policy(self.defaults['retry'])
+        self.funcs = []
+        self.func_idx = array.array('I')
+        self.base_kwargs = []
+        self.kwargs_idx = array.array('I')
+        self.columns = {}
+        self.tag_names = []
+        self.tag_bits = array.array('Q')
+        self.status = array.array('b')
+        self.step_ids = None
+        # Other values in the results of each step, by name
+        self.result_columns = {}
+        # Results that are not a dictionary with a known status and attributes that
+        # are different from the defaults, by row
+        self.results = {}
+        self.attrs = {}
+        self._size = 0
+        self._func_lookup = {}
+        self._tag_lookup = {}
+        self._base_for_func = {}
+        # Columns that were passed to the table and are not copied until they change
+        self._borrowed = set()
+        if columns is not None:
+            self.extend(func, func_kwargs, columns, tags, step_ids)
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [TableStep(self, row) for row in range(*idx.indices(self._size))]
+        if idx<0:
+            idx += self._size
+        if idx<0 or idx>=self._size:
+            raise IndexError('step table index out of range')
+        return TableStep(self, idx)
+
+    def __iter__(self):
+        for row in range(self._size):
+            yield TableStep(self, row)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Lookups are rebuilt when the table is loaded since functions are not always
+        # hashable in the same way after they are unpickled
+        del state['_func_lookup']
+        del state['_tag_lookup']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._func_lookup = {}
+        for idx, func in enumerate(self.funcs):
+            try:
+                self._func_lookup[func] = idx
+            except TypeError:
+                pass
+        self._tag_lookup = dict([(tag, idx) for idx, tag in enumerate(self.tag_names)])
+
+    def _intern_func(self, func):
+        try:
+            return self._func_lookup[func]
+        except KeyError:
+            pass
+        except TypeError:
+            # Unhashable callable
+            for idx, f in enumerate(self.funcs):
+                if f is func:
+                    return idx
+            self.funcs.append(func)
+            return len(self.funcs)-1
+        self.funcs.append(func)
+        idx = self._func_lookup[func] = len(self.funcs)-1
+        return idx
+
+    def _get_tag_bits(self, tags):
+        bits = 0
+        for tag in tags:
+            if tag not in self._tag_lookup:
+                self._tag_lookup[tag] = len(self.tag_names)
+                self.tag_names.append(tag)
+            bits |= 1<<self._tag_lookup[tag]
+        if bits>=1<<64 and isinstance(self.tag_bits, array.array):
+            # More than 64 different tags do not fit in the array
+            self.tag_bits = list(self.tag_bits)
+        return bits
+
+    def _add_column(self, name):
+        self.columns[name] = [_MISSING]*self._size
+
+    def _append_rows(self, func_idx, kwargs_idx, bits, nrows, step_ids=None):
+        self.func_idx.extend(array.array('I', [func_idx])*nrows)
+        self.kwargs_idx.extend(array.array('I', [kwargs_idx])*nrows)
+        if isinstance(self.tag_bits, list):
+            self.tag_bits.extend([bits]*nrows)
+        else:
+            self.tag_bits.extend(array.array('Q', [bits])*nrows)
+        self.status.extend(array.array('b', [0])*nrows)
+        if step_ids is not None and self.step_ids is None:
+            self.step_ids = [None]*self._size
+        if self.step_ids is not None:
+            self.step_ids.extend([None]*nrows if step_ids is None else step_ids)
+        self._size += nrows
+
+    def extend(self, func, func_kwargs=None, columns=None, tags=None, step_ids=None):
+        """
+        Add one step for each row of ``columns`` (see `StepTable`). The columns
+        passed to an empty table are used without copying them, so they should not
+        be changed afterwards.
+        """
+        from datapyp.core import PipelineError
+        if func_kwargs is None:
+            func_kwargs = {}
+        if columns is None:
+            columns = {}
+        if tags is None:
+            tags = []
+        lengths = set([len(values) for values in columns.values()])
+        if len(lengths)>1:
+            raise PipelineError('All of the columns must have the same length')
+        nrows = lengths.pop() if len(lengths)>0 else 0
+        if step_ids is not None and len(step_ids)!=nrows:
+            raise PipelineError('step_ids must have one id for each row')
+        start = self._size
+        func_idx = self._intern_func(func)
+        self.base_kwargs.append(dict(func_kwargs))
+        kwargs_idx = len(self.base_kwargs)-1
+        self._base_for_func.setdefault(func_idx, kwargs_idx)
+        self._append_rows(func_idx, kwargs_idx, self._get_tag_bits(tags), nrows, step_ids)
+        for name, values in columns.items():
+            if start==0 and name not in self.columns:
+                # Use the column as it is, which is only copied if rows are added later
+                self.columns[name] = values
+                self._borrowed.add(name)
+                continue
+            if name not in self.columns:
+                self.columns[name] = [_MISSING]*start
+            self._get_list_column(name).extend(values)
+        # Columns that were not given are not overridden in the new rows
+        for name, column in self.columns.items():
+            if name not in columns:
+                self._get_list_column(name).extend([_MISSING]*nrows)
+
+    def _get_list_column(self, name):
+        column = self.columns[name]
+        if not isinstance(column, list) or name in self._borrowed:
+            column = self.columns[name] = [
+                value.item() if hasattr(value, 'item') else value for value in column]
+            self._borrowed.discard(name)
+        return column
+
+    def append(self, step):
+        """
+        Add a step to the table. Only the keyword arguments that are different from
+        the first keyword arguments used with the same function are stored for the
+        new step.
+
+        Parameters
+        ----------
+        step: `.PipelineStep`
+            Step to add
+        """
+        func_idx = self._intern_func(step.func)
+        func_kwargs = step.func_kwargs
+        kwargs_idx = self._base_for_func.get(func_idx)
+        overrides = None
+        if kwargs_idx is not None:
+            base = self.base_kwargs[kwargs_idx]
+            if len(func_kwargs)==len(base) and all([name in base for name in func_kwargs]):
+                overrides = dict([(name, value) for name, value in func_kwargs.items()
+                    if base[name] is not value and not _equal(base[name], value)])
+                # Only share the keyword arguments if most of them are the same
+                if len(overrides)*2>len(func_kwargs):
+                    overrides = None
+        if overrides is None:
+            self.base_kwargs.append(dict(func_kwargs))
+            kwargs_idx = len(self.base_kwargs)-1
+            self._base_for_func.setdefault(func_idx, kwargs_idx)
+            overrides = {}
+        for name in overrides:
+            if name not in self.columns:
+                self._add_column(name)
+        row = self._size
+        self._append_rows(func_idx, kwargs_idx, self._get_tag_bits(step.tags), 1,
+            None if step.step_id is None else [step.step_id])
+        for name, column in self.columns.items():
+            self._get_list_column(name).append(overrides.get(name, _MISSING))
+        if step.results is not None:
+            self.set_results(row, step.results)
+        for name, default in self.defaults.items():
+            value = getattr(step, name, default)
+            if value is not default and not _equal(value, default):
+                self.attrs.setdefault(row, {})[name] = value
+
+    def get_func_kwargs(self, row):
+        """
+        Keyword arguments of the step in ``row``
+        """
+        func_kwargs = dict(self.base_kwargs[self.kwargs_idx[row]])
+        for name, column in self.columns.items():
+            value = column[row]
+            if value is not _MISSING:
+                func_kwargs[name] = value.item() if hasattr(value, 'item') else value
+        return func_kwargs
+
+    def get_stacked_kwargs(self, rows):
+        """
+        Keyword arguments of the steps in ``rows``, with a list of the value for each
+        step for every keyword (see `datapyp.batch.stack_kwargs`)
+        """
+        from datapyp.core import PipelineError
+        kwargs_idx = set([self.kwargs_idx[row] for row in rows])
+        if len(kwargs_idx)==1:
+            base = self.base_kwargs[kwargs_idx.pop()]
+            stacked = dict([(name, [value]*len(rows)) for name, value in base.items()])
+        else:
+            stacked = {}
+            for n, row in enumerate(rows):
+                for name, value in self.base_kwargs[self.kwargs_idx[row]].items():
+                    stacked.setdefault(name, [_MISSING]*len(rows))[n] = value
+        for name, column in self.columns.items():
+            if hasattr(column, 'dtype'):
+                # Select all of the rows from a NumPy array at once
+                values = column[list(rows)].tolist()
+            else:
+                values = [column[row] for row in rows]
+            if name not in stacked:
+                stacked[name] = values
+            elif isinstance(column, list) and name not in self._borrowed:
+                # Only the columns created by the table have missing values
+                stacked[name] = [old if value is _MISSING else value
+                    for old, value in zip(stacked[name], values)]
+            else:
+                stacked[name] = values
+        for name, values in stacked.items():
+            if any([value is _MISSING for value in values]):
+                raise PipelineError(
+                    "Steps in a batch must use the same keywords, missing '{0}'".format(
+                        name))
+        return stacked
+
+    def get_tags(self, row):
+        """
+        Tags of the step in ``row``
+        """
+        bits = self.tag_bits[row]
+        return [tag for idx, tag in enumerate(self.tag_names) if bits>>idx & 1]
+
+    def get_results(self, row):
+        """
+        Results of the step in ``row``
+        """
+        if row in self.results:
+            return self.results[row]
+        code = self.status[row]
+        if code==0:
+            return None
+        results = {'status': STATUSES[code]}
+        for name, column in self.result_columns.items():
+            if row<len(column) and column[row] is not _MISSING:
+                results[name] = column[row]
+        return results
+
+    def set_results(self, row, results):
+        """
+        Save the results of the step in ``row``. The status is stored as a code and the
+        other values are stored in `result_columns`.
+        """
+        self.results.pop(row, None)
+        status = results.get('status') if isinstance(results, dict) else None
+        if status is None or status not in _STATUS_CODES:
+            results_dict = {}
+        else:
+            results_dict = results
+        # Clear the values from any previous results
+        for name, column in self.result_columns.items():
+            if name not in results_dict and row<len(column):
+                column[row] = _MISSING
+        if results is None:
+            self.status[row] = 0
+            return
+        if results_dict is not results:
+            self.status[row] = _STATUS_CODES['unknown']
+            self.results[row] = results
+            return
+        self.status[row] = _STATUS_CODES[status]
+        for name, value in results.items():
+            if name=='status':
+                continue
+            column = self.result_columns.get(name)
+            if column is None:
+                column = self.result_columns[name] = []
+            if len(column)<=row:
+                column.extend([_MISSING]*(row+1-len(column)))
+            column[row] = value
+
+    def get_results_columns(self, names=None, missing=None):
+        """
+        Results of every step as columns
+
+        Parameters
+        ----------
+        names: list (optional)
+            Names of the values in the results to include. By default every value
+            returned by any of the steps is included.
+        missing: object (optional)
+            Value used for steps that did not return a value. The default is ``None``.
+
+        Returns
+        -------
+        columns: dict
+            ``step_id`` and ``status`` of each step, along with a list for each of the
+            ``names``
+        """
+        if names is None:
+            names = list(self.result_columns)
+            for results in self.results.values():
+                if isinstance(results, dict):
+                    names.extend([name for name in results
+                        if name!='status' and name not in names])
+        columns = {
+            'step_id': [self.get_attr(row, 'step_id') for row in range(self._size)],
+            'status': [STATUSES[code] for code in self.status]
+        }
+        for name in names:
+            column = self.result_columns.get(name, [])
+            values = [missing]*self._size
+            for row, value in enumerate(column):
+                if value is not _MISSING:
+                    values[row] = value
+            columns[name] = values
+        for row, results in self.results.items():
+            if not isinstance(results, dict):
+                continue
+            columns['status'][row] = results.get('status')
+            for name in names:
+                columns[name][row] = results.get(name, missing)
+        return columns
+
+    def get_attr(self, row, name):
+        """
+        Get an attribute of the step in ``row``
+        """
+        if name in self.defaults:
+            attrs = self.attrs.get(row)
+            if attrs is not None and name in attrs:
+                return attrs[name]
+            return self.defaults[name]
+        if name=='func':
+            return self.funcs[self.func_idx[row]]
+        if name=='step_id':
+            if self.step_ids is None or self.step_ids[row] is None:
+                return row
+            return self.step_ids[row]
+        if name=='results':
+            return self.get_results(row)
+        if name=='func_kwargs':
+            return self.get_func_kwargs(row)
+        if name=='tags':
+            return self.get_tags(row)
+        raise AttributeError('TableStep has no attribute {0!r}'.format(name))
+
+    def set_attr(self, row, name, value):
+        """
+        Set an attribute of the step in ``row``
+        """
+        if name=='results':
+            self.set_results(row, value)
+        elif name=='step_id':
+            if self.step_ids is None:
+                self.step_ids = [None]*self._size
+            self.step_ids[row] = value
+        elif name in self.defaults:
+            self.attrs.setdefault(row, {})[name] = value
+        else:
+            raise AttributeError('Cannot set {0!r} for a single step in a StepTable'.format(
+                name))
+
+def _equal(a, b):
+    try:
+        return bool(a==b)
+    except Exception:
+        return False
@@ -0,0 +1,434 @@
+# Copyright 2015 Fred Moolekamp
+# BSD 3-clause license
+"""
+Select steps using boolean expressions of their tags, for example
+``'reduce and not (test or debug*)'``
+"""
+import re
+import logging
+from fnmatch import fnmatchcase
+
+logger = logging.getLogger('datapyp.tags')
+
+_TOKEN = re.compile(r'\s*(\(|\)|[^\s()]+)')
+_WILDCARDS = re.compile(r'[*?\[]')
+
+def parse_tag_expression(expression):
+    """
+    Parse a tag expression. Tags are combined with ``and``, ``or``, ``not`` and
+    parentheses, where ``not`` binds the tightest and ``or`` the loosest. A tag can
+    contain the wildcards ``*``, ``?`` and ``[...]`` (see `fnmatch`), which match
+    any tag with the same pattern.
+
+    Returns
+    -------
+    node: tuple
+        Parsed expression, where each node is either ``('tag', pattern)``,
+        ``('not', node)``, ``('and', node, node)`` or ``('or', node, node)``
+    """
+    from datapyp.core import PipelineError
+    tokens = _TOKEN.findall(expression)
+    if len(''.join(tokens))!=len(re.sub(r'\s', '', expression)):
+        raise PipelineError('Invalid tag expression {0!r}'.format(expression))
+    position = [0]
+
+    def peek():
+        if position[0]<len(tokens):
+            return tokens[position[0]]
+        return None
+
+    def take():
+        token = peek()
+        if token is None:
+            raise PipelineError('Unexpected end of tag expression {0!r}'.format(expression))
+        position[0] += 1
+        return token
+
+    def parse_or():
+        node = parse_and()
+        while peek()=='or':
+            take()
+            node = ('or', node, parse_and())
+        return node
+
+    def parse_and():
+        node = parse_not()
+        while peek()=='and':
+            take()
+            node = ('and', node, parse_not())
+        return node
+
+    def parse_not():
+        token = take()
+        if token=='not':
+            return ('not', parse_not())
+        if token=='(':
+            node = parse_or()
+            if take()!=')':
+                raise PipelineError("Missing ')' in tag expression {0!r}".format(
+                    expression))
+            return node
+        if token in [')', 'and', 'or']:
+            raise PipelineError('Unexpected {0!r} in tag expression {1!r}'.format(
+                token, expression))
+        return ('tag', token)
+
+    node = parse_or()
+    if peek() is not None:
+        raise PipelineError('Unexpected {0!r} in tag expression {1!r}'.format(
+            peek(), expression))
+    return node
+
+def build_tag_query(run_tags=(), ignore_tags=(), tag_expr=None):
+    """
+    Combine the ``run_tags``, ``ignore_tags`` and ``tag_expr`` parameters of
+    `.Pipeline.run` into a single parsed expression. Tags in ``run_tags`` and
+    ``ignore_tags`` are matched exactly, using an ``('any', tags)`` node that matches
+    steps with any of the ``tags``.
+
+    Returns
+    -------
+    node: tuple
+        Parsed expression (see `parse_tag_expression`), or ``None`` if every
+        step is selected
+    """
+    node = None
+    if len(run_tags)>0:
+        node = ('any', frozenset(run_tags))
+    if tag_expr is not None:
+        expr_node = parse_tag_expression(tag_expr)
+        node = expr_node if node is None else ('and', node, expr_node)
+    if len(ignore_tags)>0:
+        ignore_node = ('not', ('any', frozenset(ignore_tags)))
+        node = ignore_node if node is None else ('and', node, ignore_node)
+    return node
+
+def match_tags(node, tags):
+    """
+    Whether or not a step with ``tags`` is selected by the parsed expression ``node``
+    """
+    op = node[0]
+    if op=='tag':
+        if _WILDCARDS.search(node[1]) is None:
+            return node[1] in tags
+        return any([fnmatchcase(tag, node[1]) for tag in tags])
+    if op=='any':
+        return not node[1].isdisjoint(tags)
+    if op=='not':
+        return not match_tags(node[1], tags)
+    if op=='and':
+        return match_tags(node[1], tags) and match_tags(node[2], tags)
+    return match_tags(node[1], tags) or match_tags(node[2], tags)
+
+class TagList(list):
+    """
+    Tags of a step. Each `TagIndex` that contains the step is told when the tags
+    change, so the index never has to check the tags of every step.
+    """
+    __slots__ = ('_indexes',)
+
+    def __init__(self, tags=()):
+        list.__init__(self, tags)
+        # Indexes that contain the step, which are only created when the step is indexed
+        self._indexes = None
+
+    def __reduce__(self):
+        # The indexes are not saved, they are rebuilt when they are needed
+        return (TagList, (list(self),))
+
+    def _changed(self):
+        if self._indexes:
+            for index in self._indexes:
+                index.tags_changed(self)
+
+def _changes_tags(name):
+    method = getattr(list, name)
+    def changed(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        self._changed()
+        return result
+    changed.__name__ = name
+    changed.__doc__ = method.__doc__
+    return changed
+
+for _name in ['append', 'extend', 'insert', 'remove', 'pop', 'clear', 'sort',
+        'reverse', '__setitem__', '__delitem__', '__iadd__', '__imul__']:
+    setattr(TagList, _name, _changes_tags(_name))
+
+def get_step_tags(step):
+    return step._tags
+
+def set_step_tags(step, tags):
+    """
+    Set the tags of a step, which are copied into a new `TagList`. Any index that
+    contained the old tags is updated.
+    """
+    if tags is None:
+        tags = []
+    old_tags = getattr(step, '_tags', None)
+    step._tags = TagList(tags)
+    if isinstance(old_tags, TagList) and old_tags._indexes:
+        for index in list(old_tags._indexes):
+            index.tags_replaced(old_tags, step._tags)
+
+class TagIndex:
+    """
+    Inverted index from each tag to the positions of the steps with that tag, so that
+    steps can be selected with set operations instead of checking every step.
+
+    The index is kept up to date by the `StepList` that owns it, and by the `TagList`
+    of each step, so only the steps that are added, removed or given new tags are
+    indexed again.
+    """
+    def __init__(self, steps=()):
+        """
+        Parameters
+        ----------
+        steps: list (optional)
+            Steps to index
+        """
+        self.positions = {}
+        # Set of the tags and the list they were copied from at each position. A set
+        # is used since a step can have the same tag more than once.
+        self.tags = []
+        self.tag_lists = []
+        # Positions of the steps with each `TagList`, by the id of the list
+        self._watched = {}
+        for step in steps:
+            self.append(step)
+
+    @property
+    def size(self):
+        return len(self.tags)
+
+    def _add(self, idx):
+        for tag in self.tags[idx]:
+            self.positions.setdefault(tag, set()).add(idx)
+
+    def _remove(self, idx):
+        for tag in self.tags[idx]:
+            positions = self.positions[tag]
+            positions.discard(idx)
+            if len(positions)==0:
+                del self.positions[tag]
+
+    def _watch(self, idx):
+        tag_list = self.tag_lists[idx]
+        if not isinstance(tag_list, TagList):
+            return
+        positions = self._watched.get(id(tag_list))
+        if positions is None:
+            positions = self._watched[id(tag_list)] = set()
+            if tag_list._indexes is None:
+                tag_list._indexes = []
+            tag_list._indexes.append(self)
+        positions.add(idx)
+
+    def _unwatch(self, idx):
+        tag_list = self.tag_lists[idx]
+        if not isinstance(tag_list, TagList):
+            return
+        positions = self._watched[id(tag_list)]
+        positions.discard(idx)
+        if len(positions)==0:
+            del self._watched[id(tag_list)]
+            tag_list._indexes.remove(self)
+
+    def append(self, step):
+        """
+        Index a step added to the end of the list of steps
+        """
+        tag_list = step.tags
+        self.tags.append(frozenset(tag_list))
+        self.tag_lists.append(tag_list)
+        idx = len(self.tags)-1
+        self._add(idx)
+        self._watch(idx)
+
+    def pop(self):
+        """
+        Remove the last step from the index
+        """
+        idx = len(self.tags)-1
+        self._remove(idx)
+        self._unwatch(idx)
+        self.tags.pop()
+        self.tag_lists.pop()
+
+    def replace(self, idx, step):
+        """
+        Index the step that replaced the step at position ``idx``
+        """
+        self._remove(idx)
+        self._unwatch(idx)
+        tag_list = step.tags
+        self.tags[idx] = frozenset(tag_list)
+        self.tag_lists[idx] = tag_list
+        self._add(idx)
+        self._watch(idx)
+
+    def tags_changed(self, tag_list):
+        """
+        Index the steps whose tags were changed in place
+        """
+        for idx in self._watched.get(id(tag_list), ()):
+            self._remove(idx)
+            self.tags[idx] = frozenset(tag_list)
+            self._add(idx)
+
+    def tags_replaced(self, old_tags, new_tags):
+        """
+        Index the steps that were given a new `TagList`
+        """
+        positions = list(self._watched.get(id(old_tags), ()))
+        for idx in positions:
+            self._unwatch(idx)
+            self._remove(idx)
+            self.tags[idx] = frozenset(new_tags)
+            self.tag_lists[idx] = new_tags
+            self._add(idx)
+            self._watch(idx)
+
+    def detach(self):
+        """
+        Stop receiving changes to the tags of the steps
+        """
+        for positions in self._watched.values():
+            self.tag_lists[next(iter(positions))]._indexes.remove(self)
+        self._watched = {}
+
+    def _get_tag(self, pattern):
+        if _WILDCARDS.search(pattern) is None:
+            return self.positions.get(pattern, set())
+        selected = set()
+        for tag, positions in self.positions.items():
+            if fnmatchcase(tag, pattern):
+                selected |= positions
+        return selected
+
+    def select(self, node):
+        """
+        Positions of the steps selected by the parsed expression ``node``
+        (see `parse_tag_expression`)
+        """
+        op = node[0]
+        if op=='tag':
+            return set(self._get_tag(node[1]))
+        if op=='any':
+            selected = set()
+            for tag in node[1]:
+                selected |= self.positions.get(tag, set())
+            return selected
+        if op=='not':
+            return set(range(self.size))-self.select(node[1])
+        if op=='and':
+            # Avoid building the set of every step for 'x and not y'
+            if node[2][0]=='not':
+                return self.select(node[1])-self.select(node[2][1])
+            if node[1][0]=='not':
+                return self.select(node[2])-self.select(node[1][1])
+            return self.select(node[1]) & self.select(node[2])
+        return self.select(node[1]) | self.select(node[2])
+
+class StepList(list):
+    """
+    List of the steps in a `.StepContainer` that keeps the container's `TagIndex` up
+    to date. The index is created the first time steps are selected. After that,
+    steps that are appended, replaced or removed from the end are indexed
+    immediately, while other changes to the order of the steps (such as inserting a
+    step in the middle) rebuild the index the next time it is used.
+    """
+    __slots__ = ('_index',)
+
+    def __init__(self, steps=()):
+        list.__init__(self, steps)
+        self._index = None
+
+    def __reduce__(self):
+        return (StepList, (list(self),))
+
+    def get_index(self):
+        """
+        Get the `TagIndex` of the steps
+        """
+        if self._index is None:
+            self._index = TagIndex(self)
+        return self._index
+
+    def _reset_index(self):
+        if self._index is not None:
+            self._index.detach()
+            self._index = None
+
+    def append(self, step):
+        list.append(self, step)
+        if self._index is not None:
+            self._index.append(step)
+
+    def extend(self, steps):
+        start = len(self)
+        list.extend(self, steps)
+        if self._index is not None:
+            for idx in range(start, len(self)):
+                self._index.append(self[idx])
+
+    def __iadd__(self, steps):
+        self.extend(steps)
+        return self
+
+    def insert(self, idx, step):
+        if idx>=len(self):
+            self.append(step)
+        else:
+            list.insert(self, idx, step)
+            self._reset_index()
+
+    def pop(self, idx=-1):
+        last = idx==-1 or idx==len(self)-1
+        step = list.pop(self, idx)
+        if self._index is not None:
+            if last:
+                self._index.pop()
+            else:
+                self._reset_index()
+        return step
+
+    def __setitem__(self, idx, value):
+        list.__setitem__(self, idx, value)
+        if self._index is None:
+            return
+        if isinstance(idx, slice):
+            self._reset_index()
+        else:
+            self._index.replace(idx if idx>=0 else idx+len(self), value)
+
+    def __delitem__(self, idx):
+        size = len(self)
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(size)
+            # Removing the steps at the end doesn't change the position of other steps
+            at_end = step==1 and stop>=size
+        else:
+            start = idx if idx>=0 else idx+size
+            at_end = start==size-1
+        list.__delitem__(self, idx)
+        if self._index is None:
+            return
+        if at_end:
+            while self._index.size>max(start, len(self)):
+                self._index.pop()
+        else:
+            self._reset_index()
+
+def _resets_index(name):
+    method = getattr(list, name)
+    def reset(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        self._reset_index()
+        return result
+    reset.__name__ = name
+    reset.__doc__ = method.__doc__
+    return reset
+
+for _name in ['remove', 'clear', 'sort', 'reverse', '__imul__']:
+    setattr(StepList, _name, _resets_index(_name))
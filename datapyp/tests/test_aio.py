@@ -0,0 +1,76 @@
+# Copyright 2015 Fred Moolekamp
+# BSD 3-clause license
+import asyncio
+import threading
+
+import pytest
+
+from datapyp.core import Pipeline, PipelineError
+from datapyp.aio import AsyncStep, run_coroutine
+
+running = []
+
+async def fetch(x, t=0):
+    running.append(x)
+    try:
+        await asyncio.sleep(t)
+        active = len(running)
+    finally:
+        running.remove(x)
+    return {'status': 'success', 'x': x, 'active': active}
+
+def add_one(x):
+    return {'status': 'success', 'x': x+1}
+
+def test_coroutine_step():
+    pipeline = Pipeline()
+    pipeline.add_step(fetch, x=1)
+    pipeline.add_step(add_one, x=1)
+    pipeline.run()
+    assert [s.results['x'] for s in pipeline.steps]==[1, 2]
+
+def test_async_step():
+    pipeline = Pipeline()
+    steps = [{'func': fetch, 'func_kwargs': {'x': x, 't': 0.01}} for x in range(20)]
+    steps.append({'func': add_one, 'func_kwargs': {'x': 20}})
+    pipeline.add_step(AsyncStep(concurrency=5, steps=steps))
+    pipeline.run()
+    results = [s.results for s in pipeline.steps[0].steps]
+    assert [r['x'] for r in results]==list(range(20))+[21]
+    # No more than concurrency steps are awaited at the same time
+    assert max([r.get('active', 0) for r in results])<=5
+    assert pipeline.steps[0].results['status']=='success'
+
+def test_async_step_timeout():
+    pipeline = Pipeline()
+    pipeline.add_step(AsyncStep(steps=[
+        {'func': fetch, 'func_kwargs': {'x': x, 't': t}, 'ignore_errors': True}
+        for x, t in [(0, 0), (1, 30)]], timeout=0.1))
+    pipeline.run()
+    statuses = [s.results['status'] for s in pipeline.steps[0].steps]
+    assert statuses==['success', 'timeout']
+
+def test_arun():
+    loops = []
+    async def in_loop(x):
+        loops.append(asyncio.get_running_loop())
+        return {'status': 'success', 'x': x}
+    pipeline = Pipeline()
+    pipeline.add_step(in_loop, x=0)
+    pipeline.add_step(AsyncStep(steps=[{'func': in_loop, 'func_kwargs': {'x': x}}
+        for x in range(3)]))
+
+    async def main():
+        await pipeline.arun()
+        return asyncio.get_running_loop(), threading.current_thread()
+    loop, thread = asyncio.run(main())
+    # Coroutine steps are run in the event loop that called arun
+    assert loops==[loop]*4
+    assert [s.results['x'] for s in pipeline.steps[1].steps]==[0, 1, 2]
+    assert pipeline._loop is None
+
+def test_run_in_loop():
+    async def main():
+        with pytest.raises(PipelineError):
+            run_coroutine(fetch(0))
+    asyncio.run(main())
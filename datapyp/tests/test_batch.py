@@ -0,0 +1,68 @@
+# Copyright 2015 Fred Moolekamp
+# BSD 3-clause license
+import pytest
+
+from datapyp.core import Pipeline, MultiprocessStep, PipelineError
+from datapyp.batch import stack_kwargs, unstack_kwargs, split_results, group_keys
+from datapyp.table import StepTable
+
+batch_sizes = []
+
+def add(x, y):
+    return {'status': 'success', 'total': x+y}
+
+def add_batch(x, y):
+    batch_sizes.append(len(x))
+    return {'status': 'success', 'total': [a+b for a, b in zip(x, y)]}
+
+def broken_batch(x, y):
+    raise ValueError('batch failed')
+
+def test_stack_kwargs():
+    kwargs = stack_kwargs([{'x': 1, 'global_vars': 'g'}, {'x': 2, 'global_vars': 'g'}])
+    assert kwargs=={'x': [1, 2], 'global_vars': 'g'}
+    assert unstack_kwargs(kwargs, 1)=={'x': 2, 'global_vars': 'g'}
+    with pytest.raises(PipelineError):
+        stack_kwargs([{'x': 1}, {'x': 2, 'y': 3}])
+
+def test_split_results():
+    assert split_results({'status': 'success', 'x': [1, 2]}, 2)==[
+        {'status': 'success', 'x': 1}, {'status': 'success', 'x': 2}]
+    assert split_results([{'status': 'success'}, None], 2)==[{'status': 'success'}, None]
+    with pytest.raises(PipelineError):
+        split_results({'x': [1, 2]}, 3)
+    with pytest.raises(PipelineError):
+        split_results([1, 2], 3)
+
+def test_group_keys():
+    funcs = [add, add, broken_batch, add, add]
+    keys = group_keys(range(5), funcs.__getitem__, {add: add_batch}, 2, {3: 1})
+    assert keys==[(0, 1), 2, 3, (4,)]
+
+@pytest.mark.parametrize('use_table', [False, True])
+def test_batch_step(use_table):
+    del batch_sizes[:]
+    columns = {'x': list(range(5)), 'y': [10]*5}
+    if use_table:
+        steps = StepTable(add, columns=columns)
+    else:
+        steps = [{'func': add, 'func_kwargs': {'x': x, 'y': y}}
+            for x, y in zip(columns['x'], columns['y'])]
+    pipeline = Pipeline(executor='thread')
+    step = MultiprocessStep(steps=steps, pool_size=2, batch_funcs={add: add_batch},
+        batch_size=2)
+    pipeline.add_step(step)
+    pipeline.run()
+    assert sorted(batch_sizes)==[1, 2, 2]
+    assert [s.results['total'] for s in step.steps]==list(range(10, 15))
+
+def test_broken_batch():
+    # The steps are run separately when the batch function fails
+    steps = [{'func': add, 'func_kwargs': {'x': x, 'y': 1}} for x in range(3)]
+    pipeline = Pipeline(executor='serial')
+    step = MultiprocessStep(steps=steps, batch_funcs={add: broken_batch})
+    pipeline.add_step(step)
+    pipeline.run()
+    assert [s.results['total'] for s in step.steps]==[1, 2, 3]
+    with pytest.raises(PipelineError):
+        MultiprocessStep(steps=steps, batch_size=0)
@@ -0,0 +1,120 @@
+# Copyright 2015 Fred Moolekamp
+# BSD 3-clause license
+import os
+import time
+import threading
+
+import pytest
+
+from datapyp.core import Pipeline, MultiprocessStep
+from datapyp.cache import StepCache
+
+calls = []
+
+def double(x):
+    calls.append(x)
+    return {'status': 'success', 'y': 2*x}
+
+def uses_globals(x, global_vars):
+    return {'status': 'success'}
+
+def set_mtime(filename, mtime):
+    os.utime(filename, (mtime, mtime))
+
+def test_cache_hit_miss(tmpdir):
+    cache = StepCache(str(tmpdir))
+    key = cache.get_key(double, {'x': 1})
+    assert key==cache.get_key(double, {'x': 1})
+    assert key!=cache.get_key(double, {'x': 2})
+    assert cache.get_key(uses_globals, {'x': 1, 'global_vars': None}) is None
+    assert cache.get(key)==(False, None)
+    assert cache.put(key, {'status': 'success', 'y': 2})
+    assert cache.get(key)==(True, {'status': 'success', 'y': 2})
+    stats = cache.get_stats()
+    assert (stats['hits'], stats['misses'])==(1, 1)
+    cache.clear()
+    assert cache.get(key)==(False, None)
+
+def test_cache_key_normalized(tmpdir):
+    cache = StepCache(str(tmpdir))
+    key = cache.get_key(double, {'x': {'a': 1, 2: 'b'}, 'y': set(['c', 'd'])})
+    assert key is not None
+    assert key==cache.get_key(double, {'y': set(['d', 'c']), 'x': {2: 'b', 'a': 1}})
+    assert key!=cache.get_key(double, {'x': {'a': 1, 2: 'c'}, 'y': set(['c', 'd'])})
+    assert cache.get_key(double, {'x': 1})!=cache.get_key(double, {'x': 1.0})
+    assert cache.get_key(double, {'x': [1, 2]})!=cache.get_key(double, {'x': (1, 2)})
+
+def test_cache_key_arrays(tmpdir):
+    np = pytest.importorskip('numpy')
+    cache = StepCache(str(tmpdir))
+    x = np.arange(6, dtype='i8').reshape(2, 3)
+    key = cache.get_key(double, {'x': x})
+    assert key==cache.get_key(double, {'x': np.asfortranarray(x)})
+    assert key==cache.get_key(double, {'x': x.astype('>i4')})
+    assert key!=cache.get_key(double, {'x': x.astype('f8')})
+    assert key!=cache.get_key(double, {'x': x.reshape(3, 2)})
+    assert cache.get_key(double, {'x': np.float32(1.5)})==cache.get_key(double, {'x': 1.5})
+
+def test_cache_partial_entry(tmpdir):
+    cache = StepCache(str(tmpdir))
+    key = cache.get_key(double, {'x': 1})
+    data = __import__('pickle').dumps({'status': 'success', 'y': 2}, 2)
+    with open(os.path.join(str(tmpdir), key+'.p'), 'wb') as f:
+        f.write(data[:len(data)//2])
+    # A truncated entry is a miss that is replaced by the next result
+    assert cache.get(key)==(False, None)
+    assert cache.put(key, {'status': 'success', 'y': 2})
+    assert cache.get(key)==(True, {'status': 'success', 'y': 2})
+    assert [f for f in os.listdir(str(tmpdir))]==[key+'.p']
+
+def test_cache_threads(tmpdir):
+    cache = StepCache(str(tmpdir))
+    keys = [cache.get_key(double, {'x': x}) for x in range(20)]
+    def use_cache(offset):
+        for key in keys[offset:]+keys[:offset]:
+            if not cache.get(key)[0]:
+                cache.put(key, {'status': 'success'})
+    threads = [threading.Thread(target=use_cache, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = cache.get_stats()
+    assert stats['hits']+stats['misses']==160
+    assert stats['size']==sum([os.path.getsize(os.path.join(str(tmpdir), f))
+        for f in os.listdir(str(tmpdir))])
+
+def test_cache_eviction(tmpdir):
+    cache = StepCache(str(tmpdir))
+    size = len(__import__('pickle').dumps({'status': 'success', 'y': 0}, 2))
+    cache.max_size = 2*size
+    keys = [cache.get_key(double, {'x': x}) for x in range(3)]
+    now = time.time()
+    for n, key in enumerate(keys):
+        cache.put(key, {'status': 'success', 'y': n})
+        set_mtime(os.path.join(str(tmpdir), key+'.p'), now-100+n)
+    # The least recently used result was removed
+    assert cache.get_stats()['evictions']==1
+    assert not cache.get(keys[0])[0]
+    assert cache.get(keys[2])[0]
+
+def test_pipeline_cache(tmpdir):
+    del calls[:]
+    path = str(tmpdir)
+    pipeline = Pipeline(paths={'log': path, 'temp': path, 'cache': path})
+    pipeline.add_step(double, x=1, cache=True)
+    pipeline.add_step(MultiprocessStep(steps=[{'func': double, 'func_kwargs': {'x': x},
+        'cache': True} for x in range(3)], executor='thread', pool_size=2))
+    pipeline.run()
+    # The result of double(x=1) is reused by the MultiprocessStep
+    assert sorted(calls)==[0, 1, 2]
+    assert pipeline.cache_stats['hits']==1
+    pipeline.run()
+    assert len(calls)==3
+    assert pipeline.cache_stats['hits']==4
+    assert [s.results['y'] for s in pipeline.steps[1].steps]==[0, 2, 4]
+    # Changing the keyword arguments invalidates the cached result
+    pipeline.steps[0].func_kwargs['x'] = 5
+    pipeline.run()
+    assert calls[3:]==[5]
+    assert pipeline.steps[0].results['y']==10
@@ -0,0 +1,46 @@
+# Copyright 2015 Fred Moolekamp
+# BSD 3-clause license
+import os
+
+import pytest
+
+from datapyp.core import Pipeline, load_pipeline
+from datapyp.checkpoint import CheckpointWriter
+
+def double(x):
+    return {'status': 'success', 'x': 2*x}
+
+def test_checkpoint_writer(tmpdir):
+    snapshot = str(tmpdir.join('pipeline.p'))
+    journal = str(tmpdir.join('pipeline.journal'))
+    writer = CheckpointWriter()
+    for n in range(10):
+        writer.write(snapshot, str(n).encode())
+        writer.append(journal, str(n).encode())
+    assert writer.flush()
+    # Only the last snapshot matters, while every append is written in order
+    assert open(snapshot, 'rb').read()==b'9'
+    assert open(journal, 'rb').read()==b''.join([str(n).encode() for n in range(10)])
+    assert not os.path.isfile(snapshot+'.tmp')
+    assert writer.close()
+    with pytest.raises(ValueError):
+        writer.write(snapshot, b'')
+
+def test_writer_errors(tmpdir):
+    writer = CheckpointWriter()
+    with pytest.warns(UserWarning):
+        writer.write(str(tmpdir.join('missing', 'pipeline.p')), b'data')
+        assert not writer.flush()
+    assert len(writer.errors)==1
+    writer.close()
+
+@pytest.mark.parametrize('checkpoint', ['snapshot', 'journal'])
+def test_async_checkpoint(tmpdir, checkpoint):
+    path = str(tmpdir)
+    pipeline = Pipeline(paths={'log': path, 'temp': path})
+    for x in range(3):
+        pipeline.add_step(double, x=x)
+    pipeline.run(async_checkpoint=True, checkpoint=checkpoint)
+    loaded = load_pipeline(os.path.join(path, 'pipeline.p'))
+    assert [s.results['x'] for s in loaded.run_steps]==[0, 2, 4]
+    assert loaded.run_step_idx==3
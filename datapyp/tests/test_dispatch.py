@@ -0,0 +1,112 @@
+# Copyright 2015 Fred Moolekamp
+# BSD 3-clause license
+import os
+import time
+import threading
+
+import pytest
+
+from datapyp.core import Pipeline, MultiprocessStep, ThreadedStep, load_pipeline
+from datapyp.checkpoint import PipelineCheckpointer
+from datapyp.dispatch import TaskDispatcher
+from datapyp.executors import create_executor
+from datapyp.journal import PipelineJournal, get_journal_path
+
+def square(x):
+    return x*x
+
+def sleep_step(x, t=0):
+    time.sleep(t)
+    if x<0:
+        raise ValueError('step failed')
+    return {'status': 'success', 'x': x}
+
+def wait_for_others(x, total, logfile, pipeline):
+    """
+    Wait until the other steps in the same step have finished and record what the
+    pipeline has saved while this step is still running
+    """
+    step = pipeline.steps[0]
+    for n in range(500):
+        if step.progress is not None and step.progress['completed']>=total-1:
+            break
+        time.sleep(0.01)
+    journal = get_journal_path(logfile)
+    if os.path.isfile(journal):
+        records = list(PipelineJournal(journal).read())
+        saved = len([r for r in records if 'substep_idx' in r])
+    else:
+        snapshot = load_pipeline(logfile).steps[0]
+        saved = len([s for s in snapshot.steps if s.results is not None])
+    return {
+        'status': 'success',
+        'x': x,
+        'progress': step.progress,
+        'finished': len([s for s in step.steps if s.results is not None]),
+        'saved': saved
+    }
+
+@pytest.mark.parametrize('checkpoint', ['snapshot', 'journal'])
+def test_streamed_results(tmpdir, monkeypatch, checkpoint):
+    # Save a snapshot each time a sub-step finishes
+    monkeypatch.setattr(PipelineCheckpointer, 'substep_interval', -1)
+    path = str(tmpdir)
+    logfile = os.path.join(path, 'pipeline.p')
+    pipeline = Pipeline(paths={'log': path, 'temp': path})
+    steps = [{'func': wait_for_others, 'func_kwargs': {'x': -1, 'total': 6,
+        'logfile': logfile}}]
+    steps += [{'func': sleep_step, 'func_kwargs': {'x': x}} for x in range(5)]
+    pipeline.add_step(ThreadedStep(steps=steps, pool_size=2))
+    pipeline.run(checkpoint=checkpoint)
+    # The results of the other steps were saved while the first step was still running
+    results = pipeline.steps[0].steps[0].results
+    assert results['progress']['completed']==5
+    assert results['progress']['total']==6
+    assert results['finished']==5
+    assert results['saved']==5
+    assert pipeline.steps[0].progress['completed']==6
+
+def test_fail_fast():
+    pipeline = Pipeline(executor='thread')
+    steps = [{'func': sleep_step, 'func_kwargs': {'x': -1}}] + [
+        {'func': sleep_step, 'func_kwargs': {'x': x, 't': 0.1}} for x in range(20)]
+    pipeline.add_step(MultiprocessStep(steps=steps, pool_size=1,
+        error_policy='fail_fast'))
+    with pytest.raises(ValueError):
+        pipeline.run()
+    # The steps that had not started were never run
+    assert any([s.results is None for s in pipeline.steps[0].steps])
+
+def test_dispatcher_chunks():
+    executor = create_executor('thread', 2)
+    try:
+        dispatcher = TaskDispatcher(executor, square, max_active=2, chunksize='auto')
+        results = dispatcher.imap_unordered([(x, x) for x in range(50)])
+        assert sorted([(key, value) for key, success, value in results])==[
+            (x, x*x) for x in range(50)]
+        assert dispatcher.completed==50
+    finally:
+        executor.close()
+
+def test_speculative_copies():
+    # The first attempt hangs until a copy of the step has been run
+    attempts = []
+    copied = threading.Event()
+    def straggler(x):
+        attempts.append(x)
+        if len(attempts)==1:
+            copied.wait(10)
+        else:
+            copied.set()
+        return {'status': 'success', 'x': x, 'attempt': len(attempts)}
+    steps = [{'func': straggler, 'func_kwargs': {'x': -1}, 'idempotent': True}]
+    steps += [{'func': sleep_step, 'func_kwargs': {'x': x, 't': 0.01}} for x in range(6)]
+    pipeline = Pipeline()
+    pipeline.add_step(ThreadedStep(steps=steps, pool_size=2, speculative=2))
+    start = time.time()
+    pipeline.run()
+    assert time.time()-start<5
+    assert len(attempts)==2
+    # The result of the copy that finished first is kept
+    assert pipeline.steps[0].steps[0].results['attempt']==2
+    assert [s.results['x'] for s in pipeline.steps[0].steps]==list(range(-1, 6))
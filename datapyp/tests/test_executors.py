@@ -0,0 +1,276 @@
+# Copyright 2015 Fred Moolekamp
+# BSD 3-clause license
+import os
+import time
+import threading
+from functools import partial
+
+import pytest
+
+from datapyp.core import (Pipeline, PipelineStep, MultiprocessStep, ThreadedStep,
+    PipelineError)
+from datapyp import executors
+from datapyp.executors import create_executor, run_batch, get_func_ref, resolve_func
+
+def square(x):
+    return x*x
+
+def fail_odd(x):
+    if x%2==1:
+        raise ValueError('odd')
+    return x
+
+def sleep_step(x, t=0):
+    time.sleep(t)
+    if x<0:
+        raise ValueError('step failed')
+    return {'status': 'success', 'x': x}
+
+def get_pid(x):
+    return {'status': 'success', 'pid': os.getpid()}
+
+def record_init(filename, label):
+    with open(filename, 'a') as f:
+        f.write('{0} {1}\n'.format(label, os.getpid()))
+
+def record_executors(monkeypatch):
+    """
+    Record each executor created by a pipeline and whether it was closed
+    """
+    created = []
+    create = executors.create_executor
+    def create_recorded(*args, **kwargs):
+        executor = create(*args, **kwargs)
+        executor.closed = []
+        close = executor.close
+        terminate = executor.terminate
+        def record_close():
+            executor.closed.append('close')
+            close()
+        def record_terminate():
+            executor.closed.append('terminate')
+            terminate()
+        executor.close = record_close
+        executor.terminate = record_terminate
+        created.append(executor)
+        return executor
+    monkeypatch.setattr(executors, 'create_executor', create_recorded)
+    return created
+
+def test_shared_pool(monkeypatch):
+    created = record_executors(monkeypatch)
+    pipeline = Pipeline(executor='process')
+    for pool_size in [1, 2]:
+        pipeline.add_step(MultiprocessStep(steps=[{'func': get_pid, 'func_kwargs': {'x': x}}
+            for x in range(6)], pool_size=pool_size))
+    pipeline.run()
+    # One pool, sized for the largest step, ran both steps and was closed
+    assert len(created)==1
+    assert created[0].closed==['close']
+    assert pipeline._executors=={}
+    pids = set([s.results['pid'] for step in pipeline.steps for s in step.steps])
+    assert len(pids)<=2
+
+def test_pool_closed_on_error(monkeypatch):
+    created = record_executors(monkeypatch)
+    pipeline = Pipeline(executor='thread')
+    pipeline.add_step(MultiprocessStep(steps=[{'func': sleep_step, 'func_kwargs': {'x': x}}
+        for x in range(2)], pool_size=2))
+    pipeline.add_step(MultiprocessStep(steps=[{'func': sleep_step, 'func_kwargs': {'x': -1}}],
+        pool_size=2))
+    with pytest.raises(ValueError):
+        pipeline.run()
+    assert len(created)==1
+    assert created[0].closed[0]=='terminate'
+    assert pipeline._executors=={}
+
+def test_process_initializers(tmpdir):
+    filename = str(tmpdir.join('init.txt'))
+    pipeline = Pipeline(executor='process')
+    for label in ['a', 'b']:
+        # Both initializers are partials of the same function
+        pipeline.add_step(MultiprocessStep(steps=[{'func': get_pid, 'func_kwargs': {'x': x}}
+            for x in range(6)], pool_size=2, initializer=partial(record_init, filename,
+            label)))
+    pipeline.run()
+    with open(filename) as f:
+        calls = [tuple(line.split()) for line in f.read().splitlines()]
+    # Each initializer ran once in every worker that ran one of its steps
+    assert len(calls)==len(set(calls))
+    for label, step in zip(['a', 'b'], pipeline.steps):
+        pids = set([str(s.results['pid']) for s in step.steps])
+        assert set([pid for l, pid in calls if l==label])==pids
+
+def test_thread_initializers():
+    lock = threading.Lock()
+    calls = []
+    def build_initializer(label):
+        def init():
+            with lock:
+                calls.append((label, threading.current_thread().name))
+        return init
+    names = {}
+    def record(x, label):
+        with lock:
+            names.setdefault(label, set()).add(threading.current_thread().name)
+        return {'status': 'success'}
+    pipeline = Pipeline()
+    for label in ['a', 'b']:
+        # Closures with the same qualified name
+        pipeline.add_step(ThreadedStep(steps=[{'func': record,
+            'func_kwargs': {'x': x, 'label': label}} for x in range(6)], pool_size=2,
+            initializer=build_initializer(label)))
+    pipeline.run()
+    assert len(calls)==len(set(calls))
+    for label in ['a', 'b']:
+        assert set([name for l, name in calls if l==label])==names[label]
+
+def test_initializer_key_computed_once(monkeypatch):
+    keys = []
+    get_key = executors._get_initializer_key
+    def counted(initializer):
+        keys.append(initializer)
+        return get_key(initializer)
+    monkeypatch.setattr(executors, '_get_initializer_key', counted)
+    initializer = partial(square, 2)
+    for executor in ['serial', 'thread']:
+        pipeline = Pipeline(executor=executor)
+        pipeline.add_step(MultiprocessStep(steps=[{'func': get_pid,
+            'func_kwargs': {'x': x}} for x in range(6)], pool_size=2,
+            initializer=initializer))
+        pipeline.run()
+    # The key is computed once when the tasks are dispatched, not by every task
+    assert keys==[initializer]*2
+    prepared = executors.get_worker_initializer(initializer)
+    assert executors.get_worker_initializer(prepared) is prepared
+    executor = executors.create_executor('thread', 2)
+    assert executor.map(square, [1, 2, 3], prepared)==[1, 4, 9]
+    executor.close()
+    assert len(keys)==3
+
+class Scaler:
+    def __init__(self, scale):
+        self.scale = scale
+
+    def scaled(self, x):
+        return {'status': 'success', 'x': x*self.scale}
+
+    @staticmethod
+    def doubled(x):
+        return {'status': 'success', 'x': 2*x}
+
+    @classmethod
+    def tripled(cls, x):
+        return {'status': 'success', 'x': 3*x}
+
+class RecordingExecutor(executors.SerialExecutor):
+    """
+    Serial executor that keeps a copy of every task it receives, as if it were sent
+    to a worker in another process
+    """
+    in_process = False
+    tasks = []
+
+    def submit(self, func, args, callback, error_callback, initializer=None):
+        import pickle
+        RecordingExecutor.tasks.extend(args[1])
+        args = pickle.loads(pickle.dumps(args))
+        executors.SerialExecutor.submit(self, func, args, callback, error_callback,
+            initializer)
+
+def test_func_refs():
+    module = __name__
+    assert get_func_ref(sleep_step)==module+':sleep_step'
+    assert get_func_ref(Scaler.doubled)==module+':Scaler.doubled'
+    assert get_func_ref(Scaler.tripled)==module+':Scaler.tripled'
+    assert resolve_func(module+':sleep_step') is sleep_step
+    assert resolve_func(module+':Scaler.tripled')(x=1)=={'status': 'success', 'x': 3}
+    # Functions that cannot be imported by name are sent as they are
+    method = Scaler(4).scaled
+    func = lambda x: x
+    def closure(x):
+        return x
+    for f in [method, func, closure]:
+        assert get_func_ref(f) is f
+        assert resolve_func(f) is f
+    with pytest.raises(AttributeError):
+        resolve_func(module+':not_a_function')
+
+def test_task_payload(monkeypatch):
+    monkeypatch.setitem(executors.EXECUTORS, 'recording', RecordingExecutor)
+    monkeypatch.setattr(RecordingExecutor, 'tasks', [])
+    funcs = [sleep_step, Scaler.doubled, Scaler.tripled, Scaler(4).scaled]
+    pipeline = Pipeline(executor='recording')
+    pipeline.add_step(MultiprocessStep(steps=[{'func': func, 'func_kwargs': {'x': 1}}
+        for func in funcs]))
+    pipeline.run()
+    assert [s.results['x'] for s in pipeline.steps[0].steps]==[1, 2, 3, 4]
+    # Workers only receive a reference to each function and its keyword arguments
+    tasks = RecordingExecutor.tasks
+    module = __name__
+    assert [params[0] for params in tasks[:3]]==[
+        module+':sleep_step', module+':Scaler.doubled', module+':Scaler.tripled']
+    assert tasks[3][0]==funcs[3]
+    assert all([params[2]=={'x': 1} for params in tasks])
+    assert not any([isinstance(value, PipelineStep) for params in tasks
+        for value in params])
+
+def test_unpicklable_step():
+    # A closure cannot be sent to a worker process
+    def closure(x):
+        return {'status': 'success', 'x': x}
+    pipeline = Pipeline(executor='process')
+    pipeline.add_step(MultiprocessStep(steps=[{'func': closure, 'func_kwargs': {'x': 1}}],
+        pool_size=1))
+    with pytest.raises(Exception) as error:
+        pipeline.run()
+    assert 'pickle' in str(error.value).lower()
+
+def test_threaded_step():
+    # Threads share the pipeline's globals so functions do not need to be pickled
+    lock = threading.Lock()
+    names = set()
+    def record(x, global_vars):
+        with lock:
+            names.add(threading.current_thread().name)
+        return {'status': 'success', 'x': x*global_vars.scale}
+    pipeline = Pipeline(global_vars={'scale': 2})
+    pipeline.add_step(ThreadedStep(steps=[{'func': record, 'func_kwargs': {'x': x}}
+        for x in range(6)], pool_size=2))
+    pipeline.run()
+    assert pipeline.steps[0].executor=='thread'
+    assert [s.results['x'] for s in pipeline.steps[0].steps]==[0, 2, 4, 6, 8, 10]
+    assert threading.current_thread().name not in names
+
+@pytest.mark.parametrize('name', ['serial', 'thread', 'process', 'socket'])
+def test_executor(name):
+    executor = create_executor(name, 2)
+    try:
+        assert executor.map(square, [1, 2, 3])==[1, 4, 9]
+        results = []
+        errors = []
+        for x in range(4):
+            executor.submit(run_batch, (fail_odd, [x]), results.append, errors.append)
+        for n in range(100):
+            if len(results)==4:
+                break
+            time.sleep(0.05)
+        values = sorted([batch[0][:2] for batch in results], key=repr)
+        assert [v[0] for v in values].count(True)==2
+        assert all([isinstance(v[1], ValueError) for v in values if not v[0]])
+        assert len(errors)==0
+    finally:
+        executor.close()
+
+def test_unknown_executor():
+    with pytest.raises(PipelineError):
+        create_executor('unknown')
+
+@pytest.mark.parametrize('name', ['serial', 'thread', 'process'])
+def test_multiprocess_step(name):
+    pipeline = Pipeline(executor=name)
+    pipeline.add_step(MultiprocessStep(steps=[{'func': sleep_step, 'func_kwargs': {'x': x}}
+        for x in range(5)], pool_size=2, chunksize=2))
+    pipeline.run()
+    assert [s.results['x'] for s in pipeline.steps[0].steps]==list(range(5))
+    assert pipeline.steps[0].results['status']=='success'
@@ -0,0 +1,62 @@
+# Copyright 2015 Fred Moolekamp
+# BSD 3-clause license
+import os
+import time
+
+from datapyp.core import Pipeline
+from datapyp.freshness import find_fresh_steps, get_step_key
+
+calls = []
+
+def copy_file(src, dst):
+    calls.append(src)
+    with open(src) as f_in:
+        with open(dst, 'w') as f_out:
+            f_out.write(f_in.read())
+    return {'status': 'success'}
+
+def set_mtime(filename, mtime):
+    os.utime(filename, (mtime, mtime))
+
+def test_find_fresh_steps(tmpdir):
+    src = str(tmpdir.join('a.txt'))
+    mid = str(tmpdir.join('b.txt'))
+    dst = str(tmpdir.join('c.txt'))
+    now = time.time()
+    for n, filename in enumerate([src, mid, dst]):
+        open(filename, 'w').close()
+        set_mtime(filename, now-100+n)
+    pipeline = Pipeline(paths={'temp': str(tmpdir)})
+    pipeline.add_step(copy_file, src=src, dst=mid, inputs=[src], outputs=[mid])
+    pipeline.add_step(copy_file, src=mid, dst=dst, inputs=[mid], outputs=[dst])
+    fresh = find_fresh_steps(pipeline.steps)
+    assert fresh==set([get_step_key(step) for step in pipeline.steps])
+    # A newer input makes the step and every step that uses its outputs stale
+    set_mtime(src, now)
+    assert find_fresh_steps(pipeline.steps)==set()
+    set_mtime(src, now-100)
+    os.remove(dst)
+    assert find_fresh_steps(pipeline.steps)==set([get_step_key(pipeline.steps[0])])
+
+def test_pipeline_freshness(tmpdir):
+    del calls[:]
+    src = str(tmpdir.join('a.txt'))
+    dst = str(tmpdir.join('b.txt'))
+    with open(src, 'w') as f:
+        f.write('data')
+    pipeline = Pipeline(paths={'temp': str(tmpdir)})
+    pipeline.add_step(copy_file, src=src, dst=dst, inputs=[src], outputs=[dst])
+    pipeline.run(freshness='mtime')
+    pipeline.run(freshness='mtime')
+    assert calls==[src]
+    # With hashes, touching the input without changing it does not rerun the step
+    pipeline.run(freshness='hash')
+    set_mtime(src, time.time()+10)
+    pipeline.run(freshness='hash')
+    assert calls==[src, src]
+    set_mtime(src, time.time()+20)
+    pipeline.run(freshness='hash')
+    assert calls==[src, src]
+    set_mtime(src, time.time()+30)
+    pipeline.run(freshness='mtime')
+    assert calls==[src, src, src]
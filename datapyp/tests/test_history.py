@@ -0,0 +1,72 @@
+# Copyright 2015 Fred Moolekamp
+# BSD 3-clause license
+import os
+import time
+
+import pytest
+
+from datapyp.core import Pipeline, MultiprocessStep
+from datapyp.history import (RuntimeHistory, order_tasks, get_task_size,
+    get_history_path)
+
+calls = []
+
+def fast(x):
+    calls.append(('fast', x))
+    return {'status': 'success'}
+
+def slow(x):
+    calls.append(('slow', x))
+    time.sleep(0.05)
+    return {'status': 'success'}
+
+def test_estimate(tmpdir):
+    path = str(tmpdir.join('pipeline.history'))
+    history = RuntimeHistory(path, max_records=3)
+    assert history.estimate('func') is None
+    for size, duration in [(None, 100), (10, 2), (20, 3), (30, 4)]:
+        history.add('func', size, duration)
+    # The oldest record was discarded and the duration is linear in the size
+    assert len(history.records['func'])==3
+    assert history.estimate('func', 40)==pytest.approx(5)
+    assert history.estimate('func')==pytest.approx(1)
+    history.add('other', None, 2)
+    history.add('other', None, 4)
+    assert history.estimate('other', 100)==pytest.approx(3)
+    assert history.save()
+    loaded = RuntimeHistory(path)
+    assert loaded.records==history.records
+    with open(path, 'wb') as f:
+        f.write(b'corrupt')
+    with pytest.warns(UserWarning):
+        assert RuntimeHistory(path).records=={}
+
+def test_order_tasks(tmpdir):
+    tasks = [(0, 'a'), (1, 'b'), (2, 'c'), (3, 'd')]
+    # Tasks that have never been run go first, then the longest
+    assert order_tasks(tasks, {0: 1., 1: 5., 3: 2.})==[(2, 'c'), (1, 'b'), (3, 'd'),
+        (0, 'a')]
+    filename = str(tmpdir.join('data.txt'))
+    with open(filename, 'w') as f:
+        f.write('x'*10)
+    assert get_task_size({'x': 1, 'filename': filename})==10
+    assert get_task_size({'filenames': [filename, filename], 'y': 'missing'})==20
+    assert get_task_size({'x': 1}) is None
+
+def test_longest_first(tmpdir):
+    path = str(tmpdir)
+    def build_pipeline():
+        pipeline = Pipeline(paths={'log': path, 'temp': path}, executor='serial')
+        steps = [{'func': fast, 'func_kwargs': {'x': x}} for x in range(3)]
+        steps += [{'func': slow, 'func_kwargs': {'x': x}} for x in range(2)]
+        pipeline.add_step(MultiprocessStep(steps=steps, pool_size=1,
+            dispatch_order='longest_first'))
+        return pipeline
+    del calls[:]
+    build_pipeline().run()
+    assert [name for name, x in calls]==['fast']*3+['slow']*2
+    assert os.path.isfile(get_history_path(os.path.join(path, 'pipeline.p')))
+    # The steps that took the longest in the last run are started first
+    del calls[:]
+    build_pipeline().run()
+    assert [name for name, x in calls]==['slow']*2+['fast']*3
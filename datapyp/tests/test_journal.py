@@ -0,0 +1,182 @@
+# Copyright 2015 Fred Moolekamp
+# BSD 3-clause license
+import os
+import threading
+import warnings
+
+import pytest
+
+from datapyp import journal
+from datapyp.core import Pipeline, MultiprocessStep, load_pipeline
+from datapyp.journal import (PipelineJournal, get_journal_path, get_globals_state,
+    get_globals_delta)
+
+def scaled(x, scale, global_vars):
+    global_vars.total = x*scale
+    if x<0:
+        raise ValueError('step failed')
+    return {'status': 'success', 'x': x*scale}
+
+def add_total(x):
+    if x<0:
+        raise ValueError('step failed')
+    return {'status': 'success', 'global_updates': {'total': x, 'items': [x]}}
+
+def append_item(x, global_vars):
+    if x<0:
+        raise ValueError('step failed')
+    global_vars.items.append(x)
+    return {'status': 'success'}
+
+def build_pipeline(path, xs, scale=1):
+    pipeline = Pipeline(paths={'log': path, 'temp': path})
+    for x in xs:
+        pipeline.add_step(scaled, x=x, scale=scale)
+    return pipeline
+
+def test_journal_round_trip(tmpdir):
+    path = str(tmpdir.join('pipeline.journal'))
+    journal = PipelineJournal(path, compact_every=2)
+    journal.clear('snapshot')
+    assert journal.append({'step_id': 0, 'results': {'status': 'success'}})
+    assert not journal.needs_compaction()
+    assert journal.append({'step_id': 1, 'results': {'status': 'error'}})
+    assert journal.needs_compaction()
+    records = list(journal.read())
+    assert records[0]=={'snapshot_id': 'snapshot'}
+    assert [r['step_id'] for r in records[1:]]==[0, 1]
+    # A record that was only partially written is ignored
+    with open(path, 'ab') as f:
+        f.write(b'P\x00\x00')
+    with warnings.catch_warnings(record=True) as w:
+        warnings.simplefilter('always')
+        assert len(list(journal.read()))==3
+    assert any(['incomplete' in str(warning.message) for warning in w])
+
+def test_replay_and_resume(tmpdir):
+    path = str(tmpdir)
+    pipeline = build_pipeline(path, [1, 2, -1, 4])
+    with pytest.raises(ValueError):
+        pipeline.run(checkpoint='journal')
+    logfile = os.path.join(path, 'pipeline.p')
+    loaded = load_pipeline(logfile)
+    assert loaded.run_step_idx==2
+    assert [s.results for s in loaded.run_steps[:2]]==[
+        {'status': 'success', 'x': 1}, {'status': 'success', 'x': 2}]
+    assert loaded.run_steps[2].results is None
+    assert loaded.global_vars.total==2
+    # Fix the step that failed and finish the run
+    loaded.run_steps[2].func_kwargs['x'] = 3
+    loaded.run(resume=True, checkpoint='journal')
+    assert [s.results['x'] for s in loaded.run_steps]==[1, 2, 3, 4]
+    assert load_pipeline(logfile).global_vars.total==4
+
+def test_stale_journal_not_replayed(tmpdir):
+    path = str(tmpdir)
+    logfile = os.path.join(path, 'pipeline.p')
+    build_pipeline(path, [1, 2, 3]).run(checkpoint='journal')
+    stale = open(get_journal_path(logfile), 'rb').read()
+    # A run in snapshot mode removes the old journal
+    build_pipeline(path, [1, 2, 3], 100).run(checkpoint='snapshot')
+    assert not os.path.isfile(get_journal_path(logfile))
+    loaded = load_pipeline(logfile)
+    assert [s.results['x'] for s in loaded.run_steps]==[100, 200, 300]
+    assert loaded.global_vars.total==300
+    # A journal written after a different snapshot is skipped
+    with open(get_journal_path(logfile), 'wb') as f:
+        f.write(stale)
+    with warnings.catch_warnings(record=True) as w:
+        warnings.simplefilter('always')
+        loaded = load_pipeline(logfile)
+    assert [s.results['x'] for s in loaded.run_steps]==[100, 200, 300]
+    assert any(['does not match' in str(warning.message) for warning in w])
+
+def test_substep_records_reduce_globals(tmpdir):
+    path = str(tmpdir)
+    pipeline = Pipeline(paths={'log': path, 'temp': path}, global_vars={'total': 100})
+    steps = [{'func': add_total, 'func_kwargs': {'x': x}} for x in list(range(20))+[-1]]
+    pipeline.add_step(MultiprocessStep(steps=steps, executor='thread', pool_size=2,
+        reducers={'total': 'sum', 'items': 'concat'}))
+    with pytest.raises(ValueError):
+        pipeline.run(checkpoint='journal')
+    logfile = os.path.join(path, 'pipeline.p')
+    records = list(PipelineJournal(get_journal_path(logfile)).read())
+    # Only the updates of each sub-step are saved, not the combined values
+    assert len(records)==21
+    assert not any(['globals' in record for record in records])
+    loaded = load_pipeline(logfile)
+    assert loaded.global_vars.total==100+sum(range(20))
+    assert sorted(loaded.global_vars.items)==list(range(20))
+
+substep_calls = []
+
+def record_call(x):
+    substep_calls.append(x)
+    if x<0:
+        raise ValueError('step failed')
+    return {'status': 'success', 'x': x}
+
+@pytest.mark.parametrize('checkpoint', ['snapshot', 'journal'])
+def test_resume_substeps(tmpdir, checkpoint):
+    del substep_calls[:]
+    path = str(tmpdir)
+    pipeline = Pipeline(paths={'log': path, 'temp': path})
+    pipeline.add_step(record_call, x=100)
+    steps = [{'func': record_call, 'func_kwargs': {'x': x}} for x in [0, 1, -1, 3, 4]]
+    pipeline.add_step(MultiprocessStep(steps=steps, executor='thread', pool_size=2))
+    with pytest.raises(ValueError):
+        pipeline.run(checkpoint=checkpoint)
+    assert sorted(substep_calls)==[-1, 0, 1, 3, 4, 100]
+    loaded = load_pipeline(os.path.join(path, 'pipeline.p'))
+    assert loaded.run_step_idx==1
+    assert [s.results is not None for s in loaded.run_steps[1].steps]==[
+        True, True, False, True, True]
+    # Fix the sub-step that failed and resume the run
+    del substep_calls[:]
+    loaded.run_steps[1].steps[2].func_kwargs['x'] = 2
+    loaded.run(resume=True, checkpoint=checkpoint)
+    assert substep_calls==[2]
+    assert [s.results['x'] for s in loaded.run_steps[1].steps]==[0, 1, 2, 3, 4]
+
+def test_globals_delta():
+    pipeline = Pipeline(global_vars={'items': [], 'total': 1, 'lock': threading.Lock()})
+    global_vars = pipeline.global_vars
+    before = get_globals_state(global_vars)
+    global_vars.items.append(1)
+    global_vars.total = 2
+    global_vars.new = 'x'
+    changed, deleted, complete = get_globals_delta(before, global_vars)
+    assert changed=={'items': [1], 'total': 2, 'new': 'x'}
+    assert deleted==[]
+    # The lock cannot be pickled, so it could have been changed in place
+    assert not complete
+    del global_vars.lock
+    assert get_globals_delta(get_globals_state(global_vars), global_vars)==({}, [], True)
+
+def test_journal_inplace_globals(tmpdir):
+    path = str(tmpdir)
+    pipeline = Pipeline(paths={'log': path, 'temp': path}, global_vars={'items': []})
+    for x in [1, 2, -1]:
+        pipeline.add_step(append_item, x=x)
+    with pytest.raises(ValueError):
+        pipeline.run(checkpoint='journal')
+    logfile = os.path.join(path, 'pipeline.p')
+    records = list(PipelineJournal(get_journal_path(logfile)).read())
+    assert [record['globals'] for record in records[1:]]==[{'items': [1]}, {'items': [1, 2]}]
+    assert load_pipeline(logfile).global_vars.items==[1, 2]
+
+def test_journal_unpicklable_globals(tmpdir, monkeypatch):
+    path = str(tmpdir)
+    pipeline = Pipeline(paths={'log': path, 'temp': path}, global_vars={'items': []})
+    for x in [1, 2]:
+        pipeline.add_step(append_item, x=x)
+    # The fingerprint of a global is missing when it cannot be serialized
+    monkeypatch.setattr(journal, 'get_fingerprint', lambda value: None)
+    pipeline.run(checkpoint='journal')
+    logfile = os.path.join(path, 'pipeline.p')
+    # The pipeline is saved after each step instead of being journaled
+    records = list(PipelineJournal(get_journal_path(logfile)).read())
+    assert records==[{'snapshot_id': pipeline.snapshot_id}]
+    loaded = load_pipeline(logfile)
+    assert [s.results for s in loaded.run_steps]==[{'status': 'success'}]*2
+    assert loaded.global_vars.items==[1, 2]
@@ -0,0 +1,125 @@
+# Copyright 2015 Fred Moolekamp
+# BSD 3-clause license
+import gc
+from functools import partial
+
+from datapyp import core, plan
+from datapyp.core import Pipeline, PipelineStep, MultiprocessStep
+from datapyp.plan import get_injected_kwargs, filter_steps
+
+def plain(x):
+    return {'status': 'success', 'x': x}
+
+def injected(x, step_id, global_vars, pipeline):
+    return {'status': 'success', 'x': x, 'step_id': step_id,
+        'scale': global_vars.scale, 'name': pipeline.name}
+
+def keyword_only(x, *, global_vars=None):
+    return {'status': 'success', 'x': x*global_vars.scale}
+
+class Step:
+    def run(self, x, step_id):
+        return {'status': 'success', 'x': x, 'step_id': step_id}
+
+def count_inspections(monkeypatch):
+    calls = []
+    get_arg_names = plan.get_arg_names
+    def counted(func):
+        calls.append(func)
+        return get_arg_names(func)
+    monkeypatch.setattr(plan, 'get_arg_names', counted)
+    return calls
+
+def test_injected_kwargs(monkeypatch):
+    calls = count_inspections(monkeypatch)
+    assert get_injected_kwargs(plain)==()
+    assert get_injected_kwargs(injected)==('step_id', 'global_vars', 'pipeline')
+    assert get_injected_kwargs(keyword_only)==('global_vars',)
+    for n in range(10):
+        get_injected_kwargs(injected)
+    # Each signature is only inspected once
+    assert calls==[plain, injected, keyword_only]
+    # Bound methods share the signature of their function
+    assert get_injected_kwargs(Step().run)==('step_id',)
+    assert get_injected_kwargs(Step().run)==('step_id',)
+    assert len(calls)==4
+
+def test_injected_cache_is_weak():
+    def build(scale):
+        def closure(x, global_vars):
+            return x*scale
+        return closure
+    closure = build(2)
+    assert get_injected_kwargs(closure)==('global_vars',)
+    assert get_injected_kwargs(partial(injected, 1))==(
+        'step_id', 'global_vars', 'pipeline')
+    size = len(plan._injected)
+    del closure
+    gc.collect()
+    assert len(plan._injected)<size
+    # Builtins cannot be weakly referenced and are not cached
+    assert get_injected_kwargs(len)==()
+
+def test_get_func_kwargs():
+    pipeline = Pipeline(name='test', global_vars={'scale': 3})
+    step = PipelineStep(injected, 'step', func_kwargs={'x': 1})
+    func_kwargs = pipeline.get_func_kwargs(step)
+    assert func_kwargs=={'x': 1, 'step_id': 'step', 'global_vars': pipeline.global_vars,
+        'pipeline': pipeline}
+    # The step's own keyword arguments are not changed
+    assert step.func_kwargs=={'x': 1}
+
+def test_injected_once_per_run(monkeypatch):
+    calls = []
+    def counted(func):
+        calls.append(func)
+        return get_injected_kwargs(func)
+    monkeypatch.setattr(core, 'get_injected_kwargs', counted)
+    pipeline = Pipeline(global_vars={'scale': 3})
+    for x in range(5):
+        pipeline.add_step(plain, x=x)
+        pipeline.add_step(keyword_only, x=x)
+    pipeline.run()
+    assert calls==[plain, keyword_only]
+    assert [s.results['x'] for s in pipeline.steps[1::2]]==[0, 3, 6, 9, 12]
+    # The kwargs of a step without any injected keywords are not copied
+    step = pipeline.steps[0]
+    assert pipeline.get_func_kwargs(step) is step.func_kwargs
+    assert pipeline._injected=={plain: ()}
+    pipeline.run()
+    assert len(calls)==4
+
+def test_run_injected():
+    pipeline = Pipeline(name='test', global_vars={'scale': 3}, executor='thread')
+    pipeline.add_step(injected, x=1)
+    pipeline.add_step(keyword_only, x=2)
+    pipeline.add_step(Step().run, x=3)
+    pipeline.add_step(MultiprocessStep(steps=[
+        {'func': keyword_only, 'func_kwargs': {'x': x}} for x in range(3)]))
+    pipeline.run()
+    assert pipeline.steps[0].results=={'status': 'success', 'x': 1, 'step_id': 0,
+        'scale': 3, 'name': 'test'}
+    assert pipeline.steps[1].results['x']==6
+    assert pipeline.steps[2].results['step_id']==2
+    assert [s.results['x'] for s in pipeline.steps[3].steps]==[0, 3, 6]
+
+def test_filter_steps():
+    steps = [PipelineStep(plain, n, tags=tags) for n, tags in enumerate(
+        [['a'], ['a', 'b'], ['c'], []])]
+    assert filter_steps(steps)==steps
+    assert filter_steps(steps, ['a'])==steps[:2]
+    assert filter_steps(steps, ['a', 'c'], ['b'])==[steps[0], steps[2]]
+    assert filter_steps(steps, tag_expr='not a')==steps[2:]
+
+def test_run_steps_filtered_once():
+    pipeline = Pipeline()
+    for tags in [['a'], ['b'], ['a']]:
+        pipeline.add_step(plain, x=1, tags=tags)
+    pipeline.run(run_tags=['a'])
+    run_steps = pipeline.run_steps
+    assert [step.step_id for step in run_steps]==[0, 2]
+    # Resuming uses the steps selected by the first run
+    pipeline.run(resume=True)
+    assert [step.step_id for step in pipeline.run_steps]==[0, 2]
+    pipeline.run(run_steps=pipeline.steps, ignore_tags=['a'])
+    assert [step.step_id for step in pipeline.run_steps]==[1]
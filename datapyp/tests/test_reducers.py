@@ -0,0 +1,106 @@
+# Copyright 2015 Fred Moolekamp
+# BSD 3-clause license
+import pytest
+
+from datapyp.core import Pipeline, MultiprocessStep, PipelineGlobals, PipelineError
+from datapyp.reducers import get_reducer, apply_updates
+
+def update_globals(x):
+    return {'status': 'success', 'global_updates': {
+        'total': x, 'items': [x], 'low': x, 'high': x, 'last': x}}
+
+@pytest.mark.parametrize('name, current, value, result', [
+    ('sum', 1, 2, 3),
+    ('concat', [1], (2, 3), [1, 2, 3]),
+    ('min', 1, 2, 1),
+    ('max', 1, 2, 2),
+    ('replace', 1, 2, 2)
+])
+def test_reducer(name, current, value, result):
+    assert get_reducer(name)(current, value)==result
+
+def test_unknown_reducer():
+    assert get_reducer(max) is max
+    with pytest.raises(PipelineError):
+        get_reducer('mean')
+    with pytest.raises(PipelineError):
+        MultiprocessStep(steps=[], reducers={'total': 'mean'})
+
+def test_apply_updates():
+    global_vars = PipelineGlobals(total=1, items=[0])
+    updated = apply_updates(global_vars, {'total': 2, 'items': [1], 'new': 3},
+        {'total': 'sum', 'items': 'concat'})
+    assert updated=={'total': 3, 'items': [0, 1], 'new': 3}
+    assert (global_vars.total, global_vars.items, global_vars.new)==(3, [0, 1], 3)
+    with pytest.warns(UserWarning):
+        apply_updates(global_vars, {'new': 4}, {})
+    assert global_vars.new==4
+
+def test_many_concat_updates():
+    items = [-1]
+    global_vars = PipelineGlobals(items=items)
+    buffers = {}
+    for x in range(100000):
+        apply_updates(global_vars, {'items': [x]}, {'items': 'concat'}, buffers)
+    assert global_vars.items==[-1]+list(range(100000))
+    # The list that existed before the updates is not changed, while the new list
+    # is extended in place
+    assert items==[-1]
+    assert buffers['items'] is global_vars.items
+    # Another step copies the list again
+    combined = global_vars.items
+    apply_updates(global_vars, {'items': [0]}, {'items': 'concat'}, {})
+    assert global_vars.items is not combined
+    assert len(combined)==100001
+
+def test_many_concat_arrays():
+    np = pytest.importorskip('numpy')
+    initial = np.zeros((1, 2), dtype=int)
+    global_vars = PipelineGlobals(rows=initial)
+    buffers = {}
+    views = []
+    for x in range(1, 10001):
+        apply_updates(global_vars, {'rows': np.array([[x, x]])}, {'rows': 'concat'},
+            buffers)
+        views.append(global_vars.rows)
+    assert global_vars.rows.shape==(10001, 2)
+    assert np.all(global_vars.rows[:, 0]==np.arange(10001))
+    # Arrays returned by earlier updates keep their values
+    assert np.all(views[9]==np.arange(11)[:, None])
+    assert np.all(initial==0)
+    # A different dtype or shape is combined in the same way as reduce_concat
+    apply_updates(global_vars, {'rows': np.array([[0.5, 0.5]])}, {'rows': 'concat'},
+        buffers)
+    assert global_vars.rows.dtype==float and global_vars.rows.shape==(10002, 2)
+    with pytest.raises(ValueError):
+        apply_updates(global_vars, {'rows': np.array([1, 2, 3])}, {'rows': 'concat'},
+            buffers)
+
+def concat_step(x):
+    return {'status': 'success', 'global_updates': {'items': [x]}}
+
+def test_concat_step_updates():
+    items = []
+    pipeline = Pipeline(global_vars={'items': items}, executor='thread')
+    for n in range(2):
+        pipeline.add_step(MultiprocessStep(steps=[
+            {'func': concat_step, 'func_kwargs': {'x': x}} for x in range(2000)],
+            pool_size=2, chunksize=100, reducers={'items': 'concat'}))
+    pipeline.run()
+    assert sorted(pipeline.global_vars.items)==sorted(2*list(range(2000)))
+    assert items==[]
+    assert pipeline._reductions=={}
+
+@pytest.mark.parametrize('name', ['serial', 'thread', 'process'])
+def test_multiprocess_reducers(name):
+    pipeline = Pipeline(global_vars={'total': 10}, executor=name)
+    pipeline.add_step(MultiprocessStep(steps=[
+        {'func': update_globals, 'func_kwargs': {'x': x}} for x in range(1, 6)],
+        pool_size=2, reducers={'total': 'sum', 'items': 'concat', 'low': 'min',
+        'high': 'max', 'last': 'replace'}))
+    pipeline.run()
+    global_vars = pipeline.global_vars
+    assert global_vars.total==25
+    assert sorted(global_vars.items)==[1, 2, 3, 4, 5]
+    assert (global_vars.low, global_vars.high)==(1, 5)
+    assert global_vars.last in range(1, 6)
@@ -0,0 +1,26 @@
+# Copyright 2015 Fred Moolekamp
+# BSD 3-clause license
+import os
+
+from datapyp.core import Pipeline, ThreadedStep
+from datapyp.retry import RetryPolicy
+
+def flaky_step(x, path):
+    # Fails the first time it is run
+    filename = os.path.join(path, 'flaky-{0}'.format(x))
+    if not os.path.isfile(filename):
+        open(filename, 'w').close()
+        raise IOError('first attempt')
+    return {'status': 'success', 'x': x}
+
+def test_retry(tmpdir):
+    path = str(tmpdir)
+    pipeline = Pipeline()
+    pipeline.add_step(ThreadedStep(steps=[{'func': flaky_step,
+        'func_kwargs': {'x': x, 'path': path}} for x in range(3)],
+        retry=RetryPolicy(2, backoff=0.01)))
+    pipeline.add_step(flaky_step, x=10, path=path, retry=1, ignore_exceptions=True,
+        ignore_errors=True)
+    pipeline.run()
+    assert [s.results['attempts'] for s in pipeline.steps[0].steps]==[2, 2, 2]
+    assert pipeline.steps[1].results['status']=='error'
@@ -0,0 +1,83 @@
+# Copyright 2015 Fred Moolekamp
+# BSD 3-clause license
+import threading
+
+import pytest
+
+from datapyp.core import Pipeline, PipelineStep, PipelineError
+from datapyp.scheduler import get_dependencies, topological_order, DagScheduler
+
+order = []
+_lock = threading.Lock()
+
+def record(name):
+    with _lock:
+        order.append(name)
+    if name=='fail':
+        raise ValueError('step failed')
+    return {'status': 'success'}
+
+def build_steps(specs):
+    return [PipelineStep(record, step_id, func_kwargs={'name': step_id}, **params)
+        for step_id, params in specs]
+
+def test_dependencies():
+    steps = build_steps([
+        ('a', {'outputs': ['data/a.fits']}),
+        ('b', {'inputs': ['data/./a.fits'], 'outputs': ['b.fits']}),
+        ('c', {'depends_on': ['a', 'missing']}),
+        ('d', {'inputs': ['b.fits', 'other.fits'], 'depends_on': ['c']})
+    ])
+    assert get_dependencies(steps)==[set(), set([0]), set([0]), set([1, 2])]
+
+def test_topological_order():
+    assert topological_order([set([2]), set(), set([1]), set()])==[1, 2, 0, 3]
+    with pytest.raises(PipelineError):
+        topological_order([set([1]), set([0]), set()])
+
+def test_dag_scheduler():
+    steps = build_steps([
+        ('a', {'depends_on': ['c']}),
+        ('b', {}),
+        ('c', {'depends_on': ['b']}),
+        ('d', {})
+    ])
+    del order[:]
+    started = []
+    finished = []
+    dag = DagScheduler(steps, max_concurrent=1)
+    dag.run(lambda idx: steps[idx].func(**steps[idx].func_kwargs),
+        on_start=started.append, on_finish=finished.append)
+    # With a single worker the ready step that comes first is run first
+    assert order==['b', 'c', 'a', 'd']
+    assert started==[1, 2, 0, 3]
+    assert finished==started
+    # Completed steps are skipped
+    del order[:]
+    dag.run(lambda idx: steps[idx].func(**steps[idx].func_kwargs), completed=[1, 2])
+    assert order==['a', 'd']
+
+def test_dag_failure():
+    steps = build_steps([
+        ('fail', {}),
+        ('b', {'depends_on': ['fail']}),
+        ('c', {'depends_on': ['b']})
+    ])
+    del order[:]
+    dag = DagScheduler(steps, max_concurrent=4)
+    with pytest.raises(ValueError):
+        dag.run(lambda idx: steps[idx].func(**steps[idx].func_kwargs))
+    assert order==['fail']
+
+def test_pipeline_dag():
+    del order[:]
+    pipeline = Pipeline()
+    pipeline.add_step(record, name='a', depends_on=[2])
+    pipeline.add_step(record, name='b')
+    pipeline.add_step(record, name='c', depends_on=[1])
+    pipeline.run(scheduler='dag', max_concurrent=1)
+    assert order==['b', 'c', 'a']
+    assert pipeline.run_step_idx==3
+    assert all([step.results['status']=='success' for step in pipeline.steps])
+    with pytest.raises(PipelineError):
+        pipeline.run(scheduler='random')
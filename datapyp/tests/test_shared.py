@@ -0,0 +1,49 @@
+# Copyright 2015 Fred Moolekamp
+# BSD 3-clause license
+import pickle
+
+import pytest
+
+from datapyp.core import Pipeline, MultiprocessStep, PipelineGlobals
+from datapyp.shared import SharedGlobals, SharedArray, detach_all
+
+def sum_array(global_vars):
+    return {'status': 'success', 'total': float(global_vars.data.sum()),
+        'writeable': global_vars.data.flags.writeable}
+
+def test_shared_globals(tmpdir):
+    np = pytest.importorskip('numpy')
+    data = np.arange(SharedGlobals.min_size//8+1, dtype=float)
+    global_vars = PipelineGlobals(data=data, small=np.arange(3), name='test')
+    shared_globals = SharedGlobals(str(tmpdir))
+    shared = shared_globals.share(global_vars)
+    try:
+        # Only the large array is shared and the pipeline's globals are not changed
+        assert isinstance(shared.data, SharedArray)
+        assert shared.small is global_vars.small
+        assert global_vars.data is data
+        loaded = pickle.loads(pickle.dumps(shared))
+        assert np.array_equal(loaded.data, data)
+        assert not loaded.data.flags.writeable
+        assert loaded.name=='test'
+        del loaded
+        detach_all()
+    finally:
+        shared_globals.release()
+    assert shared_globals.blocks==[] and shared_globals.files==[]
+    # Globals without large arrays are sent unchanged
+    global_vars = PipelineGlobals(small=np.arange(3))
+    assert SharedGlobals().share(global_vars) is global_vars
+
+def test_pipeline_shared_globals(tmpdir):
+    np = pytest.importorskip('numpy')
+    data = np.ones(SharedGlobals.min_size//8+1)
+    pipeline = Pipeline(paths={'temp': str(tmpdir)}, global_vars={'data': data},
+        executor='process')
+    pipeline.add_step(MultiprocessStep(steps=[{'func': sum_array} for n in range(3)],
+        pool_size=2))
+    pipeline.run()
+    results = [step.results for step in pipeline.steps[0].steps]
+    assert [r['total'] for r in results]==[float(len(data))]*3
+    assert not any([r['writeable'] for r in results])
+    assert pipeline.global_vars.data is data
@@ -0,0 +1,170 @@
+# Copyright 2015 Fred Moolekamp
+# BSD 3-clause license
+import pickle
+import tracemalloc
+
+import pytest
+
+from datapyp.core import (Pipeline, PipelineStep, MultiprocessStep, PipelineError,
+    _load_step)
+from datapyp.tags import TagList
+from datapyp.table import StepTable
+
+def add(x, y=0):
+    return {'status': 'success', 'total': x+y}
+
+def check_positive(x):
+    if x<0:
+        return {'status': 'error', 'error_msg': 'x is negative'}
+    return {'status': 'success', 'x': x}
+
+def test_table_columns():
+    table = StepTable(add, {'y': 10}, {'x': [1, 2, 3]}, tags=['sum'], timeout=5)
+    assert len(table)==3
+    assert [step.func_kwargs for step in table]==[
+        {'x': 1, 'y': 10}, {'x': 2, 'y': 10}, {'x': 3, 'y': 10}]
+    step = table[-1]
+    assert step.step_id==2
+    assert step.func is add
+    assert step.tags==['sum']
+    assert step.timeout==5
+    assert step.results is None
+    assert [step.step_id for step in table[1:]]==[1, 2]
+    with pytest.raises(IndexError):
+        table[3]
+    with pytest.raises(PipelineError):
+        StepTable(add, columns={'x': [1, 2], 'y': [1]})
+    with pytest.raises(PipelineError):
+        StepTable(add, columns={'x': [1]}, not_a_param=True)
+
+def test_table_views():
+    table = StepTable(add, columns={'x': [1, 2]})
+    # Changes to a view are saved in the table
+    table[0].ignore_errors = True
+    table[1].step_id = 'second'
+    assert table[0].ignore_errors and not table[1].ignore_errors
+    assert [step.step_id for step in table]==[0, 'second']
+    with pytest.raises(AttributeError):
+        table[0].func = check_positive
+
+def test_table_append():
+    table = StepTable()
+    table.append(PipelineStep(add, 'a', func_kwargs={'x': 1, 'y': 2}, tags=['t1']))
+    table.append(PipelineStep(add, 'b', func_kwargs={'x': 3, 'y': 2}, tags=['t2']))
+    table.append(PipelineStep(check_positive, 'c', func_kwargs={'x': 4},
+        ignore_exceptions=True))
+    assert [step.step_id for step in table]==['a', 'b', 'c']
+    assert [step.func_kwargs for step in table]==[
+        {'x': 1, 'y': 2}, {'x': 3, 'y': 2}, {'x': 4}]
+    assert [step.tags for step in table]==[['t1'], ['t2'], []]
+    assert [step.ignore_exceptions for step in table]==[False, False, True]
+    # The second step only stores the keyword that is different from the first
+    assert len(table.base_kwargs)==2
+
+def test_table_results():
+    table = StepTable(add, columns={'x': [1, 2, 3]})
+    table.set_results(0, {'status': 'success', 'total': 1})
+    table.set_results(1, {'status': 'error', 'error_msg': 'failed'})
+    assert table[0].results=={'status': 'success', 'total': 1}
+    assert table[1].results=={'status': 'error', 'error_msg': 'failed'}
+    # New results replace all of the old values
+    table.set_results(0, {'status': 'success'})
+    assert table[0].results=={'status': 'success'}
+    # Results that don't use a known status are stored as they are
+    table.set_results(2, ['not', 'a', 'dict'])
+    assert table[2].results==['not', 'a', 'dict']
+    columns = table.get_results_columns()
+    assert columns['step_id']==[0, 1, 2]
+    assert columns['status']==['success', 'error', 'unknown']
+    assert columns['error_msg']==[None, 'failed', None]
+
+def test_table_pickle():
+    table = StepTable(add, {'y': 1}, {'x': [1, 2]}, tags=['a'])
+    table.set_results(0, {'status': 'success', 'total': 2})
+    loaded = pickle.loads(pickle.dumps(table))
+    assert [step.func_kwargs for step in loaded]==[{'x': 1, 'y': 1}, {'x': 2, 'y': 1}]
+    assert loaded[0].results=={'status': 'success', 'total': 2}
+    # The lookups are rebuilt, so new steps reuse the function and tags
+    loaded.extend(add, {'y': 1}, {'x': [3]}, tags=['a'])
+    assert len(loaded.funcs)==1
+    assert loaded.tag_names==['a']
+    step = pickle.loads(pickle.dumps(table[1]))
+    assert step.func_kwargs=={'x': 2, 'y': 1}
+
+def test_step_footprint():
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    steps = [PipelineStep(add, n) for n in range(1000)]
+    size = tracemalloc.get_traced_memory()[0]-start
+    tracemalloc.stop()
+    # A step stored its attributes in a dict of about 440 bytes before __slots__ were used
+    assert size/len(steps)<300
+    assert steps[0].inputs is steps[1].inputs
+    # Optional attributes that have their default values are not pickled
+    data = pickle.dumps(steps[0], pickle.HIGHEST_PROTOCOL)
+    step = PipelineStep(add, 0, inputs=['a.fits'], timeout=5)
+    assert len(pickle.dumps(step, pickle.HIGHEST_PROTOCOL))>len(data)
+    loaded = pickle.loads(pickle.dumps(step))
+    assert (loaded.inputs, loaded.outputs, loaded.timeout)==(['a.fits'], (), 5)
+    assert isinstance(loaded.tags, TagList)
+    # Steps pickled with every attribute and a TagList are still loaded
+    attrs = tuple([getattr(step, name) for name in PipelineStep.__slots__])
+    loaded = _load_step(PipelineStep, attrs)
+    assert loaded.inputs==['a.fits'] and loaded.tags==[] and loaded.tags is not step.tags
+
+@pytest.mark.parametrize('executor', ['serial', 'thread'])
+def test_run_table(executor):
+    table = StepTable(check_positive, columns={'x': [1, -1, 2]}, ignore_errors=True)
+    pipeline = Pipeline(executor=executor)
+    pipeline.add_step(MultiprocessStep(steps=table, pool_size=2))
+    pipeline.run()
+    columns = table.get_results_columns(['x'])
+    assert columns['status']==['success', 'error', 'success']
+    assert columns['x']==[1, None, 2]
+
+def test_read_csv_columns(tmpdir):
+    from datapyp.table import read_csv_columns
+    filename = str(tmpdir.join('params.csv'))
+    with open(filename, 'w') as f:
+        f.write('id, x\n00123,1.5\n00456,2\n\n')
+    columns = read_csv_columns(filename)
+    # Values are kept as strings unless a type is given
+    assert columns=={'id': ['00123', '00456'], 'x': ['1.5', '2']}
+    columns = read_csv_columns(filename, {'x': float})
+    assert list(columns['x'])==[1.5, 2.0]
+    with pytest.raises(PipelineError):
+        read_csv_columns(filename, {'id': float, 'y': int})
+    with pytest.raises(PipelineError):
+        read_csv_columns(filename, {'x': int})
+    with open(filename, 'a') as f:
+        f.write('1,2,3\n')
+    with pytest.raises(PipelineError):
+        read_csv_columns(filename)
+
+def test_from_columns(tmpdir):
+    filename = str(tmpdir.join('params.csv'))
+    with open(filename, 'w') as f:
+        f.write('x\n1\n2\n3\n')
+    step = MultiprocessStep.from_columns(add, filename, {'y': 1}, dtypes={'x': int},
+        pool_size=2)
+    pipeline = Pipeline(executor='thread')
+    pipeline.add_step(step)
+    pipeline.run()
+    assert isinstance(step.steps, StepTable)
+    assert step.steps.get_results_columns(['total'])['total']==[2, 3, 4]
+    with pytest.raises(PipelineError):
+        MultiprocessStep.from_columns(add, [1, 2, 3])
+
+def test_from_structured_array():
+    np = pytest.importorskip('numpy')
+    params = np.array([(1, 10.), (2, 20.)], dtype=[('x', 'i8'), ('y', 'f8')])
+    step = MultiprocessStep.from_columns(add, params, step_params={'ignore_errors': True})
+    # The fields of the array are used without copying them
+    assert step.steps.columns['x'].base is params
+    pipeline = Pipeline(executor='serial')
+    pipeline.add_step(step)
+    pipeline.run()
+    totals = step.steps.get_results_columns(['total'])['total']
+    assert totals==[11., 22.]
+    assert all([type(total) is float for total in totals])
+    assert step.steps[0].ignore_errors
@@ -0,0 +1,204 @@
+# Copyright 2015 Fred Moolekamp
+# BSD 3-clause license
+import pickle
+import random
+
+import pytest
+
+from datapyp.core import Pipeline, PipelineStep, MultiprocessStep, PipelineError
+from datapyp.plan import filter_steps
+from datapyp.tags import (parse_tag_expression, build_tag_query, match_tags, TagList,
+    StepList, get_step_tags, set_step_tags)
+
+def step_func():
+    return {'status': 'success'}
+
+def build_pipeline():
+    pipeline = Pipeline()
+    for tags in [['reduce'], ['reduce', 'test'], ['debug-1'], ['reduce', 'debug-2'], []]:
+        pipeline.add_step(step_func, tags=tags)
+    return pipeline
+
+def get_ids(steps):
+    return [step.step_id for step in steps]
+
+def test_parse_tag_expression():
+    assert parse_tag_expression('a')==('tag', 'a')
+    assert parse_tag_expression('a or b and not c')==(
+        'or', ('tag', 'a'), ('and', ('tag', 'b'), ('not', ('tag', 'c'))))
+    assert parse_tag_expression('(a or b) and c')==(
+        'and', ('or', ('tag', 'a'), ('tag', 'b')), ('tag', 'c'))
+    assert parse_tag_expression('not not debug*')==('not', ('not', ('tag', 'debug*')))
+
+@pytest.mark.parametrize('expression', ['', 'a and', '(a or b', 'a b', 'or a', 'a)'])
+def test_invalid_tag_expression(expression):
+    with pytest.raises(PipelineError):
+        parse_tag_expression(expression)
+
+def test_match_tags():
+    node = parse_tag_expression('reduce and not (test or debug*)')
+    assert match_tags(node, ['reduce'])
+    assert not match_tags(node, ['reduce', 'test'])
+    assert not match_tags(node, ['reduce', 'debug-2'])
+    assert not match_tags(node, [])
+    assert match_tags(build_tag_query(['a', 'b']), ['b'])
+    assert not match_tags(build_tag_query(['a'], ['b'], 'c'), ['a', 'b', 'c'])
+    assert build_tag_query() is None
+
+def test_select_steps():
+    pipeline = build_pipeline()
+    assert get_ids(pipeline.select_steps())==[0, 1, 2, 3, 4]
+    assert get_ids(pipeline.select_steps('reduce and not (test or debug*)'))==[0]
+    assert get_ids(pipeline.select_steps('debug*'))==[2, 3]
+    assert get_ids(pipeline.select_steps('not reduce'))==[2, 4]
+    assert get_ids(pipeline.select_steps(run_tags=['test', 'debug-1']))==[1, 2]
+    assert get_ids(pipeline.select_steps('reduce', ignore_tags=['test']))==[0, 3]
+
+def test_pipeline_run_tags():
+    pipeline = build_pipeline()
+    pipeline.run(tag_expr='reduce and not test')
+    assert get_ids(pipeline.run_steps)==[0, 3]
+    assert [step.results is not None for step in pipeline.steps]==[
+        True, False, False, True, False]
+
+def test_stale_tag_index():
+    pipeline = build_pipeline()
+    assert get_ids(pipeline.select_steps('reduce'))==[0, 1, 3]
+    # Remove a step and add a new one at the same position
+    pipeline.steps.pop()
+    pipeline.add_step(step_func, tags=['reduce'])
+    assert get_ids(pipeline.select_steps('reduce'))==[0, 1, 3, 5]
+    # Add a tag to a step that was already indexed
+    pipeline.steps[2].tags.append('reduce')
+    assert get_ids(pipeline.select_steps('reduce'))==[0, 1, 2, 3, 5]
+    # Replace a step
+    pipeline.steps[1] = PipelineStep(step_func, 'new', tags=['test'])
+    assert get_ids(pipeline.select_steps('reduce'))==[0, 2, 3, 5]
+    assert get_ids(pipeline.select_steps('test'))==['new']
+    # Remove steps from the end
+    del pipeline.steps[3:]
+    assert get_ids(pipeline.select_steps('reduce'))==[0, 2]
+    assert get_ids(pipeline.select_steps('not test'))==[0, 2]
+
+def test_index_updated_by_add_step():
+    pipeline = build_pipeline()
+    index = pipeline.get_tag_index()
+    assert index.size==5
+    pipeline.add_step(step_func, tags=['reduce'])
+    # The new step was indexed when it was added
+    assert index.size==6
+    assert index.positions['reduce']==set([0, 1, 3, 5])
+    assert pipeline.get_tag_index() is index
+
+def test_select_skips_unchanged_steps(monkeypatch):
+    pipeline = build_pipeline()
+    for n in range(1000):
+        pipeline.add_step(step_func, tags=['bulk'])
+    assert len(pipeline.select_steps('reduce'))==3
+    # Count every time the tags of a step are read
+    reads = []
+    def read_tags(step):
+        reads.append(step.step_id)
+        return get_step_tags(step)
+    monkeypatch.setattr(PipelineStep, 'tags', property(read_tags, set_step_tags))
+    pipeline.steps[2].tags.append('reduce')
+    pipeline.steps[4].tags = ['test']
+    assert get_ids(pipeline.select_steps('reduce'))==[0, 1, 2, 3]
+    assert get_ids(pipeline.select_steps('test'))==[1, 4]
+    assert len(pipeline.select_steps('bulk and not reduce'))==1000
+    # Only the steps that were changed were read again
+    assert reads==[2]
+
+def test_index_structural_changes():
+    pipeline = build_pipeline()
+    assert get_ids(pipeline.select_steps('reduce'))==[0, 1, 3]
+    pipeline.steps.insert(0, PipelineStep(step_func, 'first', tags=['reduce']))
+    assert get_ids(pipeline.select_steps('reduce'))==['first', 0, 1, 3]
+    pipeline.steps.remove(pipeline.steps[2])
+    assert get_ids(pipeline.select_steps('reduce'))==['first', 0, 3]
+    pipeline.steps.reverse()
+    assert get_ids(pipeline.select_steps('reduce'))==[3, 0, 'first']
+    del pipeline.steps[-1]
+    pipeline.steps.extend([PipelineStep(step_func, 'last', tags=['reduce'])])
+    assert get_ids(pipeline.select_steps('reduce'))==[3, 0, 'last']
+    # A new list of steps is indexed again
+    pipeline.steps = pipeline.steps[:2]
+    assert isinstance(pipeline.steps, StepList)
+    assert get_ids(pipeline.select_steps('reduce'))==[3]
+    # Steps that were removed no longer update the index
+    removed = pipeline.steps.pop()
+    assert removed.step_id==3
+    removed.tags.append('removed')
+    assert get_ids(pipeline.select_steps('reduce or removed'))==[]
+    assert removed.tags._indexes==[]
+
+def test_container_tags():
+    pipeline = Pipeline()
+    mstep = MultiprocessStep(steps=[], tags=['parallel'])
+    pipeline.add_step(mstep)
+    pipeline.add_step(step_func, tags=['reduce'])
+    assert get_ids(pipeline.select_steps('parallel'))==[0]
+    mstep.tags = ['reduce']
+    assert isinstance(mstep.tags, TagList)
+    assert get_ids(pipeline.select_steps('reduce'))==[0, 1]
+    assert get_ids(pipeline.select_steps('parallel'))==[]
+
+def test_pickle_tags():
+    pipeline = build_pipeline()
+    pipeline.add_step(MultiprocessStep(steps=[], tags=['parallel']))
+    pipeline.select_steps('reduce')
+    loaded = pickle.loads(pickle.dumps(pipeline))
+    assert isinstance(loaded.steps, StepList)
+    assert all([isinstance(step.tags, TagList) for step in loaded.steps])
+    assert get_ids(loaded.select_steps('reduce or parallel'))==[0, 1, 3, 5]
+    loaded.steps[2].tags.append('reduce')
+    assert get_ids(loaded.select_steps('reduce'))==[0, 1, 2, 3]
+    # Changes to the loaded steps do not change the original index
+    assert get_ids(pipeline.select_steps('reduce'))==[0, 1, 3]
+    # Containers are saved with the same attributes as before
+    state = pipeline.steps[5].__getstate__()
+    assert state['tags']==['parallel'] and isinstance(state['steps'], list)
+
+def test_copied_tags():
+    tags = ['reduce']
+    step = PipelineStep(step_func, 0, tags=tags)
+    tags.append('test')
+    assert step.tags==['reduce']
+
+def test_duplicate_tags():
+    pipeline = Pipeline()
+    pipeline.add_step(step_func, tags=['a', 'a'])
+    pipeline.add_step(step_func, tags=['b'])
+    assert get_ids(pipeline.select_steps('a'))==[0]
+    pipeline.steps[0].tags.append('b')
+    pipeline.steps[0].tags.append('a')
+    assert get_ids(pipeline.select_steps('b'))==[0, 1]
+    for n in range(2):
+        pipeline.steps[0].tags.remove('a')
+        assert get_ids(pipeline.select_steps('a'))==[0]
+    pipeline.steps[0].tags.remove('a')
+    assert get_ids(pipeline.select_steps('a'))==[]
+    # Steps that were never indexed do not allocate a list of indexes
+    assert PipelineStep(step_func, 0, tags=['a']).tags._indexes is None
+
+def test_index_matches_filter():
+    rng = random.Random(0)
+    names = ['a', 'b', 'c']
+    pipeline = Pipeline()
+    for n in range(20):
+        pipeline.add_step(step_func, tags=rng.choices(names, k=rng.randint(0, 3)))
+    expressions = ['a', 'b or c', 'a and not b', 'not c']
+    for n in range(200):
+        tags = rng.choice(pipeline.steps).tags
+        change = rng.randrange(4)
+        if change==0:
+            tags.append(rng.choice(names))
+        elif change==1 and tags:
+            tags.remove(rng.choice(tags))
+        elif change==2:
+            tags.extend(rng.choices(names, k=2))
+        else:
+            tags[:] = rng.choices(names, k=rng.randint(0, 3))
+        expression = rng.choice(expressions)
+        assert (pipeline.select_steps(expression)==
+            filter_steps(pipeline.steps, tag_expr=expression))
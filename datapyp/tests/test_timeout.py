@@ -0,0 +1,85 @@
+# Copyright 2015 Fred Moolekamp
+# BSD 3-clause license
+import os
+import time
+
+import pytest
+
+from datapyp.core import (Pipeline, PipelineStep, MultiprocessStep, PipelineError,
+    StepTimeout)
+from datapyp.dispatch import TaskDispatcher
+from datapyp.executors import run_batch, ProcessExecutor
+
+def square(x):
+    return x*x
+
+def sleep_step(x, t=0):
+    time.sleep(t)
+    if x<0:
+        raise ValueError('step failed')
+    return {'status': 'success', 'x': x}
+
+def get_pid(x):
+    return os.getpid()
+
+def test_dispatcher_timeout():
+    executor = ProcessExecutor(2)
+    try:
+        dispatcher = TaskDispatcher(executor, sleep_step_args, max_active=2)
+        start = time.time()
+        results = dict([(key, (success, value)) for key, success, value in
+            dispatcher.imap_unordered([(0, (0, 0)), (1, (1, 30))], {1: 0.5})])
+        assert time.time()-start<10
+        assert results[0]==(True, {'status': 'success', 'x': 0})
+        assert not results[1][0] and isinstance(results[1][1], StepTimeout)
+        # The pool replaces the worker that was killed
+        assert sorted(executor.map(square, [1, 2]))==[1, 4]
+    finally:
+        executor.terminate()
+
+def sleep_step_args(args):
+    return sleep_step(*args)
+
+def test_kill_checks_token():
+    executor = ProcessExecutor(1)
+    try:
+        results = []
+        executor.submit(run_batch, (get_pid, [0], 1), results.append, results.append)
+        for n in range(100):
+            if len(results)>0:
+                break
+            time.sleep(0.05)
+        pid = results[0][0][1]
+        # The worker finished the batch, so it is not killed
+        assert not executor.kill(pid, 1)
+        assert executor.map(get_pid, [0])==[pid]
+    finally:
+        executor.terminate()
+
+def test_step_timeout():
+    pipeline = Pipeline()
+    pipeline.add_step(MultiprocessStep(steps=[
+        {'func': sleep_step, 'func_kwargs': {'x': x, 't': t}, 'ignore_errors': True}
+        for x, t in [(0, 0), (1, 30)]], pool_size=2, timeout=1))
+    start = time.time()
+    pipeline.run()
+    assert time.time()-start<10
+    statuses = [s.results['status'] for s in pipeline.steps[0].steps]
+    assert statuses==['success', 'timeout']
+
+def test_timeout_requires_executor():
+    pipeline = Pipeline()
+    with pytest.raises(PipelineError):
+        pipeline.add_step(sleep_step, x=0, timeout=1)
+    assert len(pipeline.steps)==0
+    step = PipelineStep(sleep_step, func_kwargs={'x': 0}, timeout=1)
+    with pytest.raises(PipelineError):
+        pipeline.add_step(step)
+    assert step.step_id is None
+    # The ids of the steps that were not added are reused
+    assert pipeline.next_id==0
+    pipeline.add_step(sleep_step, x=0, t=30, timeout=0.5, executor='process',
+        ignore_errors=True)
+    pipeline.run()
+    assert pipeline.steps[0].results['status']=='timeout'
+    assert pipeline.steps[0].step_id==0